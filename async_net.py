@@ -9,7 +9,7 @@ from log import Loggable
 __all__ = [
     'lookup_host_alias',
     'Listener', 'TcpListener', 'UnixListener',
-    'Reconnector', 'TcpReconnector'
+    'Reconnector', 'TcpReconnector', 'UnixReconnector'
 ]
 
 
@@ -106,12 +106,21 @@ class UnixListener(Listener):
     """
     next_id = 1
 
-    def __init__(self, *args):
-        # TODO: detect intelligently if somebody is bound to it before removing it!
-        #if os.path.exists(addr):
-        #    os.unlink(addr)
+    def __init__(self, addr):
+        # A leftover socket file of a crashed process refuses connections
+        if os.path.exists(addr):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                probe.connect(addr)
+            except ConnectionRefusedError:
+                os.unlink(addr)
+            except OSError:
+                pass
+            finally:
+                probe.close()
 
-        Listener.__init__(self, "UNIX", *args)
+        Listener.__init__(self, "UNIX", addr)
 
         os.chmod(self.addr, 0o666)
 
@@ -181,7 +190,9 @@ class Reconnector(Loggable):
         self.logger.debug("Reconnecting")
         self.socket = self.create_socket()
         self.socket.setblocking(False)
-        self.socket.bind(self.local_addr)
+
+        if self.local_addr:
+            self.socket.bind(self.local_addr)
 
         try:
             self.socket.connect(self.addr)
@@ -234,11 +245,22 @@ class TcpReconnector(Reconnector):
 
     def create_socket(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         return s
 
 
+class UnixReconnector(Reconnector):
+    def __init__(self, *args):
+        Reconnector.__init__(self, "UNIX", *args)
+
+        self.local_addr = None  # stays unnamed
+
+
+    def create_socket(self):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
 def parse_http_like_header(blob):
     lines = blob.decode().split("\r\n")
     headers = []
@@ -0,0 +1,93 @@
+import struct
+import time
+import collections
+
+from format import Addr, Hop
+
+
+# Capture files start with a magic line, then contain records of a fixed header
+# followed by the hop, the remote address, and the raw message bytes. Addresses
+# are stored as text, so the hop can be reconstructed without any configuration.
+
+MAGIC = b"SIPCAP1\n"
+RECORD_HEADER = struct.Struct("!dHHI")  # timestamp, hop size, raddr size, data size
+
+CaptureRecord = collections.namedtuple("CaptureRecord", [ "timestamp", "hop", "raddr", "data" ])
+
+
+class Error(Exception): pass
+
+
+def print_addr(addr):
+    if not addr:
+        return "-"
+
+    return "%s:%s" % (addr.host, addr.port if addr.port is not None else "-")
+
+
+def parse_addr(s):
+    if s == "-":
+        return None
+
+    host, port = s.rsplit(":", 1)
+
+    return Addr(host, int(port) if port != "-" else None)
+
+
+def print_hop(hop):
+    return " ".join((hop.transport, hop.interface or "-", print_addr(hop.local_addr), print_addr(hop.remote_addr)))
+
+
+def parse_hop(s):
+    transport, interface, local_addr, remote_addr = s.split(" ")
+
+    return Hop(transport, interface if interface != "-" else None, parse_addr(local_addr), parse_addr(remote_addr))
+
+
+class CaptureWriter:
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+
+
+    def __del__(self):
+        self.close()
+
+
+    def write(self, hop, raddr, data):
+        h = print_hop(hop).encode("ascii")
+        r = print_addr(raddr).encode("ascii")
+
+        self.file.write(RECORD_HEADER.pack(time.time(), len(h), len(r), len(data)))
+        self.file.write(h)
+        self.file.write(r)
+        self.file.write(data)
+
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_capture(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Error("Not a capture file: %s!" % filename)
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+
+            if not header:
+                break
+            elif len(header) < RECORD_HEADER.size:
+                raise Error("Truncated capture record!")
+
+            timestamp, hop_size, raddr_size, data_size = RECORD_HEADER.unpack(header)
+            hop = parse_hop(f.read(hop_size).decode("ascii"))
+            raddr = parse_addr(f.read(raddr_size).decode("ascii"))
+            data = f.read(data_size)
+
+            if len(data) < data_size:
+                raise Error("Truncated capture record!")
+
+            yield CaptureRecord(timestamp, hop, raddr, data)
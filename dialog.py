@@ -4,6 +4,11 @@ from format import Uri, Nameaddr, Sip
 from log import Loggable
 from zap import EventSlot
 from util import MAX_FORWARDS, generate_call_id, generate_tag
+from metrics import registry
+
+
+DIALOGS_CREATED = registry.counter("siplib_dialogs_created_total", "SIP dialogs registered by local tag.")
+DIALOGS_LIVE = registry.gauge("siplib_dialogs_live", "SIP dialogs currently alive.")
 
 
 class Error(Exception):
@@ -326,6 +331,12 @@ class DialogManager(Loggable):
         self.switch = switch
         self.dialogs_by_local_tag = WeakValueDictionary()
 
+        DIALOGS_LIVE.add_source(self.count_dialogs)
+
+
+    def count_dialogs(self):
+        return len(self.dialogs_by_local_tag)
+
         
     def provide_auth(self, response):
         return self.switch.provide_auth(response)
@@ -337,6 +348,7 @@ class DialogManager(Loggable):
 
     def register_by_local_tag(self, local_tag, dialog):
         self.dialogs_by_local_tag[local_tag] = dialog
+        DIALOGS_CREATED.inc()
         self.logger.debug("Registered dialog with local tag %s" % (local_tag,))
         
         
@@ -104,6 +104,12 @@ class SipEndpoint(Endpoint, SessionHelper):
 
         
     def hop_selected(self, hop, action):
+        if not hop:
+            self.logger.error("Dialing failed, no hop to the destination!")
+            self.forward(dict(type="reject", status=Status(503, "Destination not resolvable"), cause=Cause.NO_ROUTE_DESTINATION))
+            self.may_finish()
+            return
+            
         self.dst["hop"] = hop
         self.logger.debug("Retrying dial with resolved hop")
         self.do(action)
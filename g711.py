@@ -4,7 +4,9 @@
 #
 # Copyright (C) 2001 Chris Bagwell
 
-import struct
+import sys
+import array
+import operator
 
 lsx_alaw2linear16 = [
      -5504,   -5248,   -6016,   -5760,   -4480,   -4224,   -4992,
@@ -2162,41 +2164,89 @@ def decode_pcma_sample(u8):
     return lsx_alaw2linear16[u8]
 
 
-def encode_pcmu(x):
-    n = int(len(x) / 2)
-    y = bytearray(n)
-    
-    for i in range(n):
-        y[i] = encode_pcmu_sample(struct.unpack_from("<h", x, 2 * i)[0])
-        
+# The frame codecs work on whole buffers with C loops only. Decoding translates
+# the codes into the low and high bytes of the samples, then interleaves them.
+# Encoding looks up the samples, viewed as unsigned shorts, in full 64k tables,
+# so the rounding of the sample codecs above is kept bit exactly.
+
+def make_encode_table(encode_sample):
+    return bytes(encode_sample(u16 - 0x10000 if u16 & 0x8000 else u16) for u16 in range(0x10000))
+
+
+def make_decode_tables(linear16):
+    low = bytes(s16 & 0xff for s16 in linear16)
+    high = bytes((s16 >> 8) & 0xff for s16 in linear16)
+
+    return low, high
+
+
+PCMU_ENCODE_TABLE = make_encode_table(encode_pcmu_sample)
+PCMA_ENCODE_TABLE = make_encode_table(encode_pcma_sample)
+PCMU_DECODE_LOW, PCMU_DECODE_HIGH = make_decode_tables(lsx_ulaw2linear16)
+PCMA_DECODE_LOW, PCMA_DECODE_HIGH = make_decode_tables(lsx_alaw2linear16)
+
+
+def view_samples(x):
+    n = len(x) // 2
+    mv = memoryview(x).cast("B")[:2 * n]
+
+    if sys.byteorder == "little":
+        return mv.cast("H")
+    else:
+        a = array.array("H")
+        a.frombytes(mv)
+        a.byteswap()
+        return a
+
+
+def encode_frame(x, table):
+    samples = view_samples(x)
+
+    # An itemgetter does all the lookups in C, but it returns a scalar for one index
+    if len(samples) < 2:
+        return bytearray([ table[u16] for u16 in samples ])
+
+    return bytearray(operator.itemgetter(*samples)(table))
+
+
+def translatable(x):
+    # Only bytes and bytearray can translate, but memoryviews of payloads are common
+    return x if isinstance(x, (bytes, bytearray)) else bytes(x)
+
+
+def decode_frame(x, low, high):
+    x = translatable(x)
+    y = bytearray(2 * len(x))
+    y[0::2] = x.translate(low)
+    y[1::2] = x.translate(high)
+
     return y
 
 
+def encode_pcmu(x):
+    return encode_frame(x, PCMU_ENCODE_TABLE)
+
+
 def encode_pcma(x):
-    n = int(len(x) / 2)
-    y = bytearray(n)
-    
-    for i in range(n):
-        y[i] = encode_pcma_sample(struct.unpack_from("<h", x, 2 * i)[0])
-        
-    return y
+    return encode_frame(x, PCMA_ENCODE_TABLE)
 
 
 def decode_pcmu(x):
-    n = len(x)
-    y = bytearray(2 * n)
-    
-    for i in range(n):
-        struct.pack_into("<h", y, 2 * i, decode_pcmu_sample(x[i]))
-
-    return y
+    return decode_frame(x, PCMU_DECODE_LOW, PCMU_DECODE_HIGH)
 
 
 def decode_pcma(x):
-    n = len(x)
-    y = bytearray(2 * n)
-    
-    for i in range(n):
-        struct.pack_into("<h", y, 2 * i, decode_pcma_sample(x[i]))
+    return decode_frame(x, PCMA_DECODE_LOW, PCMA_DECODE_HIGH)
 
-    return y
+
+# Converting between the laws through linear samples, but done for all codes in advance
+PCMA_TO_PCMU_TABLE = bytes(encode_pcmu_sample(decode_pcma_sample(u8)) for u8 in range(256))
+PCMU_TO_PCMA_TABLE = bytes(encode_pcma_sample(decode_pcmu_sample(u8)) for u8 in range(256))
+
+
+def transcode_pcma_to_pcmu(x):
+    return bytearray(translatable(x).translate(PCMA_TO_PCMU_TABLE))
+
+
+def transcode_pcmu_to_pcma(x):
+    return bytearray(translatable(x).translate(PCMU_TO_PCMA_TABLE))
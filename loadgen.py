@@ -0,0 +1,611 @@
+import time
+import resource
+from weakref import proxy
+
+from format import Addr, Uri, Nameaddr, Hop, Sip, Status, Cause
+from party import PlannedEndpoint, Routing
+from registrar import LocalRecord
+from subscript import SubscriptionManager, EventSource, MessageSummaryFormatter
+from switch import Switch
+from sdp import Session
+from mgc import Controller
+from metrics import registry
+from log import Loggable
+from zap import Plug, Planned
+from util import EventKey
+
+
+# A self contained load generator. Two switches talk to each other over loopback,
+# sharing a single in-process media gateway, and a Bench object drives the calls,
+# registrations and subscriptions between them. The switches report every client
+# transaction they complete, so the latencies are measured at the SIP level.
+
+BENCH_SESSION = dict(
+    attributes=[],
+    bandwidth=None,
+    channels=[ {
+        'type': 'audio',
+        'proto': 'RTP/AVP',
+        'send': True,
+        'recv': True,
+        'attributes': [('ptime', '20')],
+        'formats': [ {
+            'clock': 8000, 'encoding': 'PCMA', 'encp': 1, 'fmtp': None
+        }, {
+            'clock': 8000, 'encoding': 'telephone-event', 'encp': 1, 'fmtp': '0-15'
+        } ]
+    } ]
+)
+
+
+class Error(Exception): pass
+
+
+class Stats:
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.failures = 0
+
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+
+    def fail(self):
+        self.failures += 1
+
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+
+        return ordered[index]
+
+
+    def summary(self, duration):
+        return dict(
+            name=self.name,
+            count=len(self.samples),
+            failures=self.failures,
+            rate=len(self.samples) / duration if duration else 0,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            max=max(self.samples) if self.samples else None
+        )
+
+
+class BenchCallerEndpoint(PlannedEndpoint):
+    def identify(self, params):
+        self.bench = params["bench"]
+        self.number = params["number"]
+        self.sip_from = params["from"]
+        self.sip_to = params["to"]
+
+        return str(self.number)
+
+
+    def plan(self):
+        src = {
+            'type': "bench",
+            'from': self.sip_from,
+            'to': self.sip_to
+        }
+
+        offer = Session.make_offer(**BENCH_SESSION).copy()
+        started = time.time()
+        self.dial(src, session=offer)
+
+        while True:
+            action = yield from self.wait_action(timeout=self.bench.timeout)
+
+            if not action:
+                self.logger.error("Call timed out!")
+                self.bench.call_finished(self.number, False)
+                self.forward(dict(type="hangup", cause=Cause.NORMAL_CLEARING))
+                return
+
+            type = action["type"]
+
+            if type == "ring":
+                self.bench.stats("ring").add(time.time() - started)
+            elif type == "accept":
+                self.bench.stats("answer").add(time.time() - started)
+                break
+            elif type in ("reject", "hangup"):
+                self.logger.error("Call failed with %s!" % type)
+                self.bench.call_finished(self.number, False)
+                return
+
+        yield from self.sleep(self.bench.hold_time)
+        self.forward(dict(type="hangup", cause=Cause.NORMAL_CLEARING))
+        self.bench.call_finished(self.number, True)
+
+
+class BenchCalleeEndpoint(PlannedEndpoint):
+    def identify(self, params):
+        self.bench = params["bench"]
+
+        return None
+
+
+    def plan(self):
+        action = yield from self.wait_action()
+        offer = action.get("session")
+
+        answer = offer.flipped()
+
+        for c in answer["channels"]:
+            c["formats"] = [ f for f in c["formats"] if f["encoding"] in ("PCMA", "telephone-event") ]
+            c["send"], c["recv"] = c["recv"], c["send"]
+
+        self.forward(dict(type="ring"))
+
+        if self.bench.ring_time:
+            yield from self.sleep(self.bench.ring_time)
+
+        self.forward(dict(type="accept", session=answer))
+
+        while True:
+            action = yield from self.wait_action()
+
+            if not action or action["type"] == "hangup":
+                break
+
+
+class BenchRouting(Routing):
+    def process_dial(self, action):
+        # Calls from the local caller go to the peer switch, the ones from SIP to the callee
+        switch = self.ground.switch
+
+        if action["src"]["type"] == "sip":
+            self.dial(action, "bench_callee", bench=switch.bench)
+        else:
+            self.dial(action, **switch.make_peer_dst(action["src"]))
+
+
+class BenchEventSource(EventSource):
+    def __init__(self):
+        EventSource.__init__(self, { "msgsum" })
+
+        self.mailbox = None
+        self.formatter = MessageSummaryFormatter()
+        self.state = 0
+
+
+    def identify(self, params):
+        self.mailbox = params["mailbox"]
+
+        return self.mailbox
+
+
+    def get_state(self, format):
+        if format == "msgsum":
+            return self.formatter.format(dict(voice=self.state))
+        else:
+            raise Exception("Invalid format: %s!" % format)
+
+
+class BenchSubscriptionManager(SubscriptionManager):
+    def identify_subscription(self, request):
+        if request["event"] == "message-summary":
+            return EventKey("bench", request["to"].uri.username), "msgsum"
+
+        return None, None
+
+
+    def make_event_source(self, type):
+        if type == "bench":
+            return BenchEventSource()
+        else:
+            return None
+
+
+class BenchSubscriber(Loggable):
+    def __init__(self, bench, dialog):
+        Loggable.__init__(self)
+
+        self.bench = bench
+        self.dialog = dialog
+        self.notify_count = 0
+
+        Plug(self.process).attach(self.dialog.message_slot)
+
+
+    def subscribe(self, request_uri, local_uri, remote_uri, hop):
+        self.dialog.setup_outgoing(request_uri, Nameaddr(local_uri), Nameaddr(remote_uri), None, hop)
+
+        request = Sip.request(method="SUBSCRIBE")
+        request["event"] = "message-summary"
+        request["expires"] = self.bench.SUBSCRIPTION_EXPIRES
+        request["contact"] = [ self.dialog.my_contact ]
+        self.dialog.send(request)
+
+
+    def process(self, msg):
+        if msg.is_response:
+            if msg.status.code >= 300:
+                self.logger.error("Subscription rejected with %s!" % msg.status.code)
+
+            return
+
+        request = msg
+
+        if request.method == "NOTIFY":
+            self.dialog.send(Sip.response(status=Status.OK, related=request))
+            self.notify_count += 1
+            self.bench.notified()
+        else:
+            self.logger.warning("Ignoring %s request!" % request.method)
+
+
+class BenchSwitch(Switch):
+    def __init__(self, bench, domain):
+        Switch.__init__(
+            self,
+            subscription_manager=BenchSubscriptionManager(proxy(self)),
+            mgc=Controller()
+        )
+
+        self.bench = bench
+        self.domain = domain
+        self.local_addr = None
+        self.transport = None
+        self.peer_addr = None
+        self.peer_domain = None
+
+
+    def start(self, transport, local_addr, mgw_addr, media_addr, media_count, mgw_path=None):
+        self.transport = transport
+        self.local_addr = local_addr
+
+        self.mgc.add_mgw_addr(mgw_addr, media_addr, media_count, mgw_path)
+
+        self.transport_manager.add_hop(Hop(transport, "lo", local_addr, None))
+
+
+    def set_peer(self, peer_domain, peer_addr):
+        self.peer_domain = peer_domain
+        self.peer_addr = peer_addr
+
+        # Accept everything from the peer without authentication
+        self.registrar.add_local_record(Uri(Addr(peer_domain), None), "peer", LocalRecord.AUTH_NEVER)
+
+
+    def get_peer_hop(self):
+        if self.transport == "UDP":
+            return Hop("UDP", "lo", self.local_addr, self.peer_addr)
+        else:
+            return Hop("TCP", "lo", self.local_addr._replace(port=None), self.peer_addr)
+
+
+    def is_ready(self):
+        return self.mgc.count_gateways() > 0
+
+
+    def make_peer_dst(self, src):
+        return {
+            'type': "sip",
+            'uri': Uri(self.peer_addr, src["to"].uri.username),
+            'hop': self.get_peer_hop(),
+            'from': src["from"],
+            'to': src["to"]
+        }
+
+
+    def make_party(self, type):
+        if type == "routing":
+            return BenchRouting()
+        elif type == "bench_caller":
+            return BenchCallerEndpoint()
+        elif type == "bench_callee":
+            return BenchCalleeEndpoint()
+        else:
+            return Switch.make_party(self, type)
+
+
+    def send_message(self, msg):
+        if not msg.is_response and msg.method not in ("ACK", "CANCEL"):
+            self.bench.request_sent(msg)
+
+        return Switch.send_message(self, msg)
+
+
+    def process(self, msg):
+        if msg.is_response:
+            self.bench.response_received(msg)
+
+        return Switch.process(self, msg)
+
+
+class Bench(Planned):
+    SUBSCRIPTION_EXPIRES = 300
+    READY_TIMEOUT = 10
+
+    def __init__(self, transport="UDP", host="127.0.0.1", base_port=15060, mgw_port=20100, media_port=30000, media_count=200):
+        Planned.__init__(self)
+
+        self.transport = transport
+        self.host = host
+        self.base_port = base_port
+        self.mgw_port = mgw_port
+        self.media_port = media_port
+        self.media_count = media_count
+
+        self.timeout = 10
+        self.hold_time = 1
+        self.ring_time = 0
+        self.mgw_path = None  # control the MGW over this Unix domain socket
+
+        self.mgw = None
+        self.switch_a = None
+        self.switch_b = None
+
+        self.stats_by_name = {}
+        self.started_by_transaction = {}
+        self.results = []
+        self.is_finished = False
+
+        self.phase_calls = 0
+        self.phase_finished = 0
+        self.phase_notifies = 0
+        self.phase_started = None
+
+
+    def stats(self, name):
+        s = self.stats_by_name.get(name)
+
+        if not s:
+            s = Stats(name)
+            self.stats_by_name[name] = s
+
+        return s
+
+
+    def setup(self, mgw_class):
+        mgw_addr = Addr(self.host, self.mgw_port)
+        self.mgw = mgw_class(mgw_addr)
+        self.mgw.set_oid(self.oid.add("mgw"))
+        self.mgw.set_name("bench-mgw")
+        self.mgw.open_port_pool(Addr(self.host, self.media_port), 2 * self.media_count)
+
+        if self.mgw_path:
+            self.mgw.add_local_path(self.mgw_path)
+
+        a_addr = Addr(self.host, self.base_port)
+        b_addr = Addr(self.host, self.base_port + 2)
+
+        self.switch_a = BenchSwitch(proxy(self), "a.bench")
+        self.switch_a.set_oid(self.oid.add("switch", "a"))
+        self.switch_a.set_name("bench-a")
+        self.switch_a.start(self.transport, a_addr, mgw_addr, Addr(self.host, self.media_port), self.media_count, self.mgw_path)
+
+        self.switch_b = BenchSwitch(proxy(self), "b.bench")
+        self.switch_b.set_oid(self.oid.add("switch", "b"))
+        self.switch_b.set_name("bench-b")
+        self.switch_b.start(self.transport, b_addr, mgw_addr, Addr(self.host, self.media_port + 2 * self.media_count), self.media_count, self.mgw_path)
+
+        self.switch_a.set_peer("b.bench", b_addr)
+        self.switch_b.set_peer("a.bench", a_addr)
+
+
+    def request_sent(self, request):
+        key = (request["call_id"], request["cseq"], request.method)
+
+        if key not in self.started_by_transaction:
+            self.started_by_transaction[key] = time.time()
+
+
+    def response_received(self, response):
+        code = response.status.code
+
+        if code < 200:
+            return
+
+        started = self.started_by_transaction.pop((response["call_id"], response["cseq"], response.method), None)
+
+        if started is None:
+            return
+
+        s = self.stats(response.method)
+
+        if code < 300:
+            s.add(time.time() - started)
+        else:
+            s.fail()
+
+
+    def call_finished(self, number, ok):
+        self.phase_finished += 1
+
+        if not ok:
+            self.stats("call").fail()
+
+
+    def notified(self):
+        self.phase_notifies += 1
+
+        if self.phase_started is not None:
+            self.stats("fanout").add(time.time() - self.phase_started)
+
+
+    def count_sip_messages(self):
+        return sum(registry.metrics_by_name["siplib_sip_messages_sent_total"].collect().values())
+
+
+    def wait_until(self, condition):
+        deadline = time.time() + self.timeout
+
+        while not condition():
+            if time.time() > deadline:
+                return False
+
+            yield from self.sleep(0.01)
+
+        return True
+
+
+    def start_phase(self, name):
+        self.logger.info("Starting phase %s." % name)
+        self.phase_finished = 0
+        self.phase_notifies = 0
+        self.phase_started = None
+
+        return time.time(), self.count_sip_messages()
+
+
+    def end_phase(self, name, started, messages, count, names):
+        duration = time.time() - started
+        messages = self.count_sip_messages() - messages
+
+        self.results.append(dict(
+            phase=name,
+            count=count,
+            duration=duration,
+            throughput=count / duration if duration else 0,
+            sip_messages=messages,
+            sip_rate=messages / duration if duration else 0,
+            stats=[ self.stats_by_name[n].summary(duration) for n in names if n in self.stats_by_name ]
+        ))
+
+
+    def run_calls(self, count, rate):
+        started, messages = self.start_phase("calls")
+        interval = 1.0 / rate
+
+        for i in range(count):
+            delay = started + i * interval - time.time()
+
+            if delay > 0:
+                yield from self.sleep(delay)
+
+            dst = {
+                'bench': proxy(self),
+                'number': i,
+                'from': Nameaddr(Uri(Addr("a.bench"), "caller%d" % i)),
+                'to': Nameaddr(Uri(Addr("b.bench"), "callee%d" % i))
+            }
+
+            self.switch_a.start_call("bench_caller", dst)
+
+        ok = yield from self.wait_until(lambda: self.phase_finished >= count)
+        if not ok:
+            self.logger.error("Only %d of %d calls finished!" % (self.phase_finished, count))
+
+        # Let the BYE-s complete, too
+        yield from self.wait_until(lambda: not self.started_by_transaction)
+        self.end_phase("calls", started, messages, count, [ "ring", "answer", "INVITE", "BYE", "call" ])
+
+
+    def run_registrations(self, count):
+        for i in range(count):
+            uri = Uri(Addr("a.bench"), "reg%d" % i)
+            self.switch_a.registrar.add_local_record(uri, "peer", LocalRecord.AUTH_NEVER)
+
+        started, messages = self.start_phase("registrations")
+        hop = self.switch_b.get_peer_hop()
+        registrar_uri = Uri(self.switch_b.peer_addr)
+
+        for i in range(count):
+            uri = Uri(Addr("a.bench"), "reg%d" % i)
+            self.switch_b.registrar.add_remote_record(uri, registrar_uri, hop)
+
+        ok = yield from self.wait_until(lambda: not self.started_by_transaction)
+        if not ok:
+            self.logger.error("Not all registrations completed!")
+
+        self.end_phase("registrations", started, messages, count, [ "REGISTER" ])
+
+
+    def run_subscriptions(self, count, rounds):
+        mailbox = "mailbox"
+        es = self.switch_a.subscription_manager.add_event_source("bench", dict(mailbox=mailbox))
+        hop = self.switch_b.get_peer_hop()
+        request_uri = Uri(self.switch_b.peer_addr, mailbox)
+        remote_uri = Uri(Addr("a.bench"), mailbox)
+
+        started, messages = self.start_phase("subscriptions")
+        subscribers = []
+
+        for i in range(count):
+            subscriber = BenchSubscriber(proxy(self), self.switch_b.make_dialog())
+            subscriber.set_oid(self.oid.add("subscriber", i))
+            subscriber.dialog.set_oid(subscriber.oid.add("dialog"))
+            subscriber.subscribe(request_uri, Uri(Addr("b.bench"), "sub%d" % i), remote_uri, hop)
+            subscribers.append(subscriber)
+
+        # Every subscription gets an initial notification
+        ok = yield from self.wait_until(lambda: self.phase_notifies >= count)
+        if not ok:
+            self.logger.error("Only %d of %d subscriptions were notified!" % (self.phase_notifies, count))
+
+        for i in range(rounds):
+            self.phase_notifies = 0
+            self.phase_started = time.time()
+            es.set_state(i + 1)
+
+            ok = yield from self.wait_until(lambda: self.phase_notifies >= count)
+            if not ok:
+                self.logger.error("Only %d of %d notifications arrived!" % (self.phase_notifies, count))
+
+        self.phase_started = None
+        yield from self.wait_until(lambda: not self.started_by_transaction)
+        self.end_phase("subscriptions", started, messages, count * (rounds + 1), [ "SUBSCRIBE", "NOTIFY", "fanout" ])
+
+
+    def run(self, call_count, call_rate, register_count, subscribe_count, notify_rounds):
+        self.plan_args = (call_count, call_rate, register_count, subscribe_count, notify_rounds)
+        self.start_plan()
+
+
+    def plan(self):
+        call_count, call_rate, register_count, subscribe_count, notify_rounds = self.plan_args
+
+        ok = yield from self.wait_until(lambda: self.switch_a.is_ready() and self.switch_b.is_ready())
+        if not ok:
+            raise Error("Media gateway not connected!")
+
+        if call_count:
+            yield from self.run_calls(call_count, call_rate)
+
+        if register_count:
+            yield from self.run_registrations(register_count)
+
+        if subscribe_count:
+            yield from self.run_subscriptions(subscribe_count, notify_rounds)
+
+
+    def plan_finished(self, error):
+        if error:
+            self.logger.error("Bench plan aborted with: %s!" % error)
+
+        self.is_finished = True
+
+
+    def get_peak_rss(self):
+        # In kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+    def print_results(self):
+        lines = []
+
+        for result in self.results:
+            lines.append("%s: %d in %.2fs, %.1f/s, %d SIP messages, %.1f/s" % (
+                result["phase"], result["count"], result["duration"], result["throughput"],
+                result["sip_messages"], result["sip_rate"]
+            ))
+
+            for s in result["stats"]:
+                lines.append("  %-10s n=%-6d fail=%-4d %s" % (
+                    s["name"], s["count"], s["failures"],
+                    " ".join("%s=%s" % (p, "%.2fms" % (s[p] * 1000) if s[p] is not None else "-") for p in ("p50", "p90", "p99", "max"))
+                ))
+
+        lines.append("peak RSS: %d kB" % self.get_peak_rss())
+
+        return "\n".join(lines)
@@ -0,0 +1,279 @@
+import weakref
+import socket
+import errno
+
+from async_net import TcpListener
+from log import Loggable
+from zap import Plug
+
+
+# A simple metrics registry with a Prometheus-style text exposition. Counters are
+# allocated once per label combination, and the hot paths are expected to keep
+# a reference to them, so incrementing is just an attribute update. Gauges are
+# computed from the owner objects only when scraped, so they cost nothing otherwise.
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+
+    def collect(self):
+        raise NotImplementedError()
+
+
+    def print_labels(self, values):
+        if not values:
+            return ""
+
+        pairs = ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(self.label_names, values))
+        return "{%s}" % pairs
+
+
+    def expose(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.TYPE)
+        ]
+
+        for values, value in sorted(self.collect().items()):
+            lines.append("%s%s %s" % (self.name, self.print_labels(values), value))
+
+        return lines
+
+
+class CounterMetric(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name, help, label_names):
+        Metric.__init__(self, name, help, label_names)
+
+        self.counters_by_values = {}
+
+        if not self.label_names:
+            self.counters_by_values[()] = Counter()
+
+
+    def labels(self, *values):
+        counter = self.counters_by_values.get(values)
+
+        if counter is None:
+            if len(values) != len(self.label_names):
+                raise Exception("Metric %s needs labels %s!" % (self.name, self.label_names))
+
+            counter = Counter()
+            self.counters_by_values[values] = counter
+
+        return counter
+
+
+    def inc(self, amount=1):
+        self.counters_by_values[()].value += amount
+
+
+    def collect(self):
+        return { values: counter.value for values, counter in self.counters_by_values.items() }
+
+
+class GaugeMetric(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, help, label_names):
+        Metric.__init__(self, name, help, label_names)
+
+        # Sources are weak methods of the measured objects, so they go away with them.
+        # Multiple sources with the same labels are summed.
+        self.sources = []
+
+
+    def add_source(self, method, *values):
+        if len(values) != len(self.label_names):
+            raise Exception("Metric %s needs labels %s!" % (self.name, self.label_names))
+
+        self.sources.append((weakref.WeakMethod(method), values))
+
+
+    def collect(self):
+        values_by_labels = {}
+        live_sources = []
+
+        for weak_method, values in self.sources:
+            method = weak_method()
+
+            if method:
+                live_sources.append((weak_method, values))
+                values_by_labels[values] = values_by_labels.get(values, 0) + method()
+
+        self.sources = live_sources
+
+        return values_by_labels
+
+
+class Registry:
+    def __init__(self):
+        self.metrics_by_name = {}
+
+
+    def add_metric(self, metric_class, name, help, label_names):
+        metric = self.metrics_by_name.get(name)
+
+        if metric:
+            if not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+                raise Exception("Metric %s already registered differently!" % name)
+        else:
+            metric = metric_class(name, help, label_names)
+            self.metrics_by_name[name] = metric
+
+        return metric
+
+
+    def counter(self, name, help, label_names=()):
+        return self.add_metric(CounterMetric, name, help, label_names)
+
+
+    def gauge(self, name, help, label_names=()):
+        return self.add_metric(GaugeMetric, name, help, label_names)
+
+
+    def expose(self):
+        lines = []
+
+        for name in sorted(self.metrics_by_name):
+            lines.extend(self.metrics_by_name[name].expose())
+
+        lines.append("")
+
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+
+class MetricsConnection(Loggable):
+    MAX_REQUEST_SIZE = 8192
+
+    def __init__(self, socket, registry):
+        Loggable.__init__(self)
+
+        self.socket = socket
+        self.registry = registry
+        self.incoming_buffer = b""
+        self.outgoing_buffer = b""
+        self.is_finished = False
+
+        self.read_plug = Plug(self.readable).attach_read(self.socket)
+        self.write_plug = Plug(self.writable)
+
+
+    def __del__(self):
+        self.read_plug.detach()
+        self.write_plug.detach()
+
+
+    def readable(self):
+        try:
+            recved = self.socket.recv(4096)
+        except socket.error as e:
+            if e.errno == errno.EAGAIN:
+                return
+
+            self.logger.warning("Socket error while receiving: %s" % e)
+            recved = None
+
+        if not recved:
+            self.finish()
+            return
+
+        self.incoming_buffer += recved
+
+        if b"\r\n\r\n" in self.incoming_buffer or b"\n\n" in self.incoming_buffer:
+            self.read_plug.detach()
+            self.respond()
+        elif len(self.incoming_buffer) > self.MAX_REQUEST_SIZE:
+            self.logger.warning("Request too long, dropping connection!")
+            self.finish()
+
+
+    def respond(self):
+        request_line = self.incoming_buffer.split(b"\n", 1)[0].decode("ascii", "replace").split()
+        method = request_line[0] if request_line else None
+
+        if method == "GET":
+            status = "200 OK"
+            body = self.registry.expose().encode("utf8")
+        else:
+            status = "405 Method Not Allowed"
+            body = b""
+
+        header = "HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body))
+        self.outgoing_buffer = header.encode("ascii") + body
+        self.writable()
+
+
+    def writable(self):
+        try:
+            sent = self.socket.send(self.outgoing_buffer)
+        except socket.error as e:
+            if e.errno != errno.EAGAIN:
+                self.logger.warning("Socket error while sending: %s" % e)
+                self.finish()
+                return
+
+            sent = 0
+
+        self.outgoing_buffer = self.outgoing_buffer[sent:]
+
+        if self.outgoing_buffer:
+            if not self.write_plug.weak_slot:
+                self.write_plug.attach_write(self.socket)
+        else:
+            self.finish()
+
+
+    def finish(self):
+        self.read_plug.detach()
+        self.write_plug.detach()
+
+        if not self.is_finished:
+            self.is_finished = True
+            self.socket.close()
+
+
+class MetricsServer(Loggable):
+    def __init__(self, addr, registry=registry):
+        Loggable.__init__(self)
+
+        self.registry = registry
+        self.listener = TcpListener(addr)
+        self.connections = set()
+
+        Plug(self.accepted).attach(self.listener.accepted_slot)
+
+
+    def set_oid(self, oid):
+        Loggable.set_oid(self, oid)
+
+        self.listener.set_oid(self.oid.add("listener"))
+
+
+    def accepted(self, socket, addr):
+        self.connections = { c for c in self.connections if not c.is_finished }
+
+        connection = MetricsConnection(socket, self.registry)
+        connection.set_oid(self.oid.add("connection", "%s:%s" % addr))
+        self.connections.add(connection)
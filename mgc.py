@@ -1,9 +1,11 @@
+import random
 from weakref import proxy, ref
 from collections import namedtuple
 
+from format import Addr
 from msgp import MsgpPeer
 from log import Loggable
-from zap import EventSlot, Plug
+from zap import EventSlot, Plug, schedule
 
 
 def label_from_oid(oid):
@@ -15,6 +17,9 @@ def label_from_oid(oid):
 MediaLeg = namedtuple("MediaLeg", [ "mgw_sid", "label", "li" ])
 
 
+class Error(Exception): pass
+
+
 class MediaThing(Loggable):
     def __init__(self, type):
         Loggable.__init__(self)
@@ -112,12 +117,13 @@ class PlayerMediaThing(MediaThing):
         MediaThing.__init__(self, "player")
         
 
-    def play(self, filename=None, format=None, volume=1, fade=0):  # TODO: rename to refresh?
+    def play(self, filename=None, format=None, volume=1, fade=0, loop=None):  # TODO: rename to refresh?
         params = dict(
             filename=filename,
             format=format,
             volume=volume,
-            fade=fade
+            fade=fade,
+            loop=loop
         )
         
         params = { k: v for k, v in params.items() if v is not None }
@@ -130,6 +136,8 @@ class RtpMediaThing(MediaThing):
         MediaThing.__init__(self, "rtp")
 
         self.event_slot = EventSlot()
+        self.quality_slot = EventSlot()
+        self.quality = None
 
     
     def process_request(self, target, params, source):
@@ -137,15 +145,94 @@ class RtpMediaThing(MediaThing):
             self.logger.debug("Yay, just detected a tone %s!" % (params,))
             self.send_response(source, "OK")
             self.event_slot.zap("tone", params)
+        elif target == "quality":
+            self.logger.debug("Media quality report: %s" % (params,))
+            self.quality = params
+            self.quality_slot.zap(params)
         else:
             MediaThing.process_request(self, target, params, source)
         
         
+class MediaAddressRange:
+    # The even ports of a range, with the free ones marked by set bits, so the
+    # lowest free one is found and taken with a few integer operations
+    def __init__(self, first_addr, count):
+        host, port = first_addr
+        
+        self.host = host
+        self.first_port = port + port % 2
+        self.count = count
+        self.free_bits = (1 << count) - 1
+        
+        
+    def allocate(self):
+        if not self.free_bits:
+            return None
+            
+        bit = self.free_bits & -self.free_bits
+        self.free_bits ^= bit
+        
+        return Addr(self.host, self.first_port + 2 * (bit.bit_length() - 1))
+        
+        
+    def deallocate(self, addr):
+        bit = 1 << (addr.port - self.first_port) // 2
+        
+        if self.free_bits & bit:
+            raise Error("Media address %s was not allocated!" % (addr,))
+            
+        self.free_bits |= bit
+
+
+class GatewayState:
+    def __init__(self, addr):
+        self.addr = addr
+        self.sid = None
+        self.is_up = False
+        self.is_draining = False
+        self.ranges = []
+        self.capacity = 0
+        self.allocated_count = 0
+        self.load = None
+        
+        
+    def set_load(self, load):
+        self.load = load
+        self.is_draining = load.get("draining", False)
+        
+        
+    def get_load(self):
+        # The busier of the address ranges and the reported CPU usage, from 0 to 1
+        allocated = self.allocated_count / self.capacity if self.capacity else 0
+        cpu = self.load["cpu"] / self.load["cores"] if self.load else 0
+        
+        return max(allocated, cpu)
+
+
+    def allocate(self):
+        for r in self.ranges:
+            addr = r.allocate()
+            
+            if addr:
+                self.allocated_count += 1
+                return addr, r
+                
+        return None, None
+        
+        
+    def deallocate(self, addr, r):
+        r.deallocate(addr)
+        self.allocated_count -= 1
+        
+
 class Controller(Loggable):
     def __init__(self):
         Loggable.__init__(self)
 
-        self.mgw_sid = None  # FIXME: Msgp can handle multiple connections already!
+        self.gateways_by_addr = {}
+        self.gateways_by_sid = {}
+        self.allocations_by_media_addr = {}  # (gateway, range)
+        self.queued_requests_by_sid = {}
         
         # Store weak references, and only remove the nullified ones
         # after getting a drop_response response from the MGW.
@@ -167,9 +254,21 @@ class Controller(Loggable):
         self.msgp.set_name(name)
 
 
-    def add_mgw_addr(self, addr):
+    def add_mgw_addr(self, addr, media_addr=None, media_count=0, local_path=None):
+        # Multiple ranges may be added for the same gateway. A co-located one
+        # may be connected through its Unix domain socket path instead.
         addr.assert_resolved()
-        self.msgp.add_remote_addr(addr)
+        gateway = self.gateways_by_addr.get(addr)
+        
+        if not gateway:
+            gateway = GatewayState(addr)
+            self.gateways_by_addr[addr] = gateway
+            self.msgp.add_remote_addr(addr, local_path)
+            
+        if media_count:
+            media_addr.assert_resolved()
+            gateway.ranges.append(MediaAddressRange(media_addr, media_count))
+            gateway.capacity += media_count
     
     
     def register_thing(self, label, thing):
@@ -182,7 +281,35 @@ class Controller(Loggable):
     def send_request(self, target, params, label=None, drop_response=False):
         # If we pass an origin, the MGW must respond, otherwise our side will time out!
         origin = (label, drop_response) if label else None
-        self.msgp.send_request(target, params, origin=origin)
+        self.queue_request(target, params, origin)
+        
+        
+    def queue_request(self, target, params, origin):
+        # The requests to a gateway in one loop iteration are sent as one batch
+        sid, ttag = target
+        self.queued_requests_by_sid.setdefault(sid, []).append((ttag, params, origin))
+        schedule(self.flush_requests)
+        
+        
+    def flush_requests(self):
+        queued_requests_by_sid = self.queued_requests_by_sid
+        self.queued_requests_by_sid = {}
+        
+        for sid, requests in queued_requests_by_sid.items():
+            if len(requests) == 1:
+                ttag, body, origin = requests[0]
+            else:
+                ttag = "batch"
+                body = dict(requests=[ (t, p) for t, p, o in requests ])
+                origin = [ o for t, p, o in requests ]
+                
+            try:
+                self.msgp.send_request((sid, ttag), body, origin=origin)
+            except Exception as e:
+                self.logger.error("Couldn't send request to MGW %s: %s" % (sid, e))
+                
+                if origin:
+                    self.process_response(origin, None, None)
 
 
     def send_response(self, target, params, label=None, drop_response=False):
@@ -192,6 +319,10 @@ class Controller(Loggable):
         
         
     def process_request(self, target, params, source):
+        if target == "load":
+            self.gateway_loaded(source[0], params)
+            return
+            
         label = params.pop('label', None)
         
         if not label:
@@ -212,6 +343,16 @@ class Controller(Loggable):
 
 
     def process_response(self, origin, params, source):
+        if isinstance(origin, list):
+            # A batch, with the responses in the same order, or None for errors
+            results = params if isinstance(params, list) else [ None ] * len(origin)
+            
+            for o, result in zip(origin, results):
+                if o:
+                    self.process_response(o, result, source)
+                    
+            return
+            
         label, drop_response = origin
 
         if not label:
@@ -237,27 +378,86 @@ class Controller(Loggable):
     def status_changed(self, sid, remote_addr):
         if remote_addr:
             self.logger.debug("MGW %s is reachable at %s" % (sid, remote_addr))
+            gateway = self.gateways_by_sid.get(sid) or self.gateways_by_addr.get(remote_addr)
+            
+            if not gateway:
+                self.logger.warning("MGW %s connected without configuration!" % sid)
+                gateway = GatewayState(remote_addr)
+                
+            if gateway.sid and gateway.sid != sid:
+                # Restarted with a new session, the old one is gone for good
+                self.logger.info("MGW %s restarted as %s." % (gateway.sid, sid))
+                self.gateways_by_sid.pop(gateway.sid, None)
+                
+            gateway.sid = sid
+            gateway.is_up = True
+            self.gateways_by_sid[sid] = gateway
         else:
             self.logger.error("MGW %s is unreachable!" % sid)
+            gateway = self.gateways_by_sid.get(sid)
             
-        self.mgw_sid = sid if remote_addr else None
+            # Keep it for the deallocations
+            if gateway:
+                gateway.is_up = False
 
 
+    def gateway_loaded(self, sid, load):
+        gateway = self.gateways_by_sid.get(sid)
+        
+        if not gateway:
+            self.logger.warning("Load report from unknown MGW %s!" % sid)
+            return
+            
+        if load.get("draining") and not gateway.is_draining:
+            self.logger.info("MGW %s started draining." % sid)
+            
+        gateway.set_load(load)
+        
+        
+    def count_gateways(self):
+        return sum(1 for gateway in self.gateways_by_sid.values() if gateway.is_up)
+        
+
     def select_gateway_sid(self, ctype, mgw_affinity):
-        if not self.mgw_sid:
-            raise Exception("Sorry, no mgw_sid yet!")
-        elif mgw_affinity and mgw_affinity != self.mgw_sid:
-            raise Exception("WAT, we don't know this MGW!")
+        # Calls stay on their gateway even while draining, unless it's gone
+        if mgw_affinity:
+            gateway = self.gateways_by_sid.get(mgw_affinity)
+            
+            if gateway and gateway.is_up:
+                return mgw_affinity
+                
+            self.logger.warning("MGW %s is not available, failing over!" % mgw_affinity)
+            
+        gateways = [ gateway for gateway in self.gateways_by_sid.values() if gateway.is_up and not gateway.is_draining ]
+        
+        if not gateways:
+            raise Exception("Sorry, no MGW is available!")
+            
+        # Weighted by the free capacity, so the calls between two load reports
+        # don't all go to the same least loaded one
+        weights = [ max(0, 1 - gateway.get_load()) for gateway in gateways ]
+        
+        if any(weights):
+            return random.choices(gateways, weights)[0].sid
         else:
-            return self.mgw_sid
+            return min(gateways, key=lambda gateway: gateway.get_load()).sid
     
 
     def allocate_media_address(self, mgw_sid):
-        raise NotImplementedError()
+        gateway = self.gateways_by_sid[mgw_sid]
+        addr, r = gateway.allocate()
+        
+        if not addr:
+            raise Error("Media addresses exhausted on MGW %s!" % mgw_sid)
+            
+        self.allocations_by_media_addr[addr] = (gateway, r)
+        
+        return addr
 
 
     def deallocate_media_address(self, addr):
-        raise NotImplementedError()
+        gateway, r = self.allocations_by_media_addr.pop(addr)
+        gateway.deallocate(addr, r)
 
     
     def make_media_thing(self, type):
@@ -287,7 +487,7 @@ class Controller(Loggable):
             
         target = (ml0.mgw_sid, "link_slots")
         params = dict(slots=[ (ml0.label, ml0.li), (ml1.label, ml1.li) ])
-        self.msgp.send_request(target, params, origin=(None, None))
+        self.queue_request(target, params, (None, None))
 
 
     def unlink_media_legs(self, ml0, ml1):
@@ -296,4 +496,4 @@ class Controller(Loggable):
             
         target = (ml0.mgw_sid, "unlink_slots")
         params = dict(slots=[ (ml0.label, ml0.li), (ml1.label, ml1.li) ])
-        self.msgp.send_request(target, params, origin=(None, None))
+        self.queue_request(target, params, (None, None))
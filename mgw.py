@@ -1,14 +1,151 @@
+import os
+import time
 import socket
-from weakref import proxy
+import contextlib
+import multiprocessing
+from weakref import proxy, WeakValueDictionary
 
-from rtp import read_wav, write_wav, RtpPlayer, RtpRecorder, RtpBuilder, RtpParser, DtmfExtractor, DtmfInjector, Format
+from rtp import map_wav, interleave_samples, transcode_payload, build_rtcp_sr, build_rtcp_rr, build_rtcp_sdes, parse_rtcp, get_ntp_time, get_ntp_middle, estimate_mos, WavWriter, Announcement, RtpPlayer, RtpRecorder, RtpBuilder, RtpParser, DtmfExtractor, DtmfInjector, Format, Packet
 from msgp import MsgpPeer
 from log import Loggable
-from zap import Plug
+from zap import Plug, loop, reset_after_fork
+from metrics import registry
+from relay import RelayWorker
+
+
+RTP_PACKETS = registry.counter("siplib_rtp_packets_total", "RTP packets processed by media gateways.", ("mgw", "direction"))
+RTP_BYTES = registry.counter("siplib_rtp_bytes_total", "RTP bytes processed by media gateways.", ("mgw", "direction"))
+MEDIA_THINGS_LIVE = registry.gauge("siplib_media_things_live", "Media things currently alive.", ("mgw",))
+ANNOUNCEMENTS_CACHED = registry.gauge("siplib_announcements_cached", "Announcement files currently cached.", ("mgw",))
+MEDIA_PORTS_FREE = registry.gauge("siplib_media_ports_free", "Pre-bound media socket pairs currently free.", ("mgw",))
+MEDIA_PORTS_EXHAUSTED = registry.counter("siplib_media_ports_exhausted_total", "Media addresses requested from the pool while not free.", ("mgw",))
+
 
 class Error(Exception): pass
 
 
+class AudioCache(Loggable):
+    # Players keep the announcements alive, so they are dropped when the last one
+    # finishes. A file modified on disk since its loading is read again.
+    def __init__(self):
+        Loggable.__init__(self)
+        
+        self.announcements_by_key = WeakValueDictionary()
+        
+        
+    def get_announcement(self, filename):
+        key = (filename, os.stat(filename).st_mtime_ns)
+        announcement = self.announcements_by_key.get(key)
+        
+        if announcement is None:
+            self.logger.debug("Loading announcement %s." % filename)
+            announcement = Announcement(map_wav(filename))
+            announcement.set_oid(self.oid.add("file", filename))
+            self.announcements_by_key[key] = announcement
+            
+        return announcement
+        
+    
+    def count_announcements(self):
+        return len(self.announcements_by_key)
+
+
+def bind_socket_pair(addr):
+    # RTCP always goes on the next port
+    host, port = addr
+    rtp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtp_socket.setblocking(False)
+    rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtcp_socket.setblocking(False)
+    
+    try:
+        rtp_socket.bind((host, port))
+        rtcp_socket.bind((host, port + 1))
+    except OSError:
+        rtp_socket.close()
+        rtcp_socket.close()
+        raise
+        
+    return rtp_socket, rtcp_socket
+
+
+def drain_socket(sock):
+    # Leftover packets of the previous user of a pooled socket
+    for i in range(1000):
+        try:
+            sock.recv(65535)
+        except OSError:
+            break
+
+
+class PortPool(Loggable):
+    # RTP and RTCP socket pairs bound in advance on even and odd ports, so that
+    # setting up a call needs no system calls. The MGC still chooses the addresses,
+    # and the ones outside of the pool are bound on demand, as before.
+    def __init__(self):
+        Loggable.__init__(self)
+        
+        self.pairs_by_addr = {}
+        self.free_addrs = set()
+        self.exhausted_counter = None
+        
+        
+    def set_exhausted_counter(self, counter):
+        self.exhausted_counter = counter
+        
+        
+    def open(self, first_addr, count):
+        first_addr.assert_resolved()
+        host, port = first_addr
+        port += port % 2
+        
+        for i in range(count):
+            addr = (host, port + 2 * i)
+            
+            try:
+                self.pairs_by_addr[addr] = bind_socket_pair(addr)
+            except OSError as e:
+                self.logger.warning("Couldn't bind media port %s:%d: %s" % (host, addr[1], e))
+            else:
+                self.free_addrs.add(addr)
+                
+        self.logger.info("Media port pool has %d free socket pairs." % len(self.free_addrs))
+        
+        
+    def count_free(self):
+        return len(self.free_addrs)
+        
+        
+    def count_taken(self):
+        return len(self.pairs_by_addr) - len(self.free_addrs)
+        
+        
+    def is_pooled(self, addr):
+        return addr in self.pairs_by_addr
+        
+        
+    def take(self, addr):
+        if addr not in self.free_addrs:
+            if self.exhausted_counter:
+                self.exhausted_counter.value += 1
+                
+            if self.free_addrs:
+                raise Error("Media port %s:%d is already in use!" % addr)
+            else:
+                raise Error("Media port pool exhausted!")
+                
+        self.free_addrs.remove(addr)
+        
+        return self.pairs_by_addr[addr]
+        
+        
+    def give(self, addr):
+        for sock in self.pairs_by_addr[addr]:
+            drain_socket(sock)
+            
+        self.free_addrs.add(addr)
+
+
 class Thing(Loggable):
     def __init__(self, label, owner_sid, type):
         Loggable.__init__(self)
@@ -45,12 +182,14 @@ class Thing(Loggable):
         
     
 class RecordThing(Thing):
+    MAX_LAG = 50  # frames a channel may get ahead of the other before padding it
+    
     def __init__(self, label, owner_sid):
         Thing.__init__(self, label, owner_sid, "record")
         
         self.filename = None
         self.is_recording = False
-        self.has_recorded = False
+        self.wav_writer = None
         self.format = None
         self.fore_recorder = None
         self.back_recorder = None
@@ -64,11 +203,31 @@ class RecordThing(Thing):
         Thing.__del__(self)
 
 
+    def write_recorded(self, is_final):
+        fore = self.fore_recorder
+        back = self.back_recorder
+        
+        if is_final:
+            fore.finish()
+            back.finish()
+            
+        # A silent channel is padded, so the other one doesn't pile up
+        length = max(fore.get_length(), back.get_length())
+        lag = 0 if is_final else self.MAX_LAG
+        fore.complete(length - lag)
+        back.complete(length - lag)
+        
+        count = min(len(fore.chunks), len(back.chunks))
+        
+        if count:
+            self.wav_writer.write(interleave_samples(fore.take(count), back.take(count)))
+
+
     def flush(self):
-        if self.has_recorded:
-            samples_fore = self.fore_recorder.get()
-            samples_back = self.back_recorder.get()
-            write_wav(self.filename, samples_fore, samples_back)
+        if self.wav_writer:
+            self.write_recorded(True)
+            self.wav_writer.close()
+            self.wav_writer = None
 
 
     def modify(self, params):
@@ -87,12 +246,13 @@ class RecordThing(Thing):
             self.back_recorder.set_oid(self.oid.add("back"))
             
             self.is_recording = False
-            self.has_recorded = False
 
         if "record" in params:
             if self.filename:
                 self.is_recording = params["record"]
-                self.has_recorded = self.has_recorded or self.is_recording
+                
+                if self.is_recording and not self.wav_writer:
+                    self.wav_writer = WavWriter(self.filename, channels=2, rate=self.format.clock)
             else:
                 self.logger.error("Can't save recording without a filename!")
 
@@ -104,6 +264,8 @@ class RecordThing(Thing):
             else:
                 self.back_recorder.record_packet(packet)
                 
+            self.write_recorded(False)
+                
         lj = 1 - li
         self.forward(lj, packet)
         
@@ -120,8 +282,16 @@ class RtpThing(Thing):
         self.dtmf_extractor = DtmfExtractor()
         self.dtmf_detected_plug = Plug(self.dtmf_detected).attach(self.dtmf_extractor.dtmf_detected_slot)
         self.dtmf_injector = DtmfInjector()
+        self.transcoded_formats = {}
         self.recved_plug = Plug(self.recved)
         
+        self.rtcp_socket = None
+        self.rtcp_interval = 5
+        self.rtcp_recved_plug = Plug(self.rtcp_recved)
+        self.rtcp_timer_plug = Plug(self.rtcp_timer)
+        self.remote_report = None
+        self.fraction_lost = 0
+        
         
     def __del__(self):
         # TODO: it seems like sometimes the plug does not get uplugged, while the
@@ -129,6 +299,12 @@ class RtpThing(Thing):
         # this descriptor, and has to purge it from the poll set. So do this explicitly.
         
         self.recved_plug.detach()
+        self.rtcp_recved_plug.detach()
+        self.rtcp_timer_plug.detach()
+        
+        statistics = self.rtp_parser.get_statistics()
+        if statistics:
+            self.logger.info("Received RTP statistics: %s" % statistics)
             
         
     def set_oid(self, oid):
@@ -148,20 +324,36 @@ class RtpThing(Thing):
             for format in payload_types_by_format:
                 if format.encoding == "telephone-event":
                     self.dtmf_injector.set_format(format)
+                    
+            self.transcoded_formats = self.find_transcoded_formats(payload_types_by_format)
             
         if "recv_formats" in params:
             formats_by_payload_type = { int(k): Format(*v) for k, v in params["recv_formats"].items() }
             self.rtp_parser.set_formats_by_payload_type(formats_by_payload_type)
+            
+        if "jitter_depth" in params:
+            min_depth, max_depth = params["jitter_depth"]
+            self.rtp_parser.jitter_buffer.set_depth(min_depth, max_depth)
 
+        if "rtcp_interval" in params:
+            self.rtcp_interval = params["rtcp_interval"]
+            self.rtcp_timer_plug.detach()
+            
+            if self.rtcp_socket and self.rtcp_interval:
+                self.rtcp_timer_plug.attach_time(self.rtcp_interval, repeat=True)
+            
         if "local_addr" in params:
             try:
-                self.recved_plug.detach()
+                self.release_sockets()
+                self.rtcp_timer_plug.detach()
                     
                 self.local_addr = tuple(params["local_addr"])
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.socket.setblocking(False)
-                self.socket.bind(self.local_addr)
-                self.recved_plug.attach_read(self.socket)
+                self.socket, self.rtcp_socket = self.mgw.take_sockets(self.local_addr)
+                self.mgw.watch_rtp(self)
+                self.rtcp_recved_plug.attach_read(self.rtcp_socket)
+                
+                if self.rtcp_interval:
+                    self.rtcp_timer_plug.attach_time(self.rtcp_interval, repeat=True)
             except Exception as e:
                 raise Error("Couldn't set up net leg: %s" % e)
             
@@ -169,10 +361,68 @@ class RtpThing(Thing):
             self.remote_addr = tuple(params["remote_addr"])
             
     
+    def release_sockets(self):
+        if not self.socket:
+            return
+            
+        self.mgw.unwatch_rtp(self)
+        self.rtcp_recved_plug.detach()
+        self.mgw.release_sockets(self.local_addr, self.socket, self.rtcp_socket)
+        self.socket = None
+        self.rtcp_socket = None
+        
+        
+    def find_transcoded_formats(self, send_formats):
+        # If only one G.711 law was negotiated here, packets of the other law
+        # coming from the linked thing are converted instead of being dropped.
+        other_encodings = { "PCMA": "PCMU", "PCMU": "PCMA" }
+        transcoded_formats = {}
+        
+        for format in send_formats:
+            other_encoding = other_encodings.get(format.encoding)
+            
+            if other_encoding:
+                other_format = format._replace(encoding=other_encoding)
+                
+                if other_format not in send_formats:
+                    transcoded_formats[other_format] = format
+                    
+        return transcoded_formats
+        
+        
+    def can_relay(self):
+        # Not while a tone is being injected into our stream
+        injector = self.dtmf_injector
+        
+        return not injector.dtmf_name and not injector.dtmf_start_ms and self.remote_addr and self.remote_addr[1]
+        
+        
+    def get_relay_target(self):
+        thing = self.mgw.get_linked_thing(self.label, 0)
+        
+        return thing if isinstance(thing, RtpThing) and thing.can_relay() else None
+        
+        
+    def relay_to(self, thing, udp):
+        # Rewrites the packet for the linked RtpThing, if nothing else needs to see it.
+        # Returns None for the full path, otherwise whether it should be sent.
+        relayed = self.rtp_parser.relay(udp, thing.rtp_builder.payload_types_by_format)
+        if not relayed:
+            return None
+            
+        format, timestamp = relayed
+        
+        return thing.rtp_builder.rewrite(udp, format, timestamp)
+        
+        
     def recved(self):
         #print("Receiving on %s" % self.name)
         udp, addr = self.socket.recvfrom(65535)
-        udp = bytearray(udp)
+        self.recved_udp(bytearray(udp), addr)
+        
+        
+    def recved_udp(self, udp, addr):
+        self.mgw.count_received(len(udp))
         
         if self.remote_addr:
             remote_host, remote_port = self.remote_addr
@@ -188,14 +438,120 @@ class RtpThing(Thing):
             self.report("detected", { 'id': self.label, 'remote_addr': addr })
             self.remote_addr = addr
             
-        packet = self.rtp_parser.parse(udp)
+        thing = self.get_relay_target()
+        
+        if thing:
+            is_relayed = self.relay_to(thing, udp)
+            
+            if is_relayed is not None:
+                if is_relayed:
+                    thing.socket.sendto(udp, thing.remote_addr)
+                    thing.mgw.count_sent(len(udp))
+                    
+                return
+            
+        packets = self.rtp_parser.parse(udp)
 
-        if packet is None:
+        if packets is None:
             self.logger.debug("Ignoring received unknown payload type!")
-        elif not self.dtmf_extractor.process(packet):
-            self.forward(0, packet)
+            return
+            
+        for packet in packets:
+            if not self.dtmf_extractor.process(packet):
+                self.forward(0, packet)
     
     
+    def rtcp_timer(self):
+        if not self.remote_addr or not self.remote_addr[1]:
+            return
+            
+        # The relay worker updates the counters from its own thread
+        with self.mgw.lock_things():
+            ntp = get_ntp_time()
+            report_block = self.rtp_parser.make_report_block()
+            report_blocks = [ report_block ] if report_block else []
+            sender_info = self.rtp_builder.get_sender_info(ntp)
+            
+            if report_block:
+                self.fraction_lost = report_block.fraction_lost
+                
+            quality = self.get_quality()
+        
+        if sender_info:
+            rtcp = build_rtcp_sr(self.rtp_builder.ssrc, sender_info, report_blocks)
+        else:
+            rtcp = build_rtcp_rr(self.rtp_builder.ssrc, report_blocks)
+            
+        rtcp += build_rtcp_sdes(self.rtp_builder.ssrc, "siplib@%s" % self.local_addr[0])
+        
+        remote_host, remote_port = self.remote_addr
+        self.rtcp_socket.sendto(rtcp, (remote_host, remote_port + 1))
+        
+        if quality:
+            self.report("quality", quality)
+            
+            
+    def rtcp_recved(self):
+        rtcp, addr = self.rtcp_socket.recvfrom(65535)
+        
+        try:
+            reports = parse_rtcp(rtcp)
+        except Exception as e:
+            self.logger.debug("Ignoring invalid RTCP packet: %s" % e)
+            return
+            
+        for ssrc, sender_info, report_blocks in reports:
+            if sender_info:
+                with self.mgw.lock_things():
+                    self.rtp_parser.record_sender_report(ssrc, sender_info)
+                
+            for rb in report_blocks:
+                if rb.ssrc != self.rtp_builder.ssrc:
+                    continue
+                    
+                # The round trip time is only known if they got our report already
+                rtt_ms = None
+                
+                if rb.lsr:
+                    rtt = (get_ntp_middle(get_ntp_time()) - rb.lsr - rb.dlsr) & 0xffffffff
+                    rtt_ms = rtt * 1000 / 65536 if rtt < 0x80000000 else None
+                    
+                clock = self.rtp_builder.last_clock
+                
+                self.remote_report = dict(
+                    fraction_lost=rb.fraction_lost * 100 / 256,
+                    cumulative_lost=rb.cumulative_lost,
+                    jitter_ms=rb.jitter * 1000 / clock if clock else None,
+                    rtt_ms=rtt_ms
+                )
+                
+                
+    def get_quality(self):
+        statistics = self.rtp_parser.get_statistics()
+        
+        if not statistics and not self.remote_report:
+            return None
+            
+        quality = dict(sent=self.rtp_builder.packet_count)
+        
+        if statistics:
+            rtt_ms = self.remote_report and self.remote_report["rtt_ms"] or 0
+            loss_percent = self.fraction_lost * 100 / 256
+            
+            quality.update(
+                received=statistics["received"],
+                lost=statistics["lost"],
+                jitter_ms=statistics["jitter_ms"],
+                loss_percent=loss_percent,
+                mos=round(estimate_mos(rtt_ms / 2, statistics["jitter_ms"], loss_percent), 2)
+            )
+            
+        if self.remote_report:
+            quality.update(remote=self.remote_report)
+            
+        return quality
+        
+        
     def dtmf_detected(self, name):
         self.report("tone", dict(name=name), origin="FIXME")
         
@@ -206,9 +562,18 @@ class RtpThing(Thing):
         
         
     def process(self, li, packet):
-        for p in self.dtmf_injector.process(packet):
-            udp = self.rtp_builder.build(p)
+        format = self.transcoded_formats.get(packet.format)
         
+        if format:
+            payload = transcode_payload(packet.format.encoding, format.encoding, packet.payload)
+            packet = Packet(format, packet.timestamp, packet.marker, payload)
+            
+        # The relay worker also uses the builder and checks the injector
+        with self.mgw.lock_things():
+            packets = list(self.dtmf_injector.process(packet))
+            udps = [ self.rtp_builder.build(p) for p in packets ]
+            
+        for p, udp in zip(packets, udps):
             if udp is None:
                 self.logger.debug("Ignoring sent unknown payload format %s" % (p.format,))
                 return
@@ -217,8 +582,8 @@ class RtpThing(Thing):
                 return
             
             #self.logger.info("Sending RTP packet to %s" % (self.remote_addr,))
-            # packet should be a bytearray here
             self.socket.sendto(udp, self.remote_addr)
+            self.mgw.count_sent(len(udp))
 
 
     def notify(self, type, params):
@@ -254,6 +619,7 @@ class PlayerThing(Thing):
         self.format = None
         self.volume = 1
         self.filename = None
+        self.is_looping = False
 
 
     def modify(self, params):
@@ -274,12 +640,18 @@ class PlayerThing(Thing):
 
         if "format" in params:
             self.format = Format(*params["format"])
+            
+        if "loop" in params:
+            self.is_looping = params["loop"]
+            
+            if self.rtp_player:
+                self.rtp_player.is_looping = self.is_looping
                 
         if "filename" in params:
             self.filename = params["filename"]
-            samples = read_wav(params["filename"])
+            announcement = self.mgw.audio_cache.get_announcement(self.filename)
             
-            self.rtp_player = RtpPlayer(self.format, samples, self.volume, fade)
+            self.rtp_player = RtpPlayer(self.format, announcement.samples, self.volume, fade, announcement=announcement, is_looping=self.is_looping)
             Plug(self.forward_packet).attach(self.rtp_player.packet_slot)
 
 
@@ -293,31 +665,199 @@ class PlayerThing(Thing):
 
 
 class MediaGateway(Loggable):
+    LOAD_INTERVAL = 5
+    
     def __init__(self, mgw_addr):
         Loggable.__init__(self)
-        mgw_addr.assert_resolved()
 
         self.things_by_label = {}
         self.links = {}
+        self.audio_cache = AudioCache()
+        self.port_pool = None
+        self.relay_worker = None
         
-        self.msgp = MsgpPeer(mgw_addr)
-        Plug(self.process_request).attach(self.msgp.request_slot)
-        Plug(self.process_response).attach(self.msgp.response_slot)
+        self.is_draining = False
+        self.mgc_sids = set()
+        self.last_load_sample = (time.time(), time.process_time(), 0)
+        self.load_plug = Plug(self.report_load).attach_time(self.LOAD_INTERVAL, repeat=True)
+        
+        self.received_packets_counter = None
+        self.received_bytes_counter = None
+        self.sent_packets_counter = None
+        self.sent_bytes_counter = None
+        self.relayed_packets_counter = None
+        self.relayed_bytes_counter = None
+        
+        if mgw_addr:
+            mgw_addr.assert_resolved()
+            self.msgp = MsgpPeer(mgw_addr)
+            Plug(self.process_request).attach(self.msgp.request_slot)
+            Plug(self.process_response).attach(self.msgp.response_slot)
+            Plug(self.status_changed).attach(self.msgp.status_slot)
+        else:
+            self.msgp = None  # the messages are passed by a supervisor
 
 
     def set_oid(self, oid):
         Loggable.set_oid(self, oid)
-        self.msgp.set_oid(oid.add("msgp"))
+        
+        if self.msgp:
+            self.msgp.set_oid(oid.add("msgp"))
+            
+        self.audio_cache.set_oid(oid.add("audio"))
+        
+        self.received_packets_counter = RTP_PACKETS.labels(oid, "received")
+        self.received_bytes_counter = RTP_BYTES.labels(oid, "received")
+        self.sent_packets_counter = RTP_PACKETS.labels(oid, "sent")
+        self.sent_bytes_counter = RTP_BYTES.labels(oid, "sent")
+        MEDIA_THINGS_LIVE.add_source(self.count_things, oid)
+        self.relayed_packets_counter = RTP_PACKETS.labels(oid, "relayed")
+        self.relayed_bytes_counter = RTP_BYTES.labels(oid, "relayed")
+        ANNOUNCEMENTS_CACHED.add_source(self.audio_cache.count_announcements, oid)
+
+
+    def count_things(self):
+        return len(self.things_by_label)
+
+
+    def count_received(self, size):
+        self.received_packets_counter.value += 1
+        self.received_bytes_counter.value += size
+
+
+    def count_sent(self, size):
+        self.sent_packets_counter.value += 1
+        self.sent_bytes_counter.value += size
         
 
     def set_name(self, name):
-        self.msgp.set_name(name)
+        if self.msgp:
+            self.msgp.set_name(name)
+        
+        
+    def add_local_path(self, local_path):
+        # For MGCs on the same host, see Controller.add_mgw_addr
+        self.msgp.add_local_path(local_path)
+        
+        
+    def status_changed(self, sid, remote_addr):
+        if remote_addr:
+            self.mgc_sids.add(sid)
+        else:
+            self.mgc_sids.discard(sid)
+            
+            
+    def count_packets(self):
+        counters = (self.received_packets_counter, self.sent_packets_counter, self.relayed_packets_counter)
+        
+        return sum(counter.value for counter in counters if counter)
+        
+        
+    def get_load(self):
+        # The rates are averaged since the previous call
+        sample = (time.time(), time.process_time(), self.count_packets())
+        last_time, last_cpu_time, last_packets = self.last_load_sample
+        self.last_load_sample = sample
+        elapsed = sample[0] - last_time
+        
+        return dict(
+            things=len(self.things_by_label),
+            packets_per_sec=(sample[2] - last_packets) / elapsed if elapsed > 0 else 0,
+            cpu=(sample[1] - last_cpu_time) / elapsed if elapsed > 0 else 0,
+            cores=1,
+            draining=self.is_draining
+        )
+        
+        
+    def report_load(self):
+        self.send_load(self.get_load())
+        
+        
+    def send_load(self, load):
+        for sid in self.mgc_sids:
+            self.msgp.send_request((sid, "load"), load)
+            
+            
+    def set_draining(self, is_draining):
+        # The MGC-s place no new calls here, but the existing ones continue
+        self.logger.info("%s draining." % ("Started" if is_draining else "Stopped"))
+        self.is_draining = is_draining
+        self.report_load()
+        
+        
+    def open_port_pool(self, first_addr, count):
+        # May be called for multiple ranges
+        if not self.port_pool:
+            port_pool = PortPool()
+            port_pool.set_oid(self.oid.add("ports"))
+            self.set_port_pool(port_pool)
+            
+        self.port_pool.open(first_addr, count)
+        
+        
+    def set_port_pool(self, port_pool):
+        self.port_pool = port_pool
+        self.port_pool.set_exhausted_counter(MEDIA_PORTS_EXHAUSTED.labels(self.oid))
+        MEDIA_PORTS_FREE.add_source(self.port_pool.count_free, self.oid)
+        
+        
+    def take_sockets(self, addr):
+        if self.port_pool and self.port_pool.is_pooled(addr):
+            return self.port_pool.take(addr)
+        else:
+            return bind_socket_pair(addr)
+            
+            
+    def release_sockets(self, addr, rtp_socket, rtcp_socket):
+        if self.port_pool and self.port_pool.is_pooled(addr):
+            self.port_pool.give(addr)
+        else:
+            rtp_socket.close()
+            rtcp_socket.close()
+            
+            
+    def start_relay_worker(self, use_mmsg=True):
+        # Must be done before creating things
+        self.relay_worker = RelayWorker(use_mmsg)
+        self.relay_worker.set_oid(self.oid.add("relay"))
+        self.relay_worker.set_counters(self.relayed_packets_counter, self.relayed_bytes_counter)
+        self.relay_worker.start()
+        
+        
+    def stop_relay_worker(self):
+        if self.relay_worker:
+            self.relay_worker.stop()
+            self.relay_worker = None
+            
+            
+    def watch_rtp(self, thing):
+        if self.relay_worker:
+            self.relay_worker.add_thing(thing)
+        else:
+            thing.recved_plug.attach_read(thing.socket)
+            
+            
+    def unwatch_rtp(self, thing):
+        if self.relay_worker:
+            self.relay_worker.remove_thing(thing)
+        else:
+            thing.recved_plug.detach()
         
         
     def send_request(self, target, params, origin=None):
         self.msgp.send_request(target, params, origin=origin)
         
         
+    def send_response(self, source, body):
+        self.msgp.send_response(source, body)
+        
+        
+    def get_linked_thing(self, label, li):
+        that = self.links.get((label, li))
+        
+        return self.things_by_label[that[0]] if that else None
+        
+        
     def forward(self, label, li, packet):
         this = (label, li)
         that = self.links.get(this)
@@ -357,8 +897,11 @@ class MediaGateway(Loggable):
         
         
     def delete_thing(self, label):
-        self.things_by_label.pop(label)
+        thing = self.things_by_label.pop(label)
         self.logger.info("Deleted thing %s" % label)
+        
+        if isinstance(thing, RtpThing):
+            thing.release_sockets()
 
 
     def take_thing(self, label, owner_sid):
@@ -391,7 +934,23 @@ class MediaGateway(Loggable):
         self.links.pop(that)
         
         
+    def lock_things(self):
+        # The relay worker must not process packets while things change
+        return self.relay_worker.lock if self.relay_worker else contextlib.nullcontext()
+        
+        
     def process_request(self, target, params, source):
+        with self.lock_things():
+            if target == "batch":
+                # Processed in order, and answered together
+                body = [ self.process_locked_request(t, p, source) for t, p in params["requests"] ]
+            else:
+                body = self.process_locked_request(target, params, source)
+                
+        self.send_response(source, body)
+            
+            
+    def process_locked_request(self, target, params, source):
         try:
             owner_sid, seq = source
             
@@ -421,13 +980,444 @@ class MediaGateway(Loggable):
                 raise Error("Invalid target %s!" % target)
         except Exception as e:
             self.logger.error("Processing error: %s" % e, exc_info=True)
-            self.msgp.send_response(source, "error")
+            return "error"
         else:
-            self.msgp.send_response(source, "ok")
-            
             if not self.things_by_label:
                 self.logger.info("Back to clean state.")
+                
+            return "ok"
 
 
     def process_response(self, origin, params, source):
         self.logger.debug("Got response for %s: %s" % (origin, params))
+
+
+# A media gateway can be split into worker processes, each running its own zap
+# loop, so that the media processing may use more cores. The supervisor owns the
+# msgp connections, so the MGC sees a single sid, and passes the requests to the
+# workers through pipes. Things are placed by their context, which is the switch
+# and call part of their labels, and all things of a context are put on the same
+# worker, because only those can be linked together.
+
+class MediaGatewayWorker(MediaGateway):
+    def __init__(self, pipe):
+        MediaGateway.__init__(self, None)
+        
+        self.pipe = pipe
+        self.pipe_plug = Plug(self.piped).attach_read(pipe)
+        self.is_finished = False
+        
+        
+    def send_request(self, target, params, origin=None):
+        self.pipe.send(("request", target, params, origin))
+        
+        
+    def send_response(self, source, body):
+        self.pipe.send(("response", source, body))
+        
+        
+    def send_load(self, load):
+        # The supervisor exports the metrics of all workers, the counters as totals
+        ports_taken = self.port_pool.count_taken() if self.port_pool else 0
+        rtp_counts = {
+            "received": (self.received_packets_counter.value, self.received_bytes_counter.value),
+            "sent": (self.sent_packets_counter.value, self.sent_bytes_counter.value),
+            "relayed": (self.relayed_packets_counter.value, self.relayed_bytes_counter.value)
+        }
+        ports_exhausted = MEDIA_PORTS_EXHAUSTED.labels(self.oid).value
+        
+        self.pipe.send(("load", dict(load, ports_taken=ports_taken, rtp_counts=rtp_counts, ports_exhausted=ports_exhausted)))
+        
+        
+    def set_port_pool(self, port_pool):
+        # Every worker has a copy of the whole pool, so a gauge here would count
+        # the ports taken by the other workers as free
+        self.port_pool = port_pool
+        self.port_pool.set_exhausted_counter(MEDIA_PORTS_EXHAUSTED.labels(self.oid))
+        
+        
+    def piped(self):
+        try:
+            while self.pipe.poll():
+                message = self.pipe.recv()
+                
+                if message[0] == "request":
+                    self.process_request(*message[1:])
+                elif message[0] == "response":
+                    self.process_response(*message[1:])
+                elif message[0] == "stop":
+                    self.finish()
+                    break
+        except EOFError:
+            self.logger.warning("Supervisor is gone!")
+            self.finish()
+            
+            
+    def finish(self):
+        self.pipe_plug.detach()
+        self.load_plug.detach()
+        self.stop_relay_worker()
+        self.is_finished = True
+
+
+def run_worker(pipe, oid, port_pool, use_relay, use_mmsg):
+    # Started in a forked process, so forget what the parent was waiting for
+    reset_after_fork()
+    
+    worker = MediaGatewayWorker(pipe)
+    worker.set_oid(oid)
+    
+    if port_pool:
+        # Inherited whole, but the MGC never gives the same address to two contexts
+        worker.set_port_pool(port_pool)
+    
+    if use_relay:
+        worker.start_relay_worker(use_mmsg)
+    
+    try:
+        loop(until=lambda: worker.is_finished)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del worker
+
+
+class SupervisedBatch:
+    def __init__(self, source, requests, is_batch):
+        self.source = source
+        self.requests = requests
+        self.is_batch = is_batch
+        self.results = [ "error" ] * len(requests)
+        self.part_count = 0
+
+
+class MediaGatewaySupervisor(Loggable):
+    def __init__(self, mgw_addr, worker_count=None):
+        Loggable.__init__(self)
+        mgw_addr.assert_resolved()
+        
+        self.worker_count = worker_count or os.cpu_count() or 1
+        self.pipes = []
+        self.pipe_plugs = []
+        self.processes = []
+        self.thing_counts = []
+        self.loads = []
+        self.dead_workers = set()
+        self.port_pool = None
+        
+        self.is_draining = False
+        self.mgc_sids = set()
+        self.load_plug = Plug(self.report_load).attach_time(MediaGateway.LOAD_INTERVAL, repeat=True)
+        
+        self.worker_by_context = {}
+        self.worker_by_label = {}
+        self.labels_by_context = {}
+        self.batch_parts_by_source = {}
+        
+        self.msgp = MsgpPeer(mgw_addr)
+        Plug(self.process_request).attach(self.msgp.request_slot)
+        Plug(self.process_response).attach(self.msgp.response_slot)
+        Plug(self.status_changed).attach(self.msgp.status_slot)
+        
+        
+    def set_oid(self, oid):
+        Loggable.set_oid(self, oid)
+        self.msgp.set_oid(oid.add("msgp"))
+        MEDIA_THINGS_LIVE.add_source(self.count_things, oid)
+        
+        
+    def set_name(self, name):
+        self.msgp.set_name(name)
+        
+        
+    def add_local_path(self, local_path):
+        self.msgp.add_local_path(local_path)
+        
+        
+    def count_things(self):
+        return len(self.worker_by_label)
+        
+        
+    def count_free_ports(self):
+        # The workers report their taken ports with the load, so this lags as much
+        loads = [ load for load in self.loads if load ]
+        
+        return self.port_pool.count_free() - sum(load.get("ports_taken", 0) for load in loads)
+        
+        
+    def status_changed(self, sid, remote_addr):
+        if remote_addr:
+            self.mgc_sids.add(sid)
+        else:
+            self.mgc_sids.discard(sid)
+            
+            
+    def report_load(self):
+        # The workers report on the same schedule, so these are at most one interval old
+        loads = [ load for load in self.loads if load ]
+        load = dict(
+            things=self.count_things(),
+            packets_per_sec=sum(load["packets_per_sec"] for load in loads),
+            cpu=sum(load["cpu"] for load in loads),
+            cores=self.worker_count,
+            draining=self.is_draining
+        )
+        
+        for sid in self.mgc_sids:
+            self.msgp.send_request((sid, "load"), load)
+            
+            
+    def set_draining(self, is_draining):
+        self.logger.info("%s draining." % ("Started" if is_draining else "Stopped"))
+        self.is_draining = is_draining
+        self.report_load()
+        
+        
+    def open_port_pool(self, first_addr, count):
+        # Must be done before starting, the workers inherit the sockets
+        if not self.port_pool:
+            self.port_pool = PortPool()
+            self.port_pool.set_oid(self.oid.add("ports"))
+            MEDIA_PORTS_FREE.add_source(self.count_free_ports, self.oid)
+            
+        self.port_pool.open(first_addr, count)
+        
+        
+    def start(self, use_relay=False, use_mmsg=True):
+        # Fork early, so the workers inherit as little as possible, and reset their
+        # zap state, which only works with the fork start method
+        self.logger.info("Starting %d workers." % self.worker_count)
+        
+        for index in range(self.worker_count):
+            parent_pipe, child_pipe = multiprocessing.Pipe()
+            oid = self.oid.add("worker", str(index))
+            process = multiprocessing.get_context("fork").Process(target=run_worker, args=(child_pipe, oid, self.port_pool, use_relay, use_mmsg), daemon=True)
+            process.start()
+            child_pipe.close()
+            
+            self.pipes.append(parent_pipe)
+            self.pipe_plugs.append(Plug(self.piped, index=index).attach_read(parent_pipe))
+            self.processes.append(process)
+            self.thing_counts.append(0)
+            self.loads.append(None)
+            
+            
+    def stop(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send(("stop",))
+            except OSError:
+                pass
+                
+        for process in self.processes:
+            process.join()
+            
+        for plug in self.pipe_plugs:
+            plug.detach()
+            
+        self.pipes = []
+        self.pipe_plugs = []
+        self.processes = []
+        self.loads = []
+        
+        
+    def add_worker_counts(self, last_load, load):
+        # Only the increments since the last load, so the counters never go back
+        # when a worker dies
+        last_rtp_counts = last_load["rtp_counts"] if last_load else {}
+        
+        for direction, (packets, bytes) in load["rtp_counts"].items():
+            last_packets, last_bytes = last_rtp_counts.get(direction, (0, 0))
+            RTP_PACKETS.labels(self.oid, direction).value += packets - last_packets
+            RTP_BYTES.labels(self.oid, direction).value += bytes - last_bytes
+            
+        last_exhausted = last_load["ports_exhausted"] if last_load else 0
+        MEDIA_PORTS_EXHAUSTED.labels(self.oid).value += load["ports_exhausted"] - last_exhausted
+        
+        
+    def send_to_worker(self, index, message):
+        try:
+            self.pipes[index].send(message)
+        except OSError as e:
+            self.logger.error("Couldn't send to worker %d: %s" % (index, e))
+            self.worker_gone(index)
+            
+            
+    def worker_gone(self, index):
+        # Its things are lost, so the requests for them fail from now on
+        if index in self.dead_workers:
+            return
+            
+        self.logger.error("Worker %d is gone!" % index)
+        self.dead_workers.add(index)
+        self.pipe_plugs[index].detach()
+        self.loads[index] = None
+        
+        for part_source, (batch, positions) in list(self.batch_parts_by_source.items()):
+            if part_source[1][1] == index:
+                self.batch_part_finished(part_source, [ "error" ] * len(positions))
+                
+                
+    def get_context(self, label):
+        return "/".join(label.split("/")[:2])
+        
+        
+    def place_thing(self, label):
+        if label in self.worker_by_label:
+            raise Error("Duplicate thing %s!" % label)
+            
+        context = self.get_context(label)
+        index = self.worker_by_context.get(context)
+        
+        if index is None:
+            live_indexes = [ i for i in range(self.worker_count) if i not in self.dead_workers ]
+            
+            if not live_indexes:
+                raise Error("No workers left!")
+                
+            index = min(live_indexes, key=lambda i: self.thing_counts[i])
+            self.logger.debug("Placing context %s on worker %d." % (context, index))
+            self.worker_by_context[context] = index
+            self.labels_by_context[context] = set()
+        elif index in self.dead_workers:
+            raise Error("Worker %d of context %s is gone!" % (index, context))
+            
+        self.labels_by_context[context].add(label)
+        self.worker_by_label[label] = index
+        self.thing_counts[index] += 1
+        
+        return index
+        
+        
+    def remove_thing(self, label):
+        index = self.worker_by_label.pop(label, None)
+        
+        if index is None:
+            return
+            
+        context = self.get_context(label)
+        labels = self.labels_by_context[context]
+        labels.remove(label)
+        self.thing_counts[index] -= 1
+        
+        if not labels:
+            self.worker_by_context.pop(context)
+            self.labels_by_context.pop(context)
+            
+            
+    def find_worker(self, label):
+        index = self.worker_by_label.get(label)
+        
+        if index is None:
+            raise Error("Thing does not exist: %s!" % label)
+            
+        return index
+        
+        
+    def route_request(self, target, params):
+        if target == "create_thing":
+            return self.place_thing(params["label"])
+        elif target == "delete_thing":
+            label = params["label"]
+            index = self.find_worker(label)
+            self.remove_thing(label)
+            return index
+        elif target in ("modify_thing", "take_thing", "tone"):
+            return self.find_worker(params["label"])
+        elif target in ("link_slots", "unlink_slots"):
+            slots = params["slots"]
+            index = self.find_worker(slots[0][0])
+            
+            if self.find_worker(slots[1][0]) != index:
+                raise Error("Things on different workers can't be linked!")
+                
+            return index
+        else:
+            raise Error("Invalid target %s!" % target)
+            
+            
+    def process_request(self, target, params, source):
+        # Every request is passed to the workers as a batch, split by worker
+        is_batch = target == "batch"
+        requests = params["requests"] if is_batch else [ (target, params) ]
+        batch = SupervisedBatch(source, requests, is_batch)
+        positions_by_worker = {}
+        
+        for position, (t, p) in enumerate(requests):
+            try:
+                index = self.route_request(t, p)
+                
+                if index in self.dead_workers:
+                    raise Error("Worker %d is gone!" % index)
+            except Exception as e:
+                self.logger.error("Routing error: %s" % e)
+            else:
+                positions_by_worker.setdefault(index, []).append(position)
+                
+        if not positions_by_worker:
+            self.finish_batch(batch)
+            return
+            
+        name, seq = source
+        part_sources_by_worker = {}
+        
+        # All parts are counted before sending, so a failed one can't finish the batch early
+        for index, positions in positions_by_worker.items():
+            # The worker still needs the owner sid from the source
+            part_source = (name, (seq, index))
+            self.batch_parts_by_source[part_source] = (batch, positions)
+            part_sources_by_worker[index] = part_source
+            batch.part_count += 1
+            
+        for index, positions in positions_by_worker.items():
+            part_requests = [ requests[position] for position in positions ]
+            self.send_to_worker(index, ("request", "batch", dict(requests=part_requests), part_sources_by_worker[index]))
+            
+            
+    def batch_part_finished(self, part_source, results):
+        batch, positions = self.batch_parts_by_source.pop(part_source)
+        
+        for position, result in zip(positions, results):
+            batch.results[position] = result
+            target, params = batch.requests[position]
+            
+            if target == "create_thing" and result != "ok":
+                self.remove_thing(params["label"])
+                
+        batch.part_count -= 1
+        
+        if not batch.part_count:
+            self.finish_batch(batch)
+            
+            
+    def finish_batch(self, batch):
+        body = batch.results if batch.is_batch else batch.results[0]
+        self.msgp.send_response(batch.source, body)
+            
+            
+    def process_response(self, origin, params, source):
+        index, origin = origin
+        
+        if index not in self.dead_workers:
+            self.send_to_worker(index, ("response", origin, params, source))
+        
+        
+    def piped(self, index):
+        pipe = self.pipes[index]
+        
+        try:
+            while pipe.poll():
+                message = pipe.recv()
+                
+                if message[0] == "request":
+                    target, params, origin = message[1:]
+                    origin = (index, origin) if origin else None
+                    self.msgp.send_request(target, params, origin=origin)
+                elif message[0] == "response":
+                    source, body = message[1:]
+                    self.batch_part_finished(source, body)
+                elif message[0] == "load":
+                    self.add_worker_counts(self.loads[index], message[1])
+                    self.loads[index] = message[1]
+        except EOFError:
+            self.worker_gone(index)
@@ -0,0 +1,507 @@
+import time
+import math
+import struct
+import socket
+import statistics
+import platform
+import datetime
+import json
+
+import g711
+from format import parse_structured_message, print_structured_message
+from async_net import HttpLikeMessage
+from sdp import Sdp
+from msgp import MsgpPipe
+from rtp import build_rtp, parse_rtp, amplify_wav, make_gain_table, interleave_samples, Announcement, RtpPlayer, RtpBuilder, RtpParser, Format, Packet
+from zap import Plug, kernel, run_scheduled_tasks
+
+
+# Microbenchmarks for the individual hot functions. Every benchmark is a function
+# that prepares its input, and returns a callable doing one unit of work, so
+# the setup cost is excluded. Results are per operation times in microseconds.
+
+SDP_BODY = (
+    b"v=0\r\n"
+    b"o=- 1730000000 1 IN IP4 192.168.1.10\r\n"
+    b"s= \r\n"
+    b"c=IN IP4 192.168.1.10\r\n"
+    b"t=0 0\r\n"
+    b"m=audio 30000 RTP/AVP 8 0 101\r\n"
+    b"a=rtpmap:8 PCMA/8000\r\n"
+    b"a=rtpmap:0 PCMU/8000\r\n"
+    b"a=rtpmap:101 telephone-event/8000\r\n"
+    b"a=fmtp:101 0-15\r\n"
+    b"a=ptime:20\r\n"
+    b"a=sendrecv\r\n"
+)
+
+INVITE_HEADER = (
+    b"INVITE sip:350@192.168.1.20:5060 SIP/2.0\r\n"
+    b"Via: SIP/2.0/UDP 192.168.1.10:5060;branch=z9hG4bK3f2a9c1e;rport\r\n"
+    b"From: \"Caller\" <sip:201@a.switch>;tag=8a6d2f01\r\n"
+    b"To: <sip:350@b.switch>\r\n"
+    b"Call-Id: 6b1e2c9d4f7a@192.168.1.10\r\n"
+    b"Cseq: 1 INVITE\r\n"
+    b"Contact: <sip:201@192.168.1.10:5060>\r\n"
+    b"Max-Forwards: 70\r\n"
+    b"Allow: ACK, BYE, CANCEL, INVITE, PRACK, REFER, UPDATE\r\n"
+    b"Supported: 100rel, norefersub, replaces\r\n"
+    b"User-Agent: siplib\r\n"
+    b"Content-Type: application/sdp\r\n"
+    b"Content-Length: %d"
+) % len(SDP_BODY)
+
+RESPONSE_HEADER = (
+    b"SIP/2.0 200 OK\r\n"
+    b"Via: SIP/2.0/UDP 192.168.1.10:5060;branch=z9hG4bK3f2a9c1e;rport\r\n"
+    b"From: \"Caller\" <sip:201@a.switch>;tag=8a6d2f01\r\n"
+    b"To: <sip:350@b.switch>;tag=51c3e0aa\r\n"
+    b"Call-Id: 6b1e2c9d4f7a@192.168.1.10\r\n"
+    b"Cseq: 1 INVITE\r\n"
+    b"Contact: <sip:350@192.168.1.20:5060>\r\n"
+    b"Content-Length: 0"
+)
+
+MSGP_MESSAGE = ("#42", "$create_thing", dict(
+    label="a/1/leg:0/0/net",
+    type="rtp",
+    local_addr=[ "192.168.1.20", 30000 ],
+    remote_addr=[ "192.168.1.10", 40000 ],
+    send_formats={ "8": [ "PCMA", 8000, 1, None ], "101": [ "telephone-event", 8000, 1, "0-15" ] },
+    recv_formats={ "8": [ "PCMA", 8000, 1, None ] }
+))
+
+SAMPLES_PER_FRAME = 160  # 20ms at 8kHz
+POLL_SOCKET_COUNT = 64
+MSGP_BURST_SIZE = 200
+
+
+def make_frame(n=SAMPLES_PER_FRAME):
+    # A 1kHz tone at a moderate level
+    return bytearray(struct.pack("<%dh" % n, *(int(8000 * math.sin(2 * math.pi * 1000 * i / 8000)) for i in range(n))))
+
+
+def bench_parse_invite():
+    def run():
+        hlm, content_length = HttpLikeMessage.parse(INVITE_HEADER)
+        hlm.body = SDP_BODY
+        parse_structured_message(hlm)
+
+    return run
+
+
+def bench_parse_response():
+    def run():
+        hlm, content_length = HttpLikeMessage.parse(RESPONSE_HEADER)
+        hlm.body = b""
+        parse_structured_message(hlm)
+
+    return run
+
+
+def bench_print_invite():
+    hlm, content_length = HttpLikeMessage.parse(INVITE_HEADER)
+    hlm.body = SDP_BODY
+    msg = parse_structured_message(hlm)
+
+    def run():
+        print_structured_message(msg).print()
+
+    return run
+
+
+def bench_sdp_parse():
+    def run():
+        Sdp.parse(SDP_BODY)
+
+    return run
+
+
+def bench_sdp_print():
+    sdp = Sdp.parse(SDP_BODY)
+
+    def run():
+        sdp.print()
+
+    return run
+
+
+def bench_encode_pcma():
+    frame = make_frame()
+
+    def run():
+        g711.encode_pcma(frame)
+
+    return run
+
+
+def bench_encode_pcmu():
+    frame = make_frame()
+
+    def run():
+        g711.encode_pcmu(frame)
+
+    return run
+
+
+def bench_decode_pcma():
+    payload = g711.encode_pcma(make_frame())
+
+    def run():
+        g711.decode_pcma(payload)
+
+    return run
+
+
+def bench_decode_pcmu():
+    payload = g711.encode_pcmu(make_frame())
+
+    def run():
+        g711.decode_pcmu(payload)
+
+    return run
+
+
+def bench_transcode_pcma_to_pcmu():
+    payload = g711.encode_pcma(make_frame())
+
+    def run():
+        g711.transcode_pcma_to_pcmu(payload)
+
+    return run
+
+
+def bench_amplify():
+    frame = make_frame()
+
+    def run():
+        amplify_wav(bytearray(frame), 0.5)
+
+    return run
+
+
+def bench_amplify_fade():
+    frame = make_frame()
+
+    def run():
+        amplify_wav(bytearray(frame), 0.5, 0.6)
+
+    return run
+
+
+def bench_amplify_fade_cold():
+    # The first fade frame of a process, when no gain tables are cached yet
+    frame = make_frame()
+
+    def run():
+        make_gain_table.cache_clear()
+        amplify_wav(bytearray(frame), 0.1, 0.9)
+
+    return run
+
+
+def bench_player_frame():
+    # Dividing the rate by 50 frames per second gives the players per core
+    player = RtpPlayer(Format("PCMA", 8000, 1, None), make_frame(8000), volume=0.5, is_looping=True)
+    player.play_plug.detach()
+
+    def run():
+        player.play()
+
+    run.player = player
+
+    return run
+
+
+def bench_player_frame_shared():
+    announcement = Announcement(make_frame(8000))
+    player = RtpPlayer(Format("PCMA", 8000, 1, None), announcement.samples, volume=0.5, announcement=announcement, is_looping=True)
+    player.play_plug.detach()
+
+    def run():
+        player.play()
+
+    run.player = player
+
+    return run
+
+
+def bench_interleave():
+    fore = make_frame()
+    back = make_frame()
+
+    def run():
+        interleave_samples(fore, back)
+
+    return run
+
+
+def bench_build_rtp():
+    payload = g711.encode_pcma(make_frame())
+
+    def run():
+        build_rtp(0x12345678, 1000, 160000, False, 8, payload)
+
+    return run
+
+
+def bench_rtp_builder():
+    format = Format("PCMA", 8000, 1, None)
+    packet = Packet(format, 160000, False, g711.encode_pcma(make_frame()))
+    builder = RtpBuilder()
+    builder.set_payload_types_by_format({ format: 8 })
+
+    def run():
+        builder.build(packet)
+
+    return run
+
+
+def bench_parse_rtp():
+    packet = bytes(build_rtp(0x12345678, 1000, 160000, False, 8, g711.encode_pcma(make_frame())))
+
+    def run():
+        parse_rtp(packet)
+
+    return run
+
+
+def bench_rtp_parser():
+    # An in order stream through the jitter buffer
+    payload = g711.encode_pcma(make_frame())
+    parser = RtpParser()
+    parser.set_formats_by_payload_type({ 8: Format("PCMA", 8000, 1, None) })
+    state = dict(seq=0)
+
+    def run():
+        seq = state["seq"] = (state["seq"] + 1) & 0xffff
+        parser.parse(build_rtp(0x12345678, seq, seq * 160, False, 8, payload))
+
+    return run
+
+
+def make_msgp_pipe(is_binary):
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    pipe = MsgpPipe(sock)
+    pipe.prints_binary = is_binary
+    pipe.peer = peer
+
+    return pipe
+
+
+def close_msgp_pipe(pipe):
+    # Leave no stale sockets registered for the poll benchmarks that follow
+    pipe.readable_plug.detach()
+    pipe.write_plug.detach()
+    pipe.socket.close()
+    pipe.peer.close()
+
+
+def bench_msgp_print(is_binary):
+    pipe = make_msgp_pipe(is_binary)
+
+    def run():
+        pipe.print_message(MSGP_MESSAGE)
+
+    run.close = lambda: close_msgp_pipe(pipe)
+
+    return run
+
+
+def bench_msgp_parse(is_binary):
+    pipe = make_msgp_pipe(is_binary)
+    data = pipe.print_message(MSGP_MESSAGE)
+
+    def run():
+        header, offset = pipe.parse_header(data, 0)
+        pipe.parse_body(header, data, offset)
+
+    run.close = lambda: close_msgp_pipe(pipe)
+
+    return run
+
+
+class CountingMsgpPipe(MsgpPipe):
+    def process_message(self, message):
+        self.message_count += 1
+
+
+def bench_msgp_recv_burst():
+    # Many small control messages arriving at once, like ACK-s after a pause
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    pipe = CountingMsgpPipe(sock)
+    pipe.peer = peer
+    pipe.message_count = 0
+    burst = b"".join(pipe.print_message(("!ack", "#%d" % i, None)) for i in range(MSGP_BURST_SIZE))
+
+    def run():
+        peer.send(burst)
+        pipe.readable()
+
+    run.close = lambda: close_msgp_pipe(pipe)
+
+    return run
+
+
+class PollReader:
+    def __init__(self):
+        self.socket, self.peer = socket.socketpair()
+        self.socket.setblocking(False)
+        self.peer.setblocking(False)
+        self.plug = Plug(self.readable).attach_read(self.socket)
+
+
+    def readable(self):
+        self.socket.recv(1)
+
+
+    def close(self):
+        self.plug.detach()
+        self.socket.close()
+        self.peer.close()
+
+
+def bench_poll_dispatch():
+    # One ready socket among many registered ones, like a busy media gateway
+    readers = [ PollReader() for i in range(POLL_SOCKET_COUNT) ]
+    peer = readers[POLL_SOCKET_COUNT // 2].peer
+
+    def run():
+        peer.send(b"x")
+        kernel.do_poll()
+        run_scheduled_tasks()
+
+    def close():
+        for reader in readers:
+            reader.close()
+
+    run.close = close
+
+    return run
+
+
+BENCHMARKS = [
+    ("format.parse_invite", bench_parse_invite),
+    ("format.parse_response", bench_parse_response),
+    ("format.print_invite", bench_print_invite),
+    ("sdp.parse", bench_sdp_parse),
+    ("sdp.print", bench_sdp_print),
+    ("g711.encode_pcma", bench_encode_pcma),
+    ("g711.encode_pcmu", bench_encode_pcmu),
+    ("g711.decode_pcma", bench_decode_pcma),
+    ("g711.decode_pcmu", bench_decode_pcmu),
+    ("g711.transcode_pcma_to_pcmu", bench_transcode_pcma_to_pcmu),
+    ("rtp.amplify", bench_amplify),
+    ("rtp.amplify_fade", bench_amplify_fade),
+    ("rtp.amplify_fade_cold", bench_amplify_fade_cold),
+    ("rtp.player_frame", bench_player_frame),
+    ("rtp.player_frame_shared", bench_player_frame_shared),
+    ("rtp.interleave", bench_interleave),
+    ("rtp.build_rtp", bench_build_rtp),
+    ("rtp.builder", bench_rtp_builder),
+    ("rtp.parse_rtp", bench_parse_rtp),
+    ("rtp.parser", bench_rtp_parser),
+    ("msgp.print_json", lambda: bench_msgp_print(False)),
+    ("msgp.parse_json", lambda: bench_msgp_parse(False)),
+    ("msgp.print_binary", lambda: bench_msgp_print(True)),
+    ("msgp.parse_binary", lambda: bench_msgp_parse(True)),
+    ("msgp.recv_burst", bench_msgp_recv_burst),
+    ("zap.poll_dispatch", bench_poll_dispatch),
+]
+
+
+def calibrate(run, min_time):
+    # Find a loop count that takes at least min_time, this also serves as a warmup
+    number = 1
+
+    while True:
+        started = time.perf_counter()
+
+        for i in range(number):
+            run()
+
+        elapsed = time.perf_counter() - started
+
+        if elapsed >= min_time:
+            return number
+
+        number *= 2 if elapsed < min_time / 10 else max(2, int(min_time / elapsed * 1.2))
+
+
+def measure(run, number, repeat):
+    timings = []
+
+    for r in range(repeat):
+        started = time.perf_counter()
+
+        for i in range(number):
+            run()
+
+        timings.append((time.perf_counter() - started) / number * 1e6)
+
+    return timings
+
+
+def run_benchmarks(names=None, repeat=7, min_time=0.1):
+    results = []
+
+    for name, factory in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+
+        run = factory()
+        number = calibrate(run, min_time)
+        timings = measure(run, number, repeat)
+
+        if hasattr(run, "close"):
+            run.close()
+
+        results.append(dict(
+            name=name,
+            number=number,
+            repeat=repeat,
+            min=min(timings),
+            median=statistics.median(timings),
+            mean=statistics.mean(timings),
+            stdev=statistics.stdev(timings) if len(timings) > 1 else 0.0
+        ))
+
+    return results
+
+
+def make_report(results):
+    return dict(
+        created=datetime.datetime.now().isoformat(),
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        machine=platform.machine(),
+        unit="usec",
+        results=results
+    )
+
+
+def print_report(report, baseline=None):
+    base_by_name = { r["name"]: r for r in baseline["results"] } if baseline else {}
+    lines = [ "%-28s %12s %12s %10s %12s %8s" % ("benchmark", "median", "min", "stdev", "ops/s", "change") ]
+
+    for r in report["results"]:
+        base = base_by_name.get(r["name"])
+        change = "%+.1f%%" % ((r["median"] / base["median"] - 1) * 100) if base else ""
+
+        rate = 1e6 / r["median"] if r["median"] else 0
+
+        lines.append("%-28s %12.3f %12.3f %10.3f %12.0f %8s" % (r["name"], r["median"], r["min"], r["stdev"], rate, change))
+
+    return "\n".join(lines)
+
+
+def load_report(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def save_report(report, filename):
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
@@ -1,44 +1,117 @@
 import json
+import struct
 import collections
 import datetime
 import socket
 import errno
 
-from async_net import TcpReconnector, TcpListener
+from async_net import TcpReconnector, TcpListener, UnixReconnector, UnixListener
 from log import Loggable
 from format import Addr
-from zap import Slot, EventSlot, Plug
+from zap import Slot, EventSlot, Plug, schedule
 from util import generate_msgp_session_id
+from metrics import registry
+
+
+MSGP_QUEUE_DEPTH = registry.gauge("siplib_msgp_queue_depth", "Msgp messages waiting for an ACK or a response.", ("dispatcher", "queue"))
+
+# Binary frames start with a byte that can't start a textual header, then the
+# sizes of the source, target, and body follow, and the body is compact JSON.
+BINARY_MAGIC = 0xb5
+BINARY_HEADER = struct.Struct("!BBBI")
+BINARY_NO_BODY = 0xffffffff
+COMPACT_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+RECV_SIZE = 65536
 
 
 class MessagePipe(Loggable):
+    # Unsent bytes above the high watermark are reported as congestion, until
+    # the peer reads enough of them to get below the low one
+    HIGH_WATERMARK = 1024 * 1024
+    LOW_WATERMARK = 256 * 1024
+    
     def __init__(self, socket):
         Loggable.__init__(self)
         
         self.socket = socket
 
-        self.incoming_buffer = b""
+        # Parsed messages only advance the offset, and the buffer is compacted
+        # once after processing everything that was received
+        self.incoming_buffer = bytearray()
+        self.incoming_offset = 0
         self.incoming_header = None
+        self.recv_buffer = bytearray(RECV_SIZE)
+        self.outgoing_chunks = []
+        self.outgoing_buffer = bytearray()
+        self.is_congested = False
+        self.has_failed = False
 
+        self.congestion_slot = EventSlot()
         self.readable_plug = Plug(self.readable).attach_read(self.socket)
+        self.write_plug = Plug(self.writable)
 
 
-    def write(self, data):
+    def write(self):
         try:
-            sent = self.socket.send(data)
+            sent = self.socket.send(self.outgoing_buffer)
+        except BlockingIOError:
+            sent = 0
         except IOError as e:
             self.logger.error("Socket error while sending: %s" % e)
+            self.write_plug.detach()
+            self.has_failed = True
             self.process_message(None)
-            return None
+            return
+            
+        del self.outgoing_buffer[:sent]
+        self.write_plug.detach()
+        
+        if self.outgoing_buffer:
+            self.write_plug.attach_write(self.socket)
+            
+        self.check_congestion()
+            
+            
+    def check_congestion(self):
+        size = len(self.outgoing_buffer)
+        
+        if not self.is_congested and size > self.HIGH_WATERMARK:
+            self.logger.warning("Pipe congested with %d unsent bytes!" % size)
+            self.is_congested = True
+            self.congestion_slot.zap(True)
+        elif self.is_congested and size < self.LOW_WATERMARK:
+            self.logger.info("Pipe no longer congested.")
+            self.is_congested = False
+            self.congestion_slot.zap(False)
+            
+            
+    def flush(self):
+        # Everything sent in one loop iteration goes out in a single write,
+        # or is appended to the unsent bytes waiting for the socket
+        if not self.outgoing_chunks or self.has_failed:
+            return
+            
+        is_writing = bool(self.outgoing_buffer)
+        self.outgoing_buffer += b"".join(self.outgoing_chunks)
+        self.outgoing_chunks = []
+        
+        if is_writing:
+            self.check_congestion()
         else:
-            return data[sent:]
+            self.write()
+            
+            
+    def writable(self):
+        """Called when the socket becomes writable."""
+        self.write()
     
         
-    def parse_header(self, buffer):
+    def parse_header(self, buffer, offset):
         raise NotImplementedError()
         
         
-    def parse_body(self, header, buffer):
+    def parse_body(self, header, buffer, offset):
         raise NotImplementedError()
 
 
@@ -60,7 +133,7 @@ class MessagePipe(Loggable):
             recved = None
 
             try:
-                recved = self.socket.recv(65536)
+                recved = self.socket.recv_into(self.recv_buffer)
             except socket.error as e:
                 if e.errno == errno.EAGAIN:
                     break
@@ -76,17 +149,17 @@ class MessagePipe(Loggable):
                 has_failed = True
                 break
 
-            self.incoming_buffer += recved
+            self.incoming_buffer += memoryview(self.recv_buffer)[:recved]
 
         # Must process all available messages
         while True:
             if not self.incoming_header:
                 # No header processed yet, look for the next one
-                self.incoming_header, self.incoming_buffer = self.parse_header(self.incoming_buffer)
+                self.incoming_header, self.incoming_offset = self.parse_header(self.incoming_buffer, self.incoming_offset)
 
             if self.incoming_header:
                 # If have a header, get the body
-                message, self.incoming_buffer = self.parse_body(self.incoming_header, self.incoming_buffer)
+                message, self.incoming_offset = self.parse_body(self.incoming_header, self.incoming_buffer, self.incoming_offset)
                 
                 if message:
                     self.incoming_header = None
@@ -96,22 +169,30 @@ class MessagePipe(Loggable):
                     
             break
 
+        if self.incoming_offset:
+            del self.incoming_buffer[:self.incoming_offset]
+            self.incoming_offset = 0
+            
         if has_failed:
             self.readable_plug.detach()
             self.process_message(None)
             
 
     def send_message(self, message):
-        """Send a Message tuple to the peer."""
+        """Queue a Message tuple to the peer, returns False if the pipe already failed."""
         
         #self.logger.debug("Sent: %s" % (message,))
         data = self.print_message(message)
         if not isinstance(data, (bytes, bytearray)):
             raise Exception("Printed message is not bytes!")
             
-        rest = self.write(data)
+        if self.has_failed:
+            return False
+            
+        self.outgoing_chunks.append(data)
+        schedule(self.flush)
         
-        return not rest
+        return True
 
 
 
@@ -125,6 +206,7 @@ class TimedMessagePipe(MessagePipe):
         self.error_slot = Slot()
         
         self.ack_plugs_by_source = {}
+        self.pending_ack_source = None
         
         self.ack_timeout = datetime.timedelta(seconds=1)  # TODO
         self.keepalive_interval = datetime.timedelta(seconds=10)  # TODO
@@ -184,23 +266,56 @@ class TimedMessagePipe(MessagePipe):
         else:
             self.reset_keepalive()
         
-        ack_plug = self.ack_plugs_by_source.pop(target, None)
-        if ack_plug:
-            #self.logger.debug("Acked %s" % seq)
-            ack_plug.detach()
-            self.ack_slot.zap(target)
+        self.acknowledge(target)
             
         if source == "!ack":
             return
 
-        ack_message = ("!ack", source, None)
-        is_piped = self.send_message(ack_message)  # no ACK expected for an ACK
-        if not is_piped:
-            self.error_slot.zap()
+        if source.startswith("#"):
+            # Numbered messages arrive in order, so only the last one is ACK-ed
+            self.pending_ack_source = source
+            schedule(self.flush)
+        else:
+            ack_message = ("!ack", source, None)
+            is_piped = self.send_message(ack_message)  # no ACK expected for an ACK
+            if not is_piped:
+                self.error_slot.zap()
 
         self.process_slot.zap(message)
 
 
+    def acknowledge(self, target):
+        # An ACK or a response to a numbered message implies all the previous ones
+        if target.startswith("#"):
+            seq = int(target[1:])
+            sources = []
+            
+            for source in self.ack_plugs_by_source:
+                if source.startswith("#"):
+                    if int(source[1:]) > seq:
+                        break
+                        
+                    sources.append(source)
+        else:
+            sources = [ target ] if target in self.ack_plugs_by_source else []
+            
+        for source in sources:
+            #self.logger.debug("Acked %s" % source)
+            self.ack_plugs_by_source.pop(source).detach()
+            self.ack_slot.zap(source)
+
+
+    def flush(self):
+        if self.pending_ack_source:
+            ack_message = ("!ack", self.pending_ack_source, None)
+            self.pending_ack_source = None
+            
+            if not self.has_failed:
+                self.outgoing_chunks.append(self.print_message(ack_message))
+            
+        MessagePipe.flush(self)
+
+
     def try_sending(self, message):
         is_piped = self.send_message(message)
         if not is_piped:
@@ -215,35 +330,33 @@ class TimedMessagePipe(MessagePipe):
 
 class SimpleJsonPipe:
 #class MsgpPipe(TimedMessagePipe):
-    def parse_header(self, buffer):
-        header, separator, rest = buffer.partition(b"\n")
-        if not separator:
-            return None, buffer
+    def parse_header(self, buffer, offset):
+        end = buffer.find(b"\n", offset)
+        if end < 0:
+            return None, offset
 
-        fields = header.decode('ascii').split(" ")
+        fields = buffer[offset:end].decode('ascii').split(" ")
         source = fields[0]
         target = fields[1]
         length = int(fields[2]) if len(fields) > 2 else None
 
         header = (source, target, length)
-        return header, rest
+        return header, end + 1
 
 
-    def parse_body(self, header, buffer):
+    def parse_body(self, header, buffer, offset):
         source, target, length = header
 
         if length is None:
-            return header, buffer
+            return header, offset
 
-        if len(self.incoming_buffer) < length + 1:
-            return None, buffer
+        end = offset + length
+        if len(buffer) < end + 1:
+            return None, offset
             
-        body = buffer[:length]
-        rest = buffer[length + 1:]
-        
-        body = json.loads(body.decode('ascii'))
+        body = json.loads(buffer[offset:end].decode('ascii'))
         message = (source, target, body)
-        return message, rest
+        return message, end + 1
 
 
     def print_message(self, message):
@@ -264,7 +377,68 @@ class SimpleJsonPipe:
 
 
 
-class MsgpPipe(SimpleJsonPipe, TimedMessagePipe):
+class BinaryJsonPipe(SimpleJsonPipe):
+    # Binary frames are only printed if the peer announced them in its handshake,
+    # but always parsed, because the peer may switch before we know it.
+    prints_binary = False
+    
+    def parse_header(self, buffer, offset):
+        if len(buffer) <= offset or buffer[offset] != BINARY_MAGIC:
+            return SimpleJsonPipe.parse_header(self, buffer, offset)
+            
+        tokens_start = offset + BINARY_HEADER.size
+        
+        if len(buffer) < tokens_start:
+            return None, offset
+            
+        magic, source_size, target_size, body_size = BINARY_HEADER.unpack_from(buffer, offset)
+        tokens_end = tokens_start + source_size + target_size
+        
+        if len(buffer) < tokens_end:
+            return None, offset
+            
+        tokens = buffer[tokens_start:tokens_end].decode('ascii')
+        length = body_size if body_size != BINARY_NO_BODY else None
+        
+        return (tokens[:source_size], tokens[source_size:], length, True), tokens_end
+        
+        
+    def parse_body(self, header, buffer, offset):
+        if len(header) == 3:
+            return SimpleJsonPipe.parse_body(self, header, buffer, offset)
+            
+        source, target, length, is_binary = header
+        
+        if length is None:
+            return (source, target, None), offset
+            
+        end = offset + length
+        if len(buffer) < end:
+            return None, offset
+            
+        body = json.loads(buffer[offset:end].decode('ascii'))
+        message = (source, target, body)
+        return message, end
+        
+        
+    def print_message(self, message):
+        if not self.prints_binary:
+            return SimpleJsonPipe.print_message(self, message)
+            
+        source, target, body = message
+        source = source.encode('ascii')
+        target = target.encode('ascii')
+        
+        if body is not None:
+            body = COMPACT_JSON_ENCODER.encode(body).encode('ascii')
+            return BINARY_HEADER.pack(BINARY_MAGIC, len(source), len(target), len(body)) + source + target + body
+        else:
+            return BINARY_HEADER.pack(BINARY_MAGIC, len(source), len(target), BINARY_NO_BODY) + source + target
+
+
+
+
+class MsgpPipe(BinaryJsonPipe, TimedMessagePipe):
     # Base class order matters, because of the MRO. Formatting functions
     # must be found first, before the default implementation!
     pass
@@ -291,6 +465,10 @@ class MsgpStream(Loggable):
 
         self.unacked_items_by_seq = collections.OrderedDict()
         self.unresponded_items_by_seq = collections.OrderedDict()
+        
+        # Queued while the pipe is congested, and sent in order once it's not
+        self.is_congested = False
+        self.held_seqs = collections.deque()
 
         self.response_timeout = datetime.timedelta(seconds=5)  # FIXME: make configurable!
 
@@ -307,6 +485,8 @@ class MsgpStream(Loggable):
 
     def connect(self, pipe, last_sent_seq):
         self.pipe = pipe
+        self.is_congested = False
+        self.held_seqs.clear()  # resent below with the unacked ones
         acked_seqs = []  # Implicitly ACK-ed messages during a reconnect
         
         for seq, item in self.unacked_items_by_seq.items():
@@ -324,6 +504,7 @@ class MsgpStream(Loggable):
         Plug(self.pipe_processed).attach(pipe.process_slot)
         Plug(self.pipe_acked).attach(pipe.ack_slot)
         Plug(self.pipe_failed).attach(pipe.error_slot)
+        Plug(self.pipe_congested).attach(pipe.congestion_slot)
 
 
     def send_item(self, seq, item):
@@ -356,7 +537,11 @@ class MsgpStream(Loggable):
             response_plug=response_plug
         )
         
-        self.send_item(seq, item)
+        if self.is_congested:
+            self.held_seqs.append(seq)
+        else:
+            self.send_item(seq, item)
+            
         self.unacked_items_by_seq[seq] = item
 
 
@@ -428,6 +613,26 @@ class MsgpStream(Loggable):
             self.logger.debug("Unexpected ACK for message #%d" % tseq)
     
             
+    def pipe_congested(self, is_congested):
+        if is_congested == self.is_congested:
+            return
+            
+        self.is_congested = is_congested
+        
+        if is_congested:
+            self.logger.warning("Pipe congested, holding outgoing messages.")
+            return
+            
+        self.logger.info("Pipe decongested, sending %d held messages." % len(self.held_seqs))
+        
+        while self.held_seqs:
+            seq = self.held_seqs.popleft()
+            item = self.unacked_items_by_seq.get(seq)
+            
+            if item:  # unless its response timed out meanwhile
+                self.send_item(seq, item)
+        
+            
     def pipe_failed(self):
         self.error_slot.zap()
 
@@ -456,10 +661,32 @@ class MsgpDispatcher(Loggable):
         
         self.streams_by_name = {}
         self.handshakes_by_addr = {}
+        self.is_binary_allowed = True
+
+
+    def set_oid(self, oid):
+        Loggable.set_oid(self, oid)
         
+        MSGP_QUEUE_DEPTH.add_source(self.count_unacked, oid, "unacked")
+        MSGP_QUEUE_DEPTH.add_source(self.count_unresponded, oid, "unresponded")
+        MSGP_QUEUE_DEPTH.add_source(self.count_held, oid, "held")
+
+
+    def count_unacked(self):
+        return sum(len(s.unacked_items_by_seq) for s in self.streams_by_name.values())
+
+
+    def count_unresponded(self):
+        return sum(len(s.unresponded_items_by_seq) for s in self.streams_by_name.values())
         
-    def add_unidentified_pipe(self, socket):
-        addr = Addr(*socket.getpeername())
+        
+    def count_held(self):
+        return sum(len(s.held_seqs) for s in self.streams_by_name.values())
+        
+        
+    def add_unidentified_pipe(self, socket, addr=None):
+        # Unix domain sockets have no meaningful peer address, so one is given
+        addr = addr or Addr(*socket.getpeername())
         self.logger.debug("Adding handshake with %s" % (addr,))
         
         pipe = MsgpPipe(socket)
@@ -475,6 +702,10 @@ class MsgpDispatcher(Loggable):
         source = "@hello"
         target = "@json"
         body = self.make_handshake(addr)
+        
+        if self.is_binary_allowed:
+            body["codecs"] = [ "binary" ]
+            
         self.logger.debug("Sending handshake from %s to %s as %r" % (source, target, body))
         message = (source, target, body)
         is_piped = pipe.try_sending(message)
@@ -498,6 +729,11 @@ class MsgpDispatcher(Loggable):
 
         if source == "@hello":
             name = self.take_handshake(addr, body)
+            
+            if self.is_binary_allowed and "binary" in body.get("codecs", []):
+                self.logger.debug("Switching to binary framing with %s" % (addr,))
+                h.pipe.prints_binary = True
+                
             # TODO: here we should check if the stream exists, and what was the last
             # properly received seq, then tell it. Similarly, we should store the
             # seq in the opposite side. If both sides recognized each other, then
@@ -583,12 +819,13 @@ class MsgpDispatcher(Loggable):
             Plug(self.process_response, name=name).attach(stream.response_slot)
             Plug(self.process_error, name=name).attach(stream.error_slot)
             self.streams_by_name[name] = stream
-
-            self.status_slot.zap(name, addr)
         else:
             self.logger.info("Reconnecting stream %s" % name)
 
         stream.connect(pipe, h.last_sent_seq)
+        
+        # Also after reconnecting, so the owner knows it's reachable again
+        self.status_slot.zap(name, addr)
     
 
     # NOTE: The reason why requests and responses are processed in almost the same
@@ -663,6 +900,8 @@ class MsgpPeer(MsgpDispatcher):
         else:
             self.listener = None
 
+        self.unix_listener = None
+        self.unix_accept_count = 0
         self.reconnectors_by_addr = {}
 
 
@@ -671,16 +910,36 @@ class MsgpPeer(MsgpDispatcher):
         
         if self.listener:
             self.listener.set_oid(self.oid.add("listener"))
+            
+        if self.unix_listener:
+            self.unix_listener.set_oid(self.oid.add("unix-listener"))
 
 
     def set_name(self, name):
         self.name = name
 
         
-    def add_remote_addr(self, remote_addr):
-        reconnector = TcpReconnector(remote_addr, datetime.timedelta(seconds=1))
+    def add_local_path(self, local_path):
+        # Peers on the same host may connect here instead of the TCP address
+        self.unix_listener = UnixListener(local_path)
+        Plug(self.unix_accepted, local_path=local_path).attach(self.unix_listener.accepted_slot)
+        
+        if self.oid:
+            self.unix_listener.set_oid(self.oid.add("unix-listener"))
+        
+        
+    def add_remote_addr(self, remote_addr, local_path=None):
+        # With a local path the peer is reached over a Unix domain socket,
+        # but it's still identified by its TCP address
+        timeout = datetime.timedelta(seconds=1)
+        
+        if local_path:
+            reconnector = UnixReconnector(local_path, timeout)
+        else:
+            reconnector = TcpReconnector(remote_addr, timeout)
+            
         reconnector.set_oid(self.oid.add("reconnector", str(remote_addr)))
-        Plug(self.connected).attach(reconnector.connected_slot)
+        Plug(self.connected, remote_addr=remote_addr).attach(reconnector.connected_slot)
         self.reconnectors_by_addr[remote_addr] = reconnector
         reconnector.start()
         
@@ -689,8 +948,13 @@ class MsgpPeer(MsgpDispatcher):
         self.add_unidentified_pipe(socket)
 
 
-    def connected(self, socket):
-        self.add_unidentified_pipe(socket)
+    def unix_accepted(self, socket, id, local_path):
+        self.unix_accept_count += 1
+        self.add_unidentified_pipe(socket, Addr(local_path, self.unix_accept_count))
+        
+
+    def connected(self, socket, remote_addr):
+        self.add_unidentified_pipe(socket, remote_addr)
 
 
     def make_handshake(self, addr):
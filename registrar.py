@@ -7,6 +7,10 @@ from transactions import make_simple_response
 from log import Loggable
 from zap import Plug, EventSlot
 from util import generate_call_id, generate_tag, MAX_FORWARDS
+from metrics import registry
+
+
+REGISTRATIONS_LIVE = registry.gauge("siplib_registrations_live", "Registrations currently alive.", ("kind",))
 
 
 class Error(Exception):
@@ -257,6 +261,21 @@ class Registrar(Loggable):
         self.remote_records_by_uri = {}
         self.record_change_slot = EventSlot()
         
+        REGISTRATIONS_LIVE.add_source(self.count_local_registrations, "local")
+        REGISTRATIONS_LIVE.add_source(self.count_remote_registrations, "remote")
+
+
+    def count_local_registrations(self):
+        # Static contacts are not registrations
+        return sum(
+            sum(1 for info in record.contact_infos_by_uri_hop.values() if info.expiration_deadline)
+            for record in self.local_records_by_uri.values()
+        )
+
+
+    def count_remote_registrations(self):
+        return len(self.remote_records_by_uri)
+        
         
     def reject_request(self, request, status):
         response = make_simple_response(request, status)
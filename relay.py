@@ -0,0 +1,336 @@
+import socket
+import select
+import errno
+import threading
+import collections
+import ctypes
+import ctypes.util
+
+from log import Loggable
+from zap import Plug
+
+
+# A worker thread receiving and sending RTP in batches for the media gateway.
+# The sockets of the RtpThings are polled here instead of the main loop, and
+# packets that can be relayed between linked things are rewritten and sent right
+# away. Everything else is handed off to the main loop, to take the full path.
+# The worker holds the lock while processing packets, so the gateway takes it
+# too for changing the things, or handling the handed off packets.
+
+PACKET_SIZE = 2048
+
+
+class Error(Exception): pass
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t)
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint)
+    ]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_uint8 * 4),
+        ("sin_zero", ctypes.c_uint8 * 8)
+    ]
+
+
+def load_libc():
+    # Calls through ctypes release the GIL, so the main loop can run meanwhile
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        for name in ("recvmmsg", "sendmmsg"):
+            f = getattr(libc, name)
+            f.restype = ctypes.c_int
+
+        libc.recvmmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p ]
+        libc.sendmmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int ]
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+libc = load_libc()
+
+
+class MmsgBatch:
+    # Preallocated message vectors for recvmmsg and sendmmsg
+    def __init__(self, size):
+        self.size = size
+        self.buffers = [ ctypes.create_string_buffer(PACKET_SIZE) for i in range(size) ]
+        self.recv_addrs = (sockaddr_in * size)()
+        self.recv_iovecs = (iovec * size)()
+        self.recv_msgs = (mmsghdr * size)()
+        self.send_addrs = (sockaddr_in * size)()
+        self.send_iovecs = (iovec * size)()
+        self.send_msgs = (mmsghdr * size)()
+
+        for i in range(size):
+            self.recv_iovecs[i].iov_base = ctypes.addressof(self.buffers[i])
+            hdr = self.recv_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.recv_addrs[i])
+            hdr.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+            hdr.msg_iovlen = 1
+            self.reset(i)
+
+            hdr = self.send_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.send_addrs[i])
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self.send_iovecs[i])
+            hdr.msg_iovlen = 1
+
+
+    def reset(self, i):
+        # The kernel overwrites these with the actual sizes
+        self.recv_iovecs[i].iov_len = PACKET_SIZE
+        self.recv_msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+
+
+    def recv(self, sock):
+        # A single packet is the common case, and that is cheaper without ctypes,
+        # the rest of a backlog is received in one call then
+        try:
+            data, addr = sock.recvfrom(PACKET_SIZE)
+        except BlockingIOError:
+            return []
+
+        received = [ (bytearray(data), addr) ]
+        n = libc.recvmmsg(sock.fileno(), self.recv_msgs, self.size - 1, socket.MSG_DONTWAIT, None)
+
+        if n < 0:
+            error = ctypes.get_errno()
+
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return received
+
+            raise OSError(error, "recvmmsg failed")
+
+        for i in range(n):
+            sa = self.recv_addrs[i]
+            addr = (socket.inet_ntoa(bytes(sa.sin_addr)), socket.ntohs(sa.sin_port))
+            data = bytearray(memoryview(self.buffers[i])[:self.recv_msgs[i].msg_len])
+            received.append((data, addr))
+            self.reset(i)
+
+        return received
+
+
+    def send(self, sock, packets):
+        # Datagrams not accepted by the kernel are dropped, as usual for RTP
+        if len(packets) == 1:
+            data, addr = packets[0]
+
+            try:
+                sock.sendto(data, addr)
+            except BlockingIOError:
+                pass
+
+            return
+
+        keep = []
+
+        for i, (data, addr) in enumerate(packets[:self.size]):
+            host, port = addr
+            sa = self.send_addrs[i]
+            sa.sin_family = socket.AF_INET
+            sa.sin_port = socket.htons(port)
+            sa.sin_addr[:] = socket.inet_aton(host)
+
+            buffer = (ctypes.c_char * len(data)).from_buffer(data)
+            keep.append(buffer)
+            self.send_iovecs[i].iov_base = ctypes.addressof(buffer)
+            self.send_iovecs[i].iov_len = len(data)
+
+        n = libc.sendmmsg(sock.fileno(), self.send_msgs, len(keep), 0)
+
+        if n < 0:
+            error = ctypes.get_errno()
+
+            if error not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise OSError(error, "sendmmsg failed")
+
+
+class SimpleBatch:
+    # The same with one system call per packet, where the above are missing
+    def __init__(self, size):
+        self.size = size
+
+
+    def recv(self, sock):
+        received = []
+
+        for i in range(self.size):
+            try:
+                data, addr = sock.recvfrom(PACKET_SIZE)
+            except BlockingIOError:
+                break
+
+            received.append((bytearray(data), addr))
+
+        return received
+
+
+    def send(self, sock, packets):
+        for data, addr in packets:
+            try:
+                sock.sendto(data, addr)
+            except BlockingIOError:
+                break
+
+
+class RelayWorker(Loggable):
+    BATCH_SIZE = 32
+    POLL_TIMEOUT = 0.5
+
+    def __init__(self, use_mmsg=True):
+        Loggable.__init__(self)
+
+        if not hasattr(select, "epoll"):
+            raise Error("The relay worker needs epoll!")
+
+        self.lock = threading.RLock()
+        self.epoll = select.epoll()
+        self.things_by_fd = {}
+        self.handoffs = collections.deque()
+        self.batch = MmsgBatch(self.BATCH_SIZE) if libc and use_mmsg else SimpleBatch(self.BATCH_SIZE)
+
+        self.relayed_packets_counter = None
+        self.relayed_bytes_counter = None
+
+        self.wakeup_socket, self.notify_socket = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self.notify_socket.setblocking(False)
+        self.handoff_plug = Plug(self.handed_off).attach_read(self.wakeup_socket)
+
+        self.is_running = False
+        self.thread = None
+
+
+    def set_counters(self, packets_counter, bytes_counter):
+        # Only this thread updates them
+        self.relayed_packets_counter = packets_counter
+        self.relayed_bytes_counter = bytes_counter
+
+
+    def start(self):
+        self.logger.info("Starting relay worker with %s." % ("recvmmsg" if isinstance(self.batch, MmsgBatch) else "recvfrom"))
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="relay", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.is_running = False
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        self.handoff_plug.detach()
+
+
+    def add_thing(self, thing):
+        fd = thing.socket.fileno()
+
+        with self.lock:
+            self.things_by_fd[fd] = thing
+            self.epoll.register(fd, select.EPOLLIN)
+
+
+    def remove_thing(self, thing):
+        with self.lock:
+            for fd, t in list(self.things_by_fd.items()):
+                if t is thing:
+                    self.epoll.unregister(fd)
+                    self.things_by_fd.pop(fd)
+
+
+    def run(self):
+        # Don't log here, it's a background thread
+        while self.is_running:
+            try:
+                events = self.epoll.poll(self.POLL_TIMEOUT)
+            except InterruptedError:
+                continue
+
+            with self.lock:
+                for fd, event in events:
+                    thing = self.things_by_fd.get(fd)
+
+                    if thing:
+                        self.process(thing)
+
+
+    def process(self, thing):
+        try:
+            received = self.batch.recv(thing.socket)
+        except OSError:
+            return
+
+        target = thing.get_relay_target()
+        packets = []
+
+        for udp, addr in received:
+            if target and addr == thing.remote_addr:
+                result = thing.relay_to(target, udp)
+
+                if result is not None:
+                    if result:
+                        packets.append((udp, target.remote_addr))
+
+                    continue
+
+            self.handoffs.append((thing, udp, addr))
+
+        if packets:
+            try:
+                self.batch.send(target.socket, packets)
+            except OSError:
+                pass
+
+            if self.relayed_packets_counter:
+                self.relayed_packets_counter.value += len(packets)
+                self.relayed_bytes_counter.value += sum(len(udp) for udp, addr in packets)
+
+        if self.handoffs:
+            try:
+                self.notify_socket.send(b"x")
+            except BlockingIOError:
+                pass  # the main loop is already notified plenty
+
+
+    def handed_off(self):
+        try:
+            self.wakeup_socket.recv(4096)
+        except BlockingIOError:
+            pass
+
+        with self.lock:
+            while self.handoffs:
+                thing, udp, addr = self.handoffs.popleft()
+                thing.recved_udp(udp, addr)
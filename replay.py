@@ -0,0 +1,154 @@
+import time
+from weakref import proxy
+
+from async_net import HttpLikeMessage
+from format import print_structured_message
+from transport import TransportManager
+from subscript import SubscriptionManager
+from switch import Switch
+from transactions import TransactionManager
+from zap import Planned
+
+
+# Feeds captured messages into a Switch with their captured hops, so that the full
+# processing path can be profiled without any network. Everybody is accepted
+# without authentication, so the requests get past the registrar checks. The
+# captured peers won't agree with our responses, so inconsistencies are expected,
+# and they are only counted instead of crashing the replay.
+
+class ReplayTransportManager(TransportManager):
+    def __init__(self):
+        TransportManager.__init__(self)
+
+        self.sent_count = 0
+
+
+    def send_message(self, params):
+        # The captured hops have no transports here, and the TCP client ones
+        # would even be connected, so only print what would be sent
+        self.sent_count += 1
+        print_structured_message(params).print()
+
+
+class ReplayTransactionManager(TransactionManager):
+    def __init__(self, transport):
+        TransactionManager.__init__(self, transport)
+
+        self.error_count = 0
+
+
+    def process_message(self, msg):
+        try:
+            TransactionManager.process_message(self, msg)
+        except Exception as e:
+            self.logger.info("Replayed message caused error: %s" % e)
+            self.error_count += 1
+
+
+class ReplaySubscriptionManager(SubscriptionManager):
+    def identify_subscription(self, request):
+        return None, None
+
+
+    def make_event_source(self, type):
+        return None
+
+
+class ReplaySwitch(Switch):
+    def __init__(self):
+        transport_manager = ReplayTransportManager()
+
+        Switch.__init__(
+            self,
+            transport_manager=transport_manager,
+            transaction_manager=ReplayTransactionManager(proxy(transport_manager)),
+            subscription_manager=ReplaySubscriptionManager(proxy(self))
+        )
+
+        self.error_count = 0
+
+
+    def auth_request(self, request):
+        return False
+
+
+    def process(self, msg):
+        try:
+            Switch.process(self, msg)
+        except Exception as e:
+            self.logger.info("Replayed message caused error: %s" % e)
+            self.error_count += 1
+
+
+    def get_error_count(self):
+        return self.error_count + self.transaction_manager.error_count
+
+
+class Replayer(Planned):
+    BATCH_SIZE = 100  # messages to feed between polls when not pacing
+
+    def __init__(self, transport_manager, records, is_paced=False):
+        Planned.__init__(self)
+
+        self.transport_manager = transport_manager
+        self.records = records
+        self.is_paced = is_paced
+
+        self.message_count = 0
+        self.invalid_count = 0
+        self.started = None
+        self.finished = None
+        self.is_finished = False
+
+
+    def feed(self, record):
+        try:
+            header, separator, rest = record.data.partition(b"\r\n\r\n")
+            message, content_length = HttpLikeMessage.parse(header)
+            message.body = rest[:content_length]
+        except Exception as e:
+            self.logger.error("Invalid captured message: %s!" % e)
+            self.invalid_count += 1
+        else:
+            self.message_count += 1
+            self.transport_manager.process_message(message, record.raddr, record.hop)
+
+
+    def plan(self):
+        self.started = time.time()
+        first_timestamp = None
+
+        for record in self.records:
+            if self.is_paced:
+                if first_timestamp is None:
+                    first_timestamp = record.timestamp
+
+                delay = self.started + (record.timestamp - first_timestamp) - time.time()
+
+                if delay > 0:
+                    yield from self.sleep(delay)
+            elif self.message_count % self.BATCH_SIZE == self.BATCH_SIZE - 1:
+                # Let the switch process the fed messages
+                yield from self.sleep(0)
+
+            self.feed(record)
+
+        yield from self.sleep(0)
+
+
+    def plan_finished(self, error):
+        if error:
+            self.logger.error("Replay aborted with: %s!" % error)
+
+        self.finished = time.time()
+        self.is_finished = True
+
+
+    def get_report(self):
+        duration = (self.finished or time.time()) - self.started
+
+        return "Replayed %d messages (%d invalid) in %.2fs, %.1f/s, %d sent" % (
+            self.message_count, self.invalid_count, duration,
+            self.message_count / duration if duration else 0,
+            self.transport_manager.sent_count
+        )
@@ -1,83 +1,719 @@
+import os
 import socket
-import multiprocessing
+import struct
+import random
+import secrets
+import time
+import collections
 
 from zap import Plug, EventSlot, kernel
 from log import Loggable, Oid
+from format import Addr
+from metrics import registry
+
+
+# A non-blocking DNS client on the main loop, so lookups run in parallel. The
+# results are cached until their TTL expires, and failed lookups too, until the
+# SOA minimum (RFC 2308). SIP hosts are resolved as in RFC 3263, through NAPTR
+# and SRV records, unless the URI has an explicit port. Only the records that
+# answer the question are cached, and every query is sent from a new socket with
+# a random ID, so spoofed responses have little to guess and nothing to poison.
+# Larger responses are asked for with EDNS0, and truncated ones are retried over
+# TCP. Names without dots are tried with the search domains of resolv.conf first.
+
+DNS_PORT = 53
+DNS_HEADER = struct.Struct("!HHHHHH")
+DNS_QUESTION = struct.Struct("!HH")
+DNS_RECORD = struct.Struct("!HHIH")
+DNS_SRV = struct.Struct("!HHH")
+DNS_NAPTR = struct.Struct("!HH")
+DNS_SOA = struct.Struct("!IIIII")
+DNS_TCP_LENGTH = struct.Struct("!H")
+EDNS_PAYLOAD_SIZE = 4096
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_SRV = 33
+TYPE_NAPTR = 35
+TYPE_OPT = 41
+CLASS_IN = 1
+
+FLAG_RD = 0x0100
+FLAG_TC = 0x0200
+RCODE_MASK = 0x000f
+RCODE_NXDOMAIN = 3
+
+TYPE_NAMES = { TYPE_A: "A", TYPE_SRV: "SRV", TYPE_NAPTR: "NAPTR" }
+
+# The NAPTR services and SRV prefixes of our transports, in order of preference
+SIP_PORT = 5060
+SIP_SERVICES = collections.OrderedDict([
+    ("UDP", ("SIP+D2U", "_sip._udp")),
+    ("TCP", ("SIP+D2T", "_sip._tcp"))
+])
+
+DNS_LOOKUPS = registry.counter("siplib_dns_lookups_total", "DNS lookups by record type and result.", ("type", "result"))
+
+SrvRecord = collections.namedtuple("SrvRecord", [ "priority", "weight", "port", "target" ])
+NaptrRecord = collections.namedtuple("NaptrRecord", [ "order", "preference", "flags", "service", "regexp", "replacement" ])
+
+
+class Error(Exception): pass
+
+
+def is_numeric(host):
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        return False
+
+    return True
+
+
+def read_resolv_conf(filename="/etc/resolv.conf"):
+    # The last domain or search line wins, like in the libc resolver
+    nameservers = []
+    search_domains = []
+
+    try:
+        for line in open(filename, "r").readlines():
+            fields = line.split()
+
+            if len(fields) >= 2 and fields[0] == "nameserver" and is_numeric(fields[1]):
+                nameservers.append(Addr(fields[1], DNS_PORT))
+            elif len(fields) >= 2 and fields[0] in ("domain", "search"):
+                search_domains = [ domain.lower().rstrip(".") for domain in fields[1:] ]
+    except OSError:
+        pass
+
+    return nameservers or [ Addr("127.0.0.1", DNS_PORT) ], search_domains
+
+
+def read_hosts(filename="/etc/hosts"):
+    addresses_by_name = {}
+
+    try:
+        for line in open(filename, "r").readlines():
+            fields = line.partition("#")[0].split()
+
+            if len(fields) >= 2 and is_numeric(fields[0]):
+                for name in fields[1:]:
+                    addresses_by_name.setdefault(name.lower(), fields[0])
+    except OSError:
+        pass
+
+    return addresses_by_name
+
+
+def print_name(name):
+    data = b""
+
+    for label in name.split("."):
+        try:
+            label = label.encode("ascii")
+        except UnicodeEncodeError:
+            raise Error("Invalid domain name: %r!" % name)
+
+        if not label or len(label) > 63:
+            raise Error("Invalid domain name: %r!" % name)
+
+        data += bytes((len(label),)) + label
+
+    return data + b"\0"
+
+
+def parse_name(data, offset):
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        length = data[offset]
+
+        if length & 0xc0 == 0xc0:
+            jumps += 1
+
+            if jumps > 16:
+                raise Error("Name compression loop!")
+
+            if end is None:
+                end = offset + 2
+
+            offset = (length & 0x3f) << 8 | data[offset + 1]
+        elif length:
+            labels.append(data[offset + 1:offset + 1 + length].decode("ascii"))
+            offset += 1 + length
+        else:
+            return ".".join(labels).lower(), end if end is not None else offset + 1
+
+
+def parse_character_string(data, offset):
+    length = data[offset]
+
+    return data[offset + 1:offset + 1 + length].decode("ascii"), offset + 1 + length
+
+
+def parse_rdata(data, offset, type):
+    if type == TYPE_A:
+        return socket.inet_ntoa(data[offset:offset + 4])
+    elif type == TYPE_CNAME:
+        return parse_name(data, offset)[0]
+    elif type == TYPE_SRV:
+        priority, weight, port = DNS_SRV.unpack_from(data, offset)
+        target, offset = parse_name(data, offset + DNS_SRV.size)
+
+        return SrvRecord(priority, weight, port, target)
+    elif type == TYPE_NAPTR:
+        order, preference = DNS_NAPTR.unpack_from(data, offset)
+        flags, offset = parse_character_string(data, offset + DNS_NAPTR.size)
+        service, offset = parse_character_string(data, offset)
+        regexp, offset = parse_character_string(data, offset)
+        replacement, offset = parse_name(data, offset)
+
+        return NaptrRecord(order, preference, flags.lower(), service.upper(), regexp, replacement)
+    elif type == TYPE_SOA:
+        mname, offset = parse_name(data, offset)
+        rname, offset = parse_name(data, offset)
+        serial, refresh, retry, expire, minimum = DNS_SOA.unpack_from(data, offset)
+
+        return minimum
+    else:
+        return None
+
+
+def print_query(id, name, type):
+    # With an OPT record for EDNS0, so that UDP responses may be larger than 512 bytes
+    question = print_name(name) + DNS_QUESTION.pack(type, CLASS_IN)
+    opt = b"\0" + DNS_RECORD.pack(TYPE_OPT, EDNS_PAYLOAD_SIZE, 0, 0)
+
+    return DNS_HEADER.pack(id, FLAG_RD, 1, 0, 0, 1) + question + opt
+
+
+def parse_records(data, offset, count):
+    records = []
+
+    for i in range(count):
+        name, offset = parse_name(data, offset)
+        type, klass, ttl, length = DNS_RECORD.unpack_from(data, offset)
+        offset += DNS_RECORD.size
+
+        if klass == CLASS_IN:
+            records.append((name, type, ttl, parse_rdata(data, offset, type)))
+
+        offset += length
+
+    return records, offset
+
+
+def parse_response(data):
+    # The answer, authority, and additional records are returned separately
+    try:
+        id, flags, qdcount, ancount, nscount, arcount = DNS_HEADER.unpack_from(data)
+        offset = DNS_HEADER.size
+        questions = []
+
+        for i in range(qdcount):
+            name, offset = parse_name(data, offset)
+            type, klass = DNS_QUESTION.unpack_from(data, offset)
+            offset += DNS_QUESTION.size
+            questions.append((name, type))
+
+        answers, offset = parse_records(data, offset, ancount)
+        authorities, offset = parse_records(data, offset, nscount)
+        additionals, offset = parse_records(data, offset, arcount)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise Error("Invalid DNS response: %s!" % e)
+
+    return id, questions, flags, (answers, authorities, additionals)
+
+
+def is_subdomain(name, domain):
+    return not domain or name == domain or name.endswith("." + domain)
+
+
+def order_srv_records(records):
+    # RFC 2782, by priority, then randomly by weight within each priority,
+    # a single dot as the target means the service is not available
+    ordered = []
+
+    for priority in sorted(set(r.priority for r in records)):
+        group = [ r for r in records if r.priority == priority and r.target ]
+
+        while group:
+            weights = [ r.weight for r in group ] if any(r.weight for r in group) else None
+            record = random.choices(group, weights)[0]
+            group.remove(record)
+            ordered.append(record)
+
+    return ordered
+
+
+class Query:
+    def __init__(self, name, type, qnames):
+        self.name = name
+        self.type = type
+        self.qnames = qnames
+        self.qname_index = 0
+        self.attempt = 0
+        self.is_tcp = False
+        self.id = None
+        self.nameserver = None
+        self.socket = None
+        self.socket_plug = None
+        self.timeout_plug = None
+        self.tcp_buffer = None
+
+
+    def get_qname(self):
+        return self.qnames[self.qname_index]
 
 
 class Resolver(Loggable):
+    TIMEOUT = 2
+    ATTEMPTS = 3
+    NEGATIVE_TTL = 300
+    MAX_TTL = 86400
+    MAX_CACHE_SIZE = 10000
+
     def __init__(self):
         Loggable.__init__(self)
-        
-        self.slots_by_hostname = {}
-        self.parent_pipe, self.child_pipe = multiprocessing.Pipe()
-        Plug(self.finish).attach_read(self.parent_pipe)
-        
-        self.resolver_process = multiprocessing.Process(target=self.resolver)
-        self.resolver_process.start()
-        
-        
-    def resolver(self):
-        # Don't log here, it's a background process
-        socket.setdefaulttimeout(5)
-        
-        try:
-            while True:
-                try:
-                    hostname = self.child_pipe.recv()
-                except EOFError:
-                    break
-                
-                try:
-                    address = socket.gethostbyname(hostname)
-                except OSError:
-                    address = None
-                
-                try:
-                    self.child_pipe.send((hostname, address))
-                except EOFError:
-                    break
-        except KeyboardInterrupt:
-            pass
-
-
-    def begin(self, hostname):
-        slot = self.slots_by_hostname.get(hostname)
-    
+
+        # Read only when first needed
+        self.nameservers = None
+        self.search_domains = None
+        self.addresses_by_host = None
+
+        self.cached_by_question = {}
+        self.slots_by_question = {}
+
+
+    def set_nameservers(self, nameservers):
+        self.nameservers = nameservers
+
+
+    def set_search_domains(self, search_domains):
+        self.search_domains = search_domains
+
+
+    def read_resolv_conf(self):
+        nameservers, search_domains = read_resolv_conf()
+
+        if self.nameservers is None:
+            self.nameservers = nameservers
+
+        if self.search_domains is None:
+            self.search_domains = search_domains
+
+
+    def get_qnames(self, name):
+        # Only single labels are searched, like with the default ndots of 1
+        if "." in name:
+            return [ name ]
+
+        if self.search_domains is None:
+            self.read_resolv_conf()
+
+        return [ "%s.%s" % (name, domain) for domain in self.search_domains ] + [ name ]
+
+
+    def set_hosts(self, addresses_by_host):
+        self.addresses_by_host = addresses_by_host
+
+
+    def get_cached(self, name, type):
+        if type == TYPE_A:
+            if is_numeric(name):
+                return [ name ]
+
+            if self.addresses_by_host is None:
+                self.addresses_by_host = read_hosts()
+
+            address = self.addresses_by_host.get(name)
+
+            if address:
+                return [ address ]
+
+        cached = self.cached_by_question.get((name, type))
+
+        if cached:
+            expiration, records = cached
+
+            if expiration > time.monotonic():
+                return records
+
+            self.cached_by_question.pop((name, type))
+
+        return None
+
+
+    def add_cached(self, name, type, records, ttl):
+        if ttl <= 0:
+            return
+
+        if len(self.cached_by_question) >= self.MAX_CACHE_SIZE:
+            now = time.monotonic()
+            self.cached_by_question = { k: v for k, v in self.cached_by_question.items() if v[0] > now }
+
+            if len(self.cached_by_question) >= self.MAX_CACHE_SIZE:
+                self.logger.warning("DNS cache full, flushing it!")
+                self.cached_by_question = {}
+
+        expiration = time.monotonic() + min(ttl, self.MAX_TTL)
+        self.cached_by_question[(name, type)] = (expiration, records)
+
+
+    def lookup(self, name, type):
+        """Returns a slot zapped with the list of records, empty on failure."""
+        name = name.lower().rstrip(".")
+        question = (name, type)
+        slot = self.slots_by_question.get(question)
+
         if slot:
-            self.logger.debug("Hostname '%s' is already being resolved." % hostname)
-        else:
-            self.logger.debug("Hostname '%s' will be resolved." % hostname)
-            slot = EventSlot()
-            self.slots_by_hostname[hostname] = slot
-            self.parent_pipe.send(hostname)
-        
+            self.logger.debug("Looking up %s %s is already in progress." % (TYPE_NAMES[type], name))
+            return slot
+
+        slot = EventSlot()
+        records = self.get_cached(name, type)
+
+        if records is not None:
+            DNS_LOOKUPS.labels(TYPE_NAMES[type], "cached").inc()
+            slot.zap(records)
+            return slot
+
+        self.logger.debug("Looking up %s %s." % (TYPE_NAMES[type], name))
+        self.slots_by_question[question] = slot
+        self.start_query(Query(name, type, self.get_qnames(name)))
+
         return slot
 
 
-    def finish(self):
-        hostname, address = self.parent_pipe.recv()
-        
-        if address:
-            self.logger.debug("Hostname '%s' was resolved to '%s'." % (hostname, address))
+    def start_query(self, query):
+        try:
+            self.send_query(query)
+        except Error as e:
+            self.logger.warning("Can't look up %s %s: %s" % (TYPE_NAMES[query.type], query.get_qname(), e))
+            self.finish(query.name, query.type, [], "failed")
+
+
+    def send_query(self, query):
+        # A new socket gets a new random source port from the kernel
+        if self.nameservers is None:
+            self.read_resolv_conf()
+
+        self.close_query(query)
+        query.id = secrets.randbelow(0x10000)
+        query.nameserver = self.nameservers[query.attempt % len(self.nameservers)]
+        query.attempt += 1
+        data = print_query(query.id, query.get_qname(), query.type)
+        query.timeout_plug = Plug(self.query_timed_out, query=query).attach_time(self.TIMEOUT)
+
+        if query.is_tcp:
+            query.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            query.socket.setblocking(False)
+            query.socket.connect_ex(query.nameserver)
+            query.tcp_buffer = bytearray(DNS_TCP_LENGTH.pack(len(data)) + data)
+            query.socket_plug = Plug(self.tcp_connected, query=query).attach_write(query.socket)
+        else:
+            query.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            query.socket.setblocking(False)
+            query.socket_plug = Plug(self.recved, query=query).attach_read(query.socket)
+
+            try:
+                query.socket.sendto(data, query.nameserver)
+            except OSError as e:
+                self.logger.warning("Couldn't send DNS query to %s: %s" % (query.nameserver, e))
+
+
+    def close_query(self, query):
+        if query.socket:
+            query.socket_plug.detach()
+            query.timeout_plug.detach()
+            query.socket.close()
+            query.socket = None
+
+
+    def query_timed_out(self, query):
+        self.query_failed(query, "timed out")
+
+
+    def query_failed(self, query, reason):
+        # Not cached, the next lookup may try again
+        if query.attempt < self.ATTEMPTS:
+            self.logger.debug("DNS query for %s %s %s, retrying." % (TYPE_NAMES[query.type], query.name, reason))
+            self.send_query(query)
+        else:
+            self.logger.warning("DNS query for %s %s %s!" % (TYPE_NAMES[query.type], query.name, reason))
+            self.close_query(query)
+            self.finish(query.name, query.type, [], "failed")
+
+
+    def recved(self, query):
+        while query.socket:
+            try:
+                data, addr = query.socket.recvfrom(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.logger.warning("DNS socket error: %s" % e)
+                continue
+
+            if addr != query.nameserver:
+                self.logger.warning("Ignoring DNS response from unknown address %s:%d!" % addr)
+                continue
+
+            self.response_recved(query, data)
+
+
+    def tcp_connected(self, query):
+        error = query.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error:
+            self.query_failed(query, "couldn't connect: %s" % os.strerror(error))
+            return
+
+        try:
+            sent = query.socket.send(query.tcp_buffer)
+        except OSError as e:
+            self.query_failed(query, "couldn't be sent: %s" % e)
+            return
+
+        del query.tcp_buffer[:sent]
+
+        if not query.tcp_buffer:
+            query.socket_plug.detach()
+            query.socket_plug = Plug(self.tcp_recved, query=query).attach_read(query.socket)
+
+
+    def tcp_recved(self, query):
+        try:
+            data = query.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.query_failed(query, "connection failed: %s" % e)
+            return
+
+        if not data:
+            self.query_failed(query, "connection closed")
+            return
+
+        query.tcp_buffer += data
+
+        if len(query.tcp_buffer) >= DNS_TCP_LENGTH.size:
+            length, = DNS_TCP_LENGTH.unpack_from(query.tcp_buffer)
+            end = DNS_TCP_LENGTH.size + length
+
+            if len(query.tcp_buffer) >= end:
+                self.response_recved(query, bytes(query.tcp_buffer[DNS_TCP_LENGTH.size:end]))
+
+
+    def response_recved(self, query, data):
+        try:
+            id, questions, flags, sections = parse_response(data)
+        except Error as e:
+            self.logger.warning("%s" % e)
+            return
+
+        if id != query.id or questions != [ (query.get_qname(), query.type) ]:
+            self.logger.debug("Ignoring unexpected DNS response.")
+            return
+
+        rcode = flags & RCODE_MASK
+
+        if flags & FLAG_TC and not query.is_tcp:
+            # Ask the same nameserver again, this is not a failed attempt
+            self.logger.debug("DNS response for %s %s truncated, retrying over TCP." % (TYPE_NAMES[query.type], query.get_qname()))
+            query.is_tcp = True
+            query.attempt -= 1
+            self.send_query(query)
+        elif rcode and rcode != RCODE_NXDOMAIN:
+            self.query_failed(query, "failed with rcode %d" % rcode)
+        else:
+            self.close_query(query)
+            self.query_answered(query, *sections)
+
+
+    def query_answered(self, query, answers, authorities, additionals):
+        # Only the CNAME chain of the queried name and its records are trusted,
+        # and the addresses of the SRV targets from the additional records
+        qname = query.get_qname()
+        name = qname
+        ttl = self.MAX_TTL
+
+        for i in range(8):
+            alias = next((r for r in answers if r[0] == name and r[1] == TYPE_CNAME), None)
+
+            if not alias:
+                break
+
+            name = alias[3]
+            ttl = min(ttl, alias[2])
+
+        found = [ r for r in answers if r[0] == name and r[1] == query.type ]
+
+        if found:
+            records = [ r[3] for r in found ]
+            self.add_cached(query.name, query.type, records, min([ ttl ] + [ r[2] for r in found ]))
+
+            if query.type == TYPE_SRV:
+                self.add_cached_targets(set(r.target for r in records), additionals)
+
+            self.finish(query.name, query.type, records, "resolved")
+        elif query.qname_index + 1 < len(query.qnames):
+            query.qname_index += 1
+            query.attempt = 0
+            query.is_tcp = False
+            self.start_query(query)
         else:
+            negative_ttl = self.NEGATIVE_TTL
+
+            for soa_name, type, soa_ttl, minimum in authorities:
+                if type == TYPE_SOA and is_subdomain(qname, soa_name):
+                    negative_ttl = min(soa_ttl, minimum, negative_ttl)
+
+            self.add_cached(query.name, query.type, [], negative_ttl)
+            self.finish(query.name, query.type, [], "missing")
+
+
+    def add_cached_targets(self, targets, additionals):
+        addresses_by_target = {}
+        ttls_by_target = {}
+
+        for name, type, ttl, address in additionals:
+            if type == TYPE_A and name in targets:
+                addresses_by_target.setdefault(name, []).append(address)
+                ttls_by_target[name] = min(ttl, ttls_by_target.get(name, ttl))
+
+        for target, addresses in addresses_by_target.items():
+            self.add_cached(target, TYPE_A, addresses, ttls_by_target[target])
+
+
+    def finish(self, name, type, records, result):
+        self.logger.debug("Looked up %s %s: %s." % (TYPE_NAMES[type], name, records or result))
+        DNS_LOOKUPS.labels(TYPE_NAMES[type], result).inc()
+        slot = self.slots_by_question.pop((name, type))
+        slot.zap(records)
+
+
+    def resolve(self, hostname):
+        """Returns a slot zapped with the first address of the hostname, or None."""
+        slot = EventSlot()
+        Plug(self.resolved, hostname=hostname, slot=slot).attach(self.lookup(hostname, TYPE_A))
+
+        return slot
+
+
+    def resolved(self, addresses, hostname, slot):
+        if not addresses:
             self.logger.warning("Hostname '%s' couldn't be resolved." % (hostname,))
-        
-        slot = self.slots_by_hostname.pop(hostname)
-        slot.zap(address)
+
+        slot.zap(addresses[0] if addresses else None)
+
+
+    def resolve_sip(self, host, port, transport):
+        """Returns a slot zapped with the address, port, and transport to use for a SIP URI."""
+        slot = EventSlot()
+        transport = transport.upper() if transport else None
+
+        if port or is_numeric(host) or (transport and transport not in SIP_SERVICES):
+            self.resolve_sip_address(host, port or SIP_PORT, transport or "UDP", slot)
+        elif transport:
+            self.lookup_sip_srv(host, [ transport ], transport, slot)
+        else:
+            Plug(self.sip_naptr_found, host=host, slot=slot).attach(self.lookup(host, TYPE_NAPTR))
+
+        return slot
+
+
+    def sip_naptr_found(self, records, host, slot):
+        # Only the terminal rules of our transports are used, without regexps
+        transports_by_service = { service: transport for transport, (service, prefix) in SIP_SERVICES.items() }
+
+        for record in sorted(records):
+            transport = transports_by_service.get(record.service)
+
+            if record.flags == "s" and transport:
+                self.logger.debug("SIP host %s uses %s via %s." % (host, transport, record.replacement))
+                Plug(self.sip_srv_found, host=host, transport=transport, transports=[], default_transport=transport, slot=slot).attach(
+                    self.lookup(record.replacement, TYPE_SRV)
+                )
+                return
+
+        self.lookup_sip_srv(host, list(SIP_SERVICES), "UDP", slot)
+
+
+    def lookup_sip_srv(self, host, transports, default_transport, slot):
+        transport = transports[0]
+        prefix = SIP_SERVICES[transport][1]
+
+        Plug(self.sip_srv_found, host=host, transport=transport, transports=transports[1:], default_transport=default_transport, slot=slot).attach(
+            self.lookup("%s.%s" % (prefix, host), TYPE_SRV)
+        )
+
+
+    def sip_srv_found(self, records, host, transport, transports, default_transport, slot):
+        # Without any SRV records the host itself is used with the default port
+        targets = order_srv_records(records)
+
+        if targets:
+            self.try_sip_targets(targets, transport, slot)
+        elif transports:
+            self.lookup_sip_srv(host, transports, default_transport, slot)
+        else:
+            self.resolve_sip_address(host, SIP_PORT, default_transport, slot)
+
+
+    def try_sip_targets(self, targets, transport, slot):
+        target = targets[0]
+
+        Plug(self.sip_target_resolved, targets=targets[1:], port=target.port, transport=transport, slot=slot).attach(
+            self.lookup(target.target, TYPE_A)
+        )
+
+
+    def sip_target_resolved(self, addresses, targets, port, transport, slot):
+        if addresses:
+            slot.zap(addresses[0], port, transport)
+        elif targets:
+            self.try_sip_targets(targets, transport, slot)
+        else:
+            slot.zap(None, None, None)
+
+
+    def resolve_sip_address(self, host, port, transport, slot):
+        Plug(self.sip_address_resolved, host=host, port=port, transport=transport, slot=slot).attach(
+            self.lookup(host, TYPE_A)
+        )
+
+
+    def sip_address_resolved(self, addresses, host, port, transport, slot):
+        if not addresses:
+            self.logger.warning("SIP host '%s' couldn't be resolved." % (host,))
+            slot.zap(None, None, None)
+        else:
+            slot.zap(addresses[0], port, transport)
 
 
 resolver = Resolver()
 resolver.set_oid(Oid("resolver"))
 
 
+def lookup_slot(name, type):
+    return resolver.lookup(name, type)
+
+
 def resolve_slot(hostname):
-    return resolver.begin(hostname)
+    return resolver.resolve(hostname)
+
+
+def resolve_sip_slot(host, port=None, transport=None):
+    return resolver.resolve_sip(host, port, transport)
 
 
 def wait_resolve(hostname, timeout=None):
     slot_index, slot_args = yield kernel.time_slot(timeout), resolve_slot(hostname)
-    
+
     if slot_index == 0:
         return None
     else:
@@ -1,3 +1,10 @@
+import sys
+import array
+import bisect
+import operator
+import functools
+import mmap
+import time
 import struct
 import wave
 import collections
@@ -8,6 +15,12 @@ from zap import EventSlot, Plug
 
 
 BYTES_PER_SAMPLE = 2
+FADE_BLOCK_SAMPLES = 40  # fades change the volume in 5ms steps at 8kHz
+GAIN_STEPS = 32  # volumes are rounded to 1/32, so that the gain tables can be reused
+
+RTP_HEADER = struct.Struct("!BBHII")  # version, marker and payload type, seq, timestamp, ssrc
+RTP_IDS = struct.Struct("!HII")  # seq, timestamp, ssrc at offset 2
+RTP_VERSION_BYTE = 2 << 6  # no padding, extension, or CSRC-s
 
 
 class Base(Loggable):
@@ -33,12 +46,39 @@ Format = collections.namedtuple("Format", [ "encoding", "clock", "encp", "fmtp"
 Packet = collections.namedtuple("Packet", [ "format", "timestamp", "marker", "payload" ])
 
 
-def read_wav(filename):
-    f = wave.open(filename, "rb")
-    x = f.readframes(f.getnframes())
-    f.close()
+def map_wav(filename):
+    # Only the header is read, the samples are paged in from the file on demand
+    with open(filename, "rb") as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+    if m[0:4] != b"RIFF" or m[8:12] != b"WAVE":
+        raise Error("Not a WAV file: %s!" % filename)
+        
+    offset = 12
+    has_format = False
     
-    return bytearray(x)  # Make it mutable
+    while offset + 8 <= len(m):
+        chunk_id, chunk_size = struct.unpack_from("<4sI", m, offset)
+        offset += 8
+        
+        if chunk_id == b"fmt ":
+            audio_format, channels, rate, byte_rate, block_align, bits = struct.unpack_from("<HHIIHH", m, offset)
+            
+            if audio_format != 1 or channels != 1 or bits != 16:
+                raise Error("Not a mono 16 bit PCM WAV file: %s!" % filename)
+                
+            has_format = True
+        elif chunk_id == b"data":
+            if not has_format:
+                raise Error("Missing format chunk in WAV file: %s!" % filename)
+                
+            size = min(chunk_size, len(m) - offset) // BYTES_PER_SAMPLE * BYTES_PER_SAMPLE
+            
+            return memoryview(m)[offset:offset + size].toreadonly()
+            
+        offset += chunk_size + (chunk_size & 1)
+        
+    raise Error("Missing data chunk in WAV file: %s!" % filename)
 
 
 def write_wav(filename, data1, data2 = None):
@@ -50,12 +90,7 @@ def write_wav(filename, data1, data2 = None):
         f.setnchannels(1)
         f.writeframes(data1)
     else:
-        n = min(len(data1), len(data2)) // 2
-        data = bytearray(2 * 2 * n)
-        
-        for i in range(n):
-            data[2 * 2 * i + 0 : 2 * 2 * i + 2] = data1[2 * i : 2 * i + 2]
-            data[2 * 2 * i + 2 : 2 * 2 * i + 4] = data2[2 * i : 2 * i + 2]
+        data = interleave_samples(data1, data2)
         
         f.setnchannels(2)
         f.writeframes(data)
@@ -63,11 +98,160 @@ def write_wav(filename, data1, data2 = None):
     f.close()
 
 
-def amplify_wav(samples, volume):
-    for i in range(int(len(samples) / BYTES_PER_SAMPLE)):
-        offset = i * BYTES_PER_SAMPLE
-        old = struct.unpack_from("<h", samples, offset)[0]
-        struct.pack_into('<h', samples, offset, int(volume * old))
+def interleave_samples(data1, data2):
+    # Copies whole samples with strided views, the byte order doesn't matter
+    n = min(len(data1), len(data2)) // BYTES_PER_SAMPLE
+    data = bytearray(2 * n * BYTES_PER_SAMPLE)
+    
+    if n:
+        view = memoryview(data).cast("H")
+        view[0::2] = memoryview(data1).cast("B")[:n * BYTES_PER_SAMPLE].cast("H")
+        view[1::2] = memoryview(data2).cast("B")[:n * BYTES_PER_SAMPLE].cast("H")
+    
+    return data
+
+
+class WavWriter:
+    # Writes the frames in larger chunks, the header is completed on closing
+    BUFFER_SIZE = 65536
+    
+    def __init__(self, filename, channels=1, rate=8000):
+        self.file = wave.open(filename, "wb")
+        self.file.setsampwidth(BYTES_PER_SAMPLE)
+        self.file.setframerate(rate)
+        self.file.setnchannels(channels)
+        
+        self.chunks = []
+        self.buffered_size = 0
+        
+        
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered_size += len(data)
+        
+        if self.buffered_size >= self.BUFFER_SIZE:
+            self.flush()
+            
+            
+    def flush(self):
+        if self.chunks:
+            self.file.writeframes(b"".join(self.chunks))
+            self.chunks = []
+            self.buffered_size = 0
+            
+            
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def get_gain_steps(volume):
+    return round(volume * GAIN_STEPS)
+
+
+def pack_lanes(values):
+    a = array.array("I", values)
+    
+    if sys.byteorder == "big":
+        a.byteswap()
+        
+    return int.from_bytes(a.tobytes(), "little")
+
+
+def unpack_lanes(number):
+    a = array.array("I")
+    a.frombytes(number.to_bytes(GAIN_LANE_COUNT * 4, "little"))
+    
+    if sys.byteorder == "big":
+        a.byteswap()
+        
+    return a
+
+
+def narrow_lanes(lanes):
+    # The low 16 bits of every lane, as signed samples
+    data = lanes.tobytes()
+    low = 0 if sys.byteorder == "little" else 2
+    narrowed = bytearray(len(data) // 2)
+    narrowed[0::2] = data[low::4]
+    narrowed[1::2] = data[low + 1::4]
+    
+    a = array.array("h")
+    a.frombytes(narrowed)
+    
+    return a
+
+
+# Every magnitude from 0 to 32768 in its own 32 bit lane of a big integer, so that
+# they can all be scaled at once by the C loops of the integer arithmetic
+GAIN_LANE_COUNT = 0x8001
+GAIN_SHIFT = GAIN_STEPS.bit_length() - 1
+SAMPLE_LANES = pack_lanes(range(GAIN_LANE_COUNT))
+SCALED_LANE_MASK = pack_lanes([ 0xffffffff >> GAIN_SHIFT ] * GAIN_LANE_COUNT)
+NEGATING_LANES = pack_lanes([ 0x10000 ] * GAIN_LANE_COUNT)
+
+
+@functools.lru_cache(maxsize=64)
+def make_gain_table(gain_steps):
+    # Scaled value of every sample, indexed by its unsigned short view. Built
+    # without a Python loop over the samples, because it runs on the main loop.
+    if not gain_steps:
+        return array.array("h", bytes(0x20000))
+        
+    magnitudes = unpack_lanes((SAMPLE_LANES * gain_steps >> GAIN_SHIFT) & SCALED_LANE_MASK)
+    
+    # Saturate the increasing magnitudes, positives only go up to 32767
+    positives = magnitudes[:0x8000]
+    clipped = bisect.bisect_right(positives, 32767)
+    positives[clipped:] = array.array("I", [ 32767 ]) * (len(positives) - clipped)
+    clipped = bisect.bisect_right(magnitudes, 32768)
+    magnitudes[clipped:] = array.array("I", [ 32768 ]) * (len(magnitudes) - clipped)
+    
+    # The low 16 bits of 0x10000 - m are -m, and the unsigned view runs backwards
+    negatives = unpack_lanes(NEGATING_LANES - pack_lanes(magnitudes))
+    
+    return narrow_lanes(positives) + narrow_lanes(negatives)[0x8000:0:-1]
+
+
+def lookup_gains(view, table):
+    return operator.itemgetter(*view)(table) if len(view) > 1 else [ table[u16] for u16 in view ]
+
+
+def amplify_wav(samples, volume, end_volume=None):
+    # Scales the samples in place, ramping linearly to end_volume if specified
+    gain_steps = get_gain_steps(volume)
+    end_gain_steps = get_gain_steps(end_volume) if end_volume is not None else gain_steps
+        
+    if gain_steps == GAIN_STEPS and end_gain_steps == GAIN_STEPS:
+        return
+        
+    n = len(samples) // BYTES_PER_SAMPLE
+    size = n * BYTES_PER_SAMPLE
+    
+    if not n:
+        return
+    elif gain_steps == 0 and end_gain_steps == 0:
+        samples[:size] = bytes(size)
+        return
+    elif gain_steps == end_gain_steps:
+        # Constant volumes are few, so the lookups can be done in C
+        view = g711.view_samples(samples)
+        a = array.array("h", lookup_gains(view, make_gain_table(gain_steps)))
+    else:
+        # Ramp in blocks, each looked up at the rounded volume of its middle
+        view = g711.view_samples(samples)
+        a = array.array("h")
+        
+        for start in range(0, n, FADE_BLOCK_SAMPLES):
+            block = view[start:start + FADE_BLOCK_SAMPLES]
+            middle = start + len(block) / 2
+            block_gain_steps = get_gain_steps(volume + (end_volume - volume) * middle / n)
+            a.extend(lookup_gains(block, make_gain_table(block_gain_steps)))
+    
+    if sys.byteorder == "big":
+        a.byteswap()
+        
+    samples[:size] = a.tobytes()
 
 
 def encode_samples(encoding, samples):
@@ -92,29 +276,27 @@ def decode_samples(encoding, payload):
     return samples
 
 
+def transcode_payload(old_encoding, new_encoding, payload):
+    if old_encoding == "PCMA" and new_encoding == "PCMU":
+        payload = g711.transcode_pcma_to_pcmu(payload)
+    elif old_encoding == "PCMU" and new_encoding == "PCMA":
+        payload = g711.transcode_pcmu_to_pcma(payload)
+    else:
+        raise Error("Can't transcode %s to %s!" % (old_encoding, new_encoding))
+        
+    return payload
+
+
 def build_rtp(ssrc, seq, timestamp, marker, payload_type, payload):
-    version = 2
-    padding = 0
-    extension = 0
-    csrc_count = 0
-    
-    packet = bytearray(12 + len(payload))
-    packet[0] = version << 6 | padding << 5 | extension << 4 | csrc_count
-    packet[1] = int(marker) << 7 | payload_type & 0x7f
-    struct.pack_into('!H', packet, 2, seq)
-    struct.pack_into('!I', packet, 4, timestamp)
-    struct.pack_into('!I', packet, 8, ssrc)
-    packet[12:] = payload
+    header = RTP_HEADER.pack(RTP_VERSION_BYTE, (0x80 if marker else 0) | payload_type & 0x7f, seq, timestamp, ssrc)
     
-    return packet
+    return bytearray(header + payload)
 
 
 def parse_rtp(packet):
     payload_type = packet[1] & 0x7f
     marker = bool(packet[1] & 0x80)
-    seq = struct.unpack_from("!H", packet, 2)[0]
-    timestamp = struct.unpack_from("!I", packet, 4)[0]
-    ssrc = struct.unpack_from("!I", packet, 8)[0]
+    seq, timestamp, ssrc = RTP_IDS.unpack_from(packet, 2)
     payload = packet[12:]
 
     return ssrc, seq, timestamp, marker, payload_type, payload
@@ -135,18 +317,166 @@ def parse_telephone_event(payload):
     return event, end, volume, duration
 
 
+RTCP_SR = 200
+RTCP_RR = 201
+RTCP_SDES = 202
+RTCP_BYE = 203
+
+NTP_EPOCH_OFFSET = 2208988800  # seconds from 1900 to 1970
+
+ReportBlock = collections.namedtuple("ReportBlock", [ "ssrc", "fraction_lost", "cumulative_lost", "highest_seq", "jitter", "lsr", "dlsr" ])
+SenderInfo = collections.namedtuple("SenderInfo", [ "ntp", "timestamp", "packet_count", "octet_count" ])
+
+
+def get_ntp_time():
+    # As a 64 bit fixed point number
+    return int((time.time() + NTP_EPOCH_OFFSET) * 0x100000000)
+    
+    
+def get_ntp_middle(ntp):
+    return (ntp >> 16) & 0xffffffff
+
+
+def build_rtcp_header(count, packet_type, length):
+    # The length is in 32 bit words, minus one
+    return struct.pack("!BBH", 2 << 6 | count, packet_type, length // 4 - 1)
+
+
+def build_report_blocks(report_blocks):
+    return b"".join(
+        struct.pack("!IIIIII", rb.ssrc, rb.fraction_lost << 24 | rb.cumulative_lost & 0xffffff, rb.highest_seq, rb.jitter, rb.lsr, rb.dlsr)
+        for rb in report_blocks
+    )
+
+
+def build_rtcp_sr(ssrc, sender_info, report_blocks):
+    si = sender_info
+    body = struct.pack("!IQIII", ssrc, si.ntp, si.timestamp, si.packet_count, si.octet_count) + build_report_blocks(report_blocks)
+    
+    return build_rtcp_header(len(report_blocks), RTCP_SR, 4 + len(body)) + body
+
+
+def build_rtcp_rr(ssrc, report_blocks):
+    body = struct.pack("!I", ssrc) + build_report_blocks(report_blocks)
+    
+    return build_rtcp_header(len(report_blocks), RTCP_RR, 4 + len(body)) + body
+    
+    
+def build_rtcp_sdes(ssrc, cname):
+    # A single chunk with a CNAME item, terminated and padded with zeroes
+    text = cname.encode("utf8")[:255]
+    chunk = struct.pack("!IBB", ssrc, 1, len(text)) + text
+    chunk += bytes(4 - len(chunk) % 4)
+    
+    return build_rtcp_header(1, RTCP_SDES, 4 + len(chunk)) + chunk
+
+
+def parse_rtcp(data):
+    # Returns the sender info and the report blocks of each report in a compound packet
+    reports = []
+    offset = 0
+    
+    while offset + 4 <= len(data):
+        first, packet_type, length = struct.unpack_from("!BBH", data, offset)
+        end = offset + (length + 1) * 4
+        count = first & 0x1f
+        
+        if first >> 6 != 2 or end > len(data):
+            raise Error("Invalid RTCP packet!")
+            
+        if packet_type in (RTCP_SR, RTCP_RR):
+            ssrc = struct.unpack_from("!I", data, offset + 4)[0]
+            block_offset = offset + 8
+            sender_info = None
+            
+            if packet_type == RTCP_SR:
+                sender_info = SenderInfo(*struct.unpack_from("!QIII", data, block_offset))
+                block_offset += 20
+                
+            report_blocks = []
+            
+            for i in range(count):
+                if block_offset + 24 > end:
+                    raise Error("Truncated RTCP report block!")
+                    
+                rb_ssrc, lost, highest_seq, jitter, lsr, dlsr = struct.unpack_from("!IIIIII", data, block_offset)
+                cumulative_lost = lost & 0xffffff
+                cumulative_lost -= 0x1000000 if cumulative_lost & 0x800000 else 0
+                report_blocks.append(ReportBlock(rb_ssrc, lost >> 24, cumulative_lost, highest_seq, jitter, lsr, dlsr))
+                block_offset += 24
+                
+            reports.append((ssrc, sender_info, report_blocks))
+            
+        offset = end
+        
+    return reports
+
+
+def estimate_mos(delay_ms, jitter_ms, loss_percent):
+    # A simplified E-model for G.711, the jitter counting as extra delay
+    effective_delay = delay_ms + 2 * jitter_ms + 10
+    
+    if effective_delay < 160:
+        r = 93.2 - effective_delay / 40
+    else:
+        r = 93.2 - (effective_delay - 120) / 10
+        
+    r -= 2.5 * loss_percent
+    
+    if r < 0:
+        return 1.0
+    elif r > 100:
+        return 4.5
+        
+    return 1 + 0.035 * r + 0.000007 * r * (r - 60) * (100 - r)
+
+
+class Announcement(Base):
+    # Decoded samples of a file shared by players, with the payloads of each frame
+    # encoded only once for every constant volume they are played at.
+    def __init__(self, samples):
+        Base.__init__(self)
+        
+        self.samples = samples
+        self.payloads_by_key = {}
+        
+        
+    def get_payload(self, format, volume, ptime_ms, index):
+        key = (format, get_gain_steps(volume), ptime_ms)
+        payloads = self.payloads_by_key.get(key)
+        
+        if payloads is None:
+            frame_size = self.ticks(ptime_ms, format.clock) * BYTES_PER_SAMPLE
+            payloads = [ None ] * ((len(self.samples) + frame_size - 1) // frame_size)
+            self.payloads_by_key[key] = payloads
+            
+        payload = payloads[index]
+        
+        if payload is None:
+            frame_size = self.ticks(ptime_ms, format.clock) * BYTES_PER_SAMPLE
+            samples = bytearray(self.samples[index * frame_size:(index + 1) * frame_size])
+            amplify_wav(samples, volume)
+            payload = bytes(encode_samples(format.encoding, samples))
+            payloads[index] = payload
+            
+        return payload
+
+
 class RtpProcessor(Base):
     pass
     
 
 class RtpPlayer(RtpProcessor):
-    def __init__(self, format, data, volume=1, fade=0, ptime_ms=20):
+    def __init__(self, format, data, volume=1, fade=0, ptime_ms=20, announcement=None, is_looping=False):
         RtpProcessor.__init__(self)
 
         self.packet_slot = EventSlot()
         self.timestamp = 0
+        self.offset = 0
         
-        self.data = data  # mono 16 bit LSB LPCM
+        self.data = data  # mono 16 bit LSB LPCM, possibly a read only memoryview
+        self.is_looping = is_looping
+        self.announcement = announcement
         self.ptime_ms = ptime_ms
         self.format = format
         
@@ -164,36 +494,56 @@ class RtpPlayer(RtpProcessor):
 
 
     def set_volume(self, volume, fade):
-        self.fade_steps = fade * 1000 // self.ptime_ms + 1
-        self.fade_step = (volume - self.volume) / self.fade_steps
+        self.fade_volume = volume
+        self.fade_steps = int(fade * 1000 // self.ptime_ms)
+        
+        if self.fade_steps:
+            self.fade_step = (volume - self.volume) / self.fade_steps
+        else:
+            self.volume = volume
         
 
     def play(self):
         timestamp = self.timestamp
         self.timestamp += self.ticks(self.ptime_ms, self.format.clock)
         
-        old_offset = timestamp * BYTES_PER_SAMPLE
-        new_offset = self.timestamp * BYTES_PER_SAMPLE
-        samples = self.data[old_offset:new_offset]
-        
-        if self.fade_steps:
-            self.fade_steps -= 1
-            self.volume += self.fade_step
+        # The timestamp keeps increasing while looping, but the offset restarts
+        old_offset = self.offset
+        new_offset = old_offset + (self.timestamp - timestamp) * BYTES_PER_SAMPLE
         
-        # TODO: resample? Must know the input clock, too!
-        amplify_wav(samples, self.volume)
+        if self.announcement and not self.fade_steps:
+            # Constant volume, the prepared payloads can be shared
+            index = old_offset // (new_offset - old_offset)
+            payload = self.announcement.get_payload(self.format, self.volume, self.ptime_ms, index)
+        else:
+            samples = bytearray(self.data[old_offset:new_offset])
+            start_volume = self.volume
+            
+            if self.fade_steps:
+                self.fade_steps -= 1
+                self.volume = self.volume + self.fade_step if self.fade_steps else self.fade_volume
+            
+            # TODO: resample? Must know the input clock, too!
+            amplify_wav(samples, start_volume, self.volume)
 
-        payload = encode_samples(self.format.encoding, samples)
+            payload = encode_samples(self.format.encoding, samples)
             
         packet = Packet(self.format, timestamp, True, payload)
         #packet = build_rtp(self.ssrc, self.base_seq + seq, self.base_timestamp + timestamp, 127, payload)
         self.packet_slot.zap(packet)
         
-        if new_offset >= len(self.data):
+        if new_offset < len(self.data):
+            self.offset = new_offset
+        elif self.is_looping:
+            self.offset = 0
+        else:
             self.play_plug.detach()
 
 
 class RtpRecorder(RtpProcessor):
+    REORDER_WINDOW = 5  # frames to wait for packets arriving out of order
+    MAX_GAP_MS = 5000  # longer timestamp jumps are not filled with silence
+    
     def __init__(self, format, ptime_ms=20):
         RtpProcessor.__init__(self)
         
@@ -206,38 +556,65 @@ class RtpRecorder(RtpProcessor):
             raise Error("Unknown encoding for recording: %s" % (format.encoding,))
         
         self.format = format
+        self.silence = bytes(self.ticks(self.ptime_ms, self.format.clock) * BYTES_PER_SAMPLE)
         
-        self.chunks = []  # mono 16 bit LSB LPCM
+        self.next_index = 0
+        self.pending_chunks = {}
+        self.chunks = []  # mono 16 bit LSB LPCM, completed but not yet taken
         
         
     def record_packet(self, packet):
         if self.base_ms is None:
-            self.base_ms = self.msecs(packet.timestamp, packet.format.clock)
+            # Continue after the silence possibly completed so far
+            self.base_ms = self.msecs(packet.timestamp, packet.format.clock) - self.next_index * self.ptime_ms
             
         rec_time_ms = self.msecs(packet.timestamp, packet.format.clock) - self.base_ms
-        if rec_time_ms < 0:
-            return  # Oops, started recording later!
-        
         rec_index = rec_time_ms // self.ptime_ms
         #self.logger.info("Recording chunk %d" % n)
+        
+        gap = rec_index - self.next_index
+        
+        if abs(gap) * self.ptime_ms > self.MAX_GAP_MS:
+            # A discontinuity, so continue right after the chunks recorded so far
+            self.logger.warning("Timestamp jump of %d ms in recording, resyncing." % (gap * self.ptime_ms))
+            self.finish()
+            self.base_ms += (rec_index - self.next_index) * self.ptime_ms
+            rec_index = self.next_index
+        
+        if rec_index < self.next_index:
+            self.logger.debug("Dropping packet arrived too late for recording.")
+            return
 
         samples = decode_samples(packet.format.encoding, packet.payload)
         
         if packet.format.clock != self.format.clock:
             pass  # resample!
         
-        while rec_index >= len(self.chunks):
-            self.chunks.append(None)
+        self.pending_chunks[rec_index] = samples
+        self.complete(rec_index - self.REORDER_WINDOW + 1)
+        
+        
+    def complete(self, index):
+        # Missing chunks before this index won't arrive anymore
+        while self.next_index < index:
+            self.chunks.append(self.pending_chunks.pop(self.next_index, None) or self.silence)
+            self.next_index += 1
+            
+            
+    def finish(self):
+        if self.pending_chunks:
+            self.complete(max(self.pending_chunks) + 1)
             
-        self.chunks[rec_index] = samples
         
+    def get_length(self):
+        return self.next_index
         
-    def get(self):
-        silence = bytes(self.ticks(self.ptime_ms, self.format.clock) * BYTES_PER_SAMPLE)
         
-        samples = b"".join(chunk or silence for chunk in self.chunks)
-
-        return samples
+    def take(self, count):
+        chunks = self.chunks[:count]
+        self.chunks = self.chunks[count:]
+        
+        return b"".join(chunks)
 
 
 class DtmfBase(Base):
@@ -346,36 +723,282 @@ class RtpBuilder:
         self.last_seq = 0  # TODO: generate
         self.base_timestamp = 0  # TODO: generate
         self.payload_types_by_format = {}
+        self.last_format = None
+        self.last_payload_type = None
+        
+        self.packet_count = 0
+        self.octet_count = 0
+        self.last_timestamp = None
+        self.last_clock = None
+        self.last_time = None
         
         
     def set_payload_types_by_format(self, ptbf):
         self.payload_types_by_format = ptbf
+        self.last_format = None
+        self.last_payload_type = None
         
         
     def build(self, packet):
-        payload_type = self.payload_types_by_format.get(packet.format)
+        # A stream mostly sends the same format, whose identity is cheaper to
+        # check than hashing it again. Returns bytes, valid to send right away.
+        format = packet.format
+        
+        if format is self.last_format:
+            payload_type = self.last_payload_type
+        else:
+            payload_type = self.payload_types_by_format.get(format)
+            if payload_type is None:
+                return None
+                
+            self.last_format = format
+            self.last_payload_type = payload_type
+            
+        self.last_seq = seq = (self.last_seq + 1) & 0xffff
+        timestamp = (packet.timestamp + self.base_timestamp) & 0xffffffff
+        marker_payload_type = (0x80 if packet.marker else 0) | payload_type & 0x7f
+        payload = packet.payload
+        
+        udp = RTP_HEADER.pack(RTP_VERSION_BYTE, marker_payload_type, seq, timestamp, self.ssrc) + payload
+        
+        self.packet_count += 1
+        self.octet_count += len(payload)
+        self.last_timestamp = timestamp
+        self.last_clock = format.clock
+        self.last_time = time.time()
+        
+        return udp
+        
+        
+    def rewrite(self, udp, format, timestamp):
+        # Turns a received packet into ours in place, keeping the marker bit
+        payload_type = self.payload_types_by_format.get(format)
         if payload_type is None:
-            print("No payload for %s: %s" % (packet.format, self.payload_types_by_format))
+            return False
+            
+        self.last_seq = (self.last_seq + 1) & 0xffff
+        timestamp = (timestamp + self.base_timestamp) & 0xffffffff
+        
+        udp[1] = udp[1] & 0x80 | payload_type & 0x7f
+        RTP_IDS.pack_into(udp, 2, self.last_seq, timestamp, self.ssrc)
+        
+        self.packet_count += 1
+        self.octet_count += len(udp) - 12
+        self.last_timestamp = timestamp
+        self.last_clock = format.clock
+        self.last_time = time.time()
+        
+        return True
+        
+        
+    def get_sender_info(self, ntp):
+        # Extrapolate the RTP timestamp to the time of the report
+        if self.last_timestamp is None:
             return None
             
-        self.last_seq += 1
+        elapsed = ntp / 0x100000000 - NTP_EPOCH_OFFSET - self.last_time
+        timestamp = (self.last_timestamp + int(elapsed * self.last_clock)) & 0xffffffff
         
-        udp = build_rtp(self.ssrc, self.last_seq, packet.timestamp + self.base_timestamp, packet.marker, payload_type, packet.payload)
+        return SenderInfo(ntp, timestamp, self.packet_count & 0xffffffff, self.octet_count & 0xffffffff)
+
+
+class JitterBuffer:
+    # Releases packets in sequence order, holding the ones after a gap until the
+    # missing ones arrive, or until more than depth packets follow them. The depth
+    # grows whenever a packet arrives after its gap was skipped, and shrinks back
+    # after a period without such late packets.
+    ADAPT_PACKETS = 500
+    
+    def __init__(self, min_depth=1, max_depth=10):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth = min_depth
         
-        return udp
+        self.next_seq = None
+        self.highest_seq = None
+        self.packets_by_seq = {}
+        self.skipped_seqs = set()
+        self.quiet_count = 0
+        self.late_count = 0
+        self.duplicate_count = 0
+        
+        
+    def set_depth(self, min_depth, max_depth):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth = min(max(self.depth, min_depth), max_depth)
+        
+        
+    def push(self, seq, packet):
+        if self.next_seq is None:
+            self.next_seq = seq
+            self.highest_seq = seq
+        elif seq < self.next_seq:
+            if seq in self.skipped_seqs:
+                self.skipped_seqs.remove(seq)
+                self.late_count += 1
+                self.quiet_count = 0
+                self.depth = min(self.depth + 1, self.max_depth)
+            else:
+                self.duplicate_count += 1
+                
+            return []
+        elif seq in self.packets_by_seq:
+            self.duplicate_count += 1
+            return []
+            
+        self.packets_by_seq[seq] = packet
+        self.highest_seq = max(self.highest_seq, seq)
+        
+        self.quiet_count += 1
+        if self.quiet_count >= self.ADAPT_PACKETS:
+            self.quiet_count = 0
+            self.depth = max(self.depth - 1, self.min_depth)
+            
+        packets = []
+        
+        while self.packets_by_seq:
+            packet = self.packets_by_seq.pop(self.next_seq, None)
+            
+            if packet:
+                packets.append(packet)
+            elif self.highest_seq - self.next_seq <= self.depth:
+                break
+            else:
+                self.skipped_seqs.add(self.next_seq)
+                
+            self.next_seq += 1
+            
+        if len(self.skipped_seqs) > 256:
+            self.skipped_seqs = { seq for seq in self.skipped_seqs if seq > self.next_seq - 256 }
+            
+        return packets
+        
+        
+    def pass_by(self, seq):
+        # Account for a packet not stored, while nothing is held back
+        if self.next_seq is None or seq >= self.next_seq:
+            self.next_seq = seq + 1
+            self.highest_seq = seq
+            
+            
+    def flush(self):
+        packets = [ self.packets_by_seq[seq] for seq in sorted(self.packets_by_seq) ]
+        
+        self.packets_by_seq = {}
+        self.skipped_seqs = set()
+        self.next_seq = None
+        self.highest_seq = None
+        
+        return packets
 
 
 class RtpParser:
+    MAX_DROPOUT = 3000
+    MAX_MISORDER = 100
+    
     def __init__(self):
-        self.last_seq = None
+        self.ssrc = None
+        self.cycles = 0
+        self.max_seq = None
+        self.base_seq = None
         self.base_timestamp = None
+        self.last_timestamp = None
         self.formats_by_payload_type = {}
+        self.jitter_buffer = JitterBuffer()
+        
+        self.received_count = 0
+        self.transit = None
+        self.jitter = 0.0  # in timestamp units, as in RFC 3550
+        self.jitter_clock = None
+        
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.last_sr_ntp_middle = 0
+        self.last_sr_time = None
         
         
     def set_formats_by_payload_type(self, fbpt):
         self.formats_by_payload_type = fbpt
         
         
+    def restart(self, ssrc, seq, timestamp):
+        # The new stream continues from the last relative timestamp of the old one
+        if self.last_timestamp is not None:
+            self.base_timestamp = (timestamp - (self.last_timestamp - self.base_timestamp)) & 0xffffffff
+            
+        self.ssrc = ssrc
+        self.cycles = 0
+        self.max_seq = seq
+        self.base_seq = seq
+        self.received_count = 0
+        self.transit = None
+        self.jitter = 0.0
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.last_sr_ntp_middle = 0
+        self.last_sr_time = None
+        
+        
+    def extend_seq(self, seq):
+        # Returns the 32 bit extended sequence number, or None to restart
+        delta = (seq - self.max_seq) & 0xffff
+        
+        if delta < self.MAX_DROPOUT:
+            if seq < self.max_seq:
+                self.cycles += 0x10000
+                
+            self.max_seq = seq
+            
+            return self.cycles + seq
+        elif delta >= 0x10000 - self.MAX_MISORDER:
+            return self.cycles + seq - (0x10000 if seq > self.max_seq else 0)
+        else:
+            return None
+            
+            
+    def update_jitter(self, timestamp, clock):
+        # Interarrival jitter, with the arrival time in timestamp units
+        if clock != self.jitter_clock:
+            self.jitter_clock = clock
+            self.transit = None
+            
+        transit = int(time.time() * clock) - timestamp
+        
+        if self.transit is not None:
+            d = abs(transit - self.transit)
+            self.jitter += (d - self.jitter) / 16
+            
+        self.transit = transit
+        
+        
+    def receive(self, ssrc, seq, timestamp, format):
+        # Returns the extended sequence number, and the packets flushed by a restart
+        packets = []
+        
+        if ssrc != self.ssrc:
+            packets.extend(self.jitter_buffer.flush())
+            self.restart(ssrc, seq, timestamp)
+            
+        extended_seq = self.extend_seq(seq)
+        
+        if extended_seq is None:
+            # A jump too far to be a loss, the sender must have restarted
+            packets.extend(self.jitter_buffer.flush())
+            self.restart(ssrc, seq, timestamp)
+            extended_seq = seq
+            
+        self.received_count += 1
+        self.update_jitter(timestamp, format.clock)
+            
+        if self.base_timestamp is None:
+            self.base_timestamp = timestamp
+            
+        self.last_timestamp = timestamp
+            
+        return extended_seq, packets
+        
+        
     def parse(self, udp):
         ssrc, seq, timestamp, marker, payload_type, payload = parse_rtp(udp)
         
@@ -383,14 +1006,78 @@ class RtpParser:
         if format is None:
             return None
             
-        if self.last_seq is not None and seq < self.last_seq:
+        extended_seq, packets = self.receive(ssrc, seq, timestamp, format)
+            
+        packet = Packet(format, (timestamp - self.base_timestamp) & 0xffffffff, marker, payload)
+        packets.extend(self.jitter_buffer.push(extended_seq, packet))
+        
+        return packets
+        
+        
+    def relay(self, udp, send_formats):
+        # Like parse, but for packets passed on as they are, bypassing the jitter
+        # buffer, which the receiver of the relayed packets has anyway. Returns the
+        # format and relative timestamp if possible, or None for the full path.
+        format = self.formats_by_payload_type.get(udp[1] & 0x7f)
+        
+        if format is None or format not in send_formats or format.encoding == "telephone-event":
             return None
             
-        self.last_seq = seq
+        if self.jitter_buffer.packets_by_seq:
+            return None
             
-        if self.base_timestamp is None:
-            self.base_timestamp = timestamp
+        seq, timestamp, ssrc = RTP_IDS.unpack_from(udp, 2)
+        extended_seq, packets = self.receive(ssrc, seq, timestamp, format)
+        self.jitter_buffer.pass_by(extended_seq)
+        
+        return format, (timestamp - self.base_timestamp) & 0xffffffff
+        
+        
+    def get_expected_count(self):
+        return self.cycles + self.max_seq - self.base_seq + 1
+        
+        
+    def record_sender_report(self, ssrc, sender_info):
+        if ssrc == self.ssrc:
+            self.last_sr_ntp_middle = get_ntp_middle(sender_info.ntp)
+            self.last_sr_time = time.time()
+            
+            
+    def make_report_block(self):
+        # Also starts a new reporting interval for the fraction lost
+        if self.max_seq is None:
+            return None
+            
+        expected = self.get_expected_count()
+        expected_interval = expected - self.expected_prior
+        received_interval = self.received_count - self.received_prior
+        lost_interval = expected_interval - received_interval
+        self.expected_prior = expected
+        self.received_prior = self.received_count
+        
+        fraction_lost = min((lost_interval << 8) // expected_interval, 255) if expected_interval and lost_interval > 0 else 0
+        cumulative_lost = min(max(expected - self.received_count, -0x800000), 0x7fffff)
+        dlsr = int((time.time() - self.last_sr_time) * 65536) if self.last_sr_time else 0
+        
+        return ReportBlock(
+            self.ssrc, fraction_lost, cumulative_lost, (self.cycles + self.max_seq) & 0xffffffff,
+            int(self.jitter), self.last_sr_ntp_middle, dlsr
+        )
+        
+        
+    def get_statistics(self):
+        if self.max_seq is None:
+            return None
             
-        packet = Packet(format, timestamp - self.base_timestamp, marker, payload)
+        expected = self.get_expected_count()
         
-        return packet
+        return dict(
+            ssrc=self.ssrc,
+            received=self.received_count,
+            expected=expected,
+            lost=max(expected - self.received_count, 0),
+            late=self.jitter_buffer.late_count,
+            duplicate=self.jitter_buffer.duplicate_count,
+            jitter_ms=self.jitter * 1000 / self.jitter_clock if self.jitter_clock else 0,
+            depth=self.jitter_buffer.depth
+        )
@@ -0,0 +1,58 @@
+import struct
+import unittest
+
+import g711
+
+
+# The per sample codecs the frame codecs replaced, as the reference
+def encode_samples(x, encode_sample):
+    return bytearray(encode_sample(struct.unpack_from("<h", x, 2 * i)[0]) for i in range(len(x) // 2))
+
+
+def decode_codes(x, decode_sample):
+    y = bytearray(2 * len(x))
+
+    for i in range(len(x)):
+        struct.pack_into("<h", y, 2 * i, decode_sample(x[i]))
+
+    return y
+
+
+ALL_SAMPLES = struct.pack("<65536h", *range(-32768, 32768))
+ALL_CODES = bytes(range(256))
+
+
+class TestG711(unittest.TestCase):
+    def test_encoding_every_sample_is_bit_exact(self):
+        self.assertEqual(g711.encode_pcmu(ALL_SAMPLES), encode_samples(ALL_SAMPLES, g711.encode_pcmu_sample))
+        self.assertEqual(g711.encode_pcma(ALL_SAMPLES), encode_samples(ALL_SAMPLES, g711.encode_pcma_sample))
+
+
+    def test_decoding_every_code_is_bit_exact(self):
+        self.assertEqual(g711.decode_pcmu(ALL_CODES), decode_codes(ALL_CODES, g711.decode_pcmu_sample))
+        self.assertEqual(g711.decode_pcma(ALL_CODES), decode_codes(ALL_CODES, g711.decode_pcma_sample))
+
+
+    def test_transcoding_every_code_is_bit_exact(self):
+        pcmu = encode_samples(decode_codes(ALL_CODES, g711.decode_pcma_sample), g711.encode_pcmu_sample)
+        pcma = encode_samples(decode_codes(ALL_CODES, g711.decode_pcmu_sample), g711.encode_pcma_sample)
+
+        self.assertEqual(g711.transcode_pcma_to_pcmu(ALL_CODES), pcmu)
+        self.assertEqual(g711.transcode_pcmu_to_pcma(ALL_CODES), pcma)
+
+
+    def test_single_sample_frames(self):
+        self.assertEqual(g711.encode_pcma(ALL_SAMPLES[:2]), encode_samples(ALL_SAMPLES[:2], g711.encode_pcma_sample))
+        self.assertEqual(g711.decode_pcmu(ALL_CODES[:1]), decode_codes(ALL_CODES[:1], g711.decode_pcmu_sample))
+
+
+    def test_memoryviews_are_accepted(self):
+        view = memoryview(bytearray(ALL_CODES))
+
+        self.assertEqual(g711.decode_pcma(view), g711.decode_pcma(ALL_CODES))
+        self.assertEqual(g711.transcode_pcmu_to_pcma(view), g711.transcode_pcmu_to_pcma(ALL_CODES))
+        self.assertEqual(g711.encode_pcmu(memoryview(ALL_SAMPLES)), g711.encode_pcmu(ALL_SAMPLES))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from format import Addr
+from log import Oid
+from mgc import Controller
+
+
+MGW_A = Addr("127.0.0.1", 20901)
+MGW_B = Addr("127.0.0.1", 20902)
+
+
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.mgc = Controller()
+        self.mgc.set_oid(Oid("mgc"))
+        self.mgc.add_mgw_addr(MGW_A, Addr("127.0.0.1", 40000), 100)
+        self.mgc.add_mgw_addr(MGW_B, Addr("127.0.0.1", 41000), 100)
+        self.mgc.status_changed("mgw-a-1", MGW_A)
+        self.mgc.status_changed("mgw-b-1", MGW_B)
+        
+        
+    def test_restarted_gateway_replaces_its_old_session(self):
+        self.mgc.status_changed("mgw-a-1", None)
+        self.mgc.status_changed("mgw-a-2", MGW_A)
+        
+        self.assertEqual(self.mgc.count_gateways(), 2)
+        self.assertEqual(set(self.mgc.gateways_by_sid), { "mgw-a-2", "mgw-b-1" })
+        
+        
+    def test_calls_on_the_old_session_fail_over(self):
+        self.mgc.status_changed("mgw-a-1", None)
+        self.mgc.status_changed("mgw-a-2", MGW_A)
+        
+        self.assertIn(self.mgc.select_gateway_sid("rtp", "mgw-a-1"), ("mgw-a-2", "mgw-b-1"))
+        
+        
+if __name__ == "__main__":
+    unittest.main()
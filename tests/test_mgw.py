@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import signal
+import unittest
+
+from format import Addr
+from log import Oid
+from mgw import MediaGatewaySupervisor, MediaGatewayWorker, MEDIA_PORTS_FREE, RTP_PACKETS, RTP_BYTES
+from zap import loop
+
+
+MGW_ADDR = Addr("127.0.0.1", 20911)
+FIRST_MEDIA_ADDR = Addr("127.0.0.1", 42000)
+
+
+def close_supervisor(supervisor):
+    # Nothing may be left polled for the tests that run the loop after us
+    supervisor.load_plug.detach()
+    supervisor.msgp.listener.incoming_plug.detach()
+    supervisor.msgp.listener.socket.close()
+
+
+class TestSupervisorMetrics(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = MediaGatewaySupervisor(MGW_ADDR, 2)
+        self.supervisor.set_oid(Oid("mgw"))
+        self.supervisor.open_port_pool(FIRST_MEDIA_ADDR, 4)
+
+
+    def tearDown(self):
+        for pair in self.supervisor.port_pool.pairs_by_addr.values():
+            for sock in pair:
+                sock.close()
+
+        close_supervisor(self.supervisor)
+
+
+    def test_free_ports_are_counted_once_for_all_workers(self):
+        self.supervisor.loads = [ dict(ports_taken=1), dict(ports_taken=2) ]
+
+        self.assertEqual(MEDIA_PORTS_FREE.collect()[(self.supervisor.oid,)], 1)
+
+
+    def test_workers_export_no_free_ports_of_their_own(self):
+        parent_pipe, child_pipe = multiprocessing.Pipe()
+        worker = MediaGatewayWorker(child_pipe)
+        worker.set_oid(Oid("mgw").add("worker", "0"))
+        worker.set_port_pool(self.supervisor.port_pool)
+
+        self.assertNotIn((worker.oid,), MEDIA_PORTS_FREE.collect())
+
+        worker.finish()
+        parent_pipe.close()
+        child_pipe.close()
+
+
+    def test_worker_rtp_counts_are_added_up(self):
+        packets = RTP_PACKETS.labels(self.supervisor.oid, "sent")
+        bytes = RTP_BYTES.labels(self.supervisor.oid, "sent")
+        started = packets.value, bytes.value
+        loads = [
+            dict(rtp_counts=dict(sent=(10, 1720)), ports_exhausted=0),
+            dict(rtp_counts=dict(sent=(15, 2580)), ports_exhausted=0),
+            dict(rtp_counts=dict(sent=(3, 516)), ports_exhausted=1)
+        ]
+
+        # From two workers
+        self.supervisor.add_worker_counts(None, loads[0])
+        self.supervisor.add_worker_counts(loads[0], loads[1])
+        self.supervisor.add_worker_counts(None, loads[2])
+
+        self.assertEqual((packets.value - started[0], bytes.value - started[1]), (18, 3096))
+
+
+class TestSupervisorWorkers(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = MediaGatewaySupervisor(Addr("127.0.0.1", 20912), 2)
+        self.supervisor.set_oid(Oid("mgw"))
+        self.supervisor.start()
+        self.responses = {}
+        self.supervisor.msgp.send_response = self.responded
+
+
+    def tearDown(self):
+        self.supervisor.stop()
+        close_supervisor(self.supervisor)
+
+
+    def responded(self, source, body):
+        self.responses[source] = body
+
+
+    def request(self, seq, target, **params):
+        source = ("mgc", seq)
+        self.supervisor.process_request(target, params, source)
+        loop(until=lambda: source in self.responses)
+
+        return self.responses[source]
+
+
+    def test_dead_worker_gets_no_new_contexts(self):
+        self.assertEqual(self.request(1, "create_thing", label="sw/a/echo", type="echo"), "ok")
+        dead_index = self.supervisor.find_worker("sw/a/echo")
+
+        os.kill(self.supervisor.processes[dead_index].pid, signal.SIGKILL)
+        loop(until=lambda: dead_index in self.supervisor.dead_workers)
+
+        # Its old context fails, the new ones go to the live worker
+        self.assertEqual(self.request(2, "modify_thing", label="sw/a/echo"), "error")
+        self.assertEqual(self.request(3, "delete_thing", label="sw/a/echo"), "error")
+
+        for i in range(3):
+            self.assertEqual(self.request(4 + i, "create_thing", label="sw/b%d/echo" % i, type="echo"), "ok")
+            self.assertNotEqual(self.supervisor.find_worker("sw/b%d/echo" % i), dead_index)
+
+
+    def test_request_to_a_dying_worker_is_answered(self):
+        self.assertEqual(self.request(1, "create_thing", label="sw/a/echo", type="echo"), "ok")
+        dead_index = self.supervisor.find_worker("sw/a/echo")
+        process = self.supervisor.processes[dead_index]
+
+        # Not noticed by the supervisor yet
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+        self.assertEqual(self.request(2, "modify_thing", label="sw/a/echo"), "error")
+        self.assertIn(dead_index, self.supervisor.dead_workers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import types
+import unittest
+
+from log import Oid
+from msgp import MsgpPeer, MSGP_QUEUE_DEPTH
+
+
+def fake_stream(unacked, unresponded, held):
+    return types.SimpleNamespace(
+        unacked_items_by_seq=dict.fromkeys(range(unacked)),
+        unresponded_items_by_seq=dict.fromkeys(range(unresponded)),
+        held_seqs=set(range(held))
+    )
+
+
+class TestQueueDepth(unittest.TestCase):
+    def test_dispatchers_are_measured_separately(self):
+        a = MsgpPeer(None)
+        a.set_oid(Oid("mgc").add("msgp"))
+        a.streams_by_name["x"] = fake_stream(2, 1, 0)
+        b = MsgpPeer(None)
+        b.set_oid(Oid("mgw").add("msgp"))
+        b.streams_by_name["y"] = fake_stream(0, 3, 1)
+        
+        depths = MSGP_QUEUE_DEPTH.collect()
+        
+        self.assertEqual(depths[(a.oid, "unacked")], 2)
+        self.assertEqual(depths[(a.oid, "unresponded")], 1)
+        self.assertEqual(depths[(b.oid, "unresponded")], 3)
+        self.assertEqual(depths[(b.oid, "held")], 1)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
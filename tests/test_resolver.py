@@ -0,0 +1,255 @@
+import socket
+import struct
+import unittest
+from unittest import mock
+
+from format import Addr
+from resolver import Resolver, read_resolv_conf, parse_name, print_name, TYPE_A, TYPE_CNAME, TYPE_SRV, TYPE_NAPTR
+from zap import Plug, loop, run_scheduled_tasks
+import resolver
+
+
+def record(name, type, ttl, rdata):
+    return print_name(name) + struct.pack("!HHIH", type, 1, ttl, len(rdata)) + rdata
+
+
+def a_record(name, address, ttl=60):
+    return record(name, TYPE_A, ttl, socket.inet_aton(address))
+
+
+def cname_record(name, alias, ttl=60):
+    return record(name, TYPE_CNAME, ttl, print_name(alias))
+
+
+def srv_record(name, priority, weight, port, target, ttl=60):
+    return record(name, TYPE_SRV, ttl, struct.pack("!HHH", priority, weight, port) + print_name(target))
+
+
+def naptr_record(name, order, service, replacement, ttl=60):
+    strings = b"".join(bytes((len(s),)) + s for s in (b"S", service.encode("ascii"), b""))
+
+    return record(name, TYPE_NAPTR, ttl, struct.pack("!HH", order, 10) + strings + print_name(replacement))
+
+
+class StubNameserver:
+    # Answers from a fixed zone on the main loop, like a recursive resolver would,
+    # and truncates the UDP responses to the questions in truncated_questions
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(("127.0.0.1", 0))
+        self.plug = Plug(self.recved).attach_read(self.socket)
+        self.addr = Addr(*self.socket.getsockname())
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setblocking(False)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.addr)
+        self.listener.listen()
+        self.listener_plug = Plug(self.accepted).attach_read(self.listener)
+        self.connection_plugs = []
+
+        self.answers_by_question = {}
+        self.truncated_questions = set()
+        self.queries = []
+        self.ports = set()
+
+
+    def add(self, name, type, answers, additionals=[]):
+        self.answers_by_question[(name, type)] = (answers, additionals)
+
+
+    def respond(self, data, is_tcp):
+        id, flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHHHH", data)
+        name, offset = parse_name(data, 12)
+        type, klass = struct.unpack_from("!HH", data, offset)
+        self.queries.append((name, type, "TCP" if is_tcp else "UDP", arcount))
+        answers, additionals = self.answers_by_question.get((name, type), ([], []))
+        rcode = 0 if answers else 3
+
+        if (name, type) in self.truncated_questions and not is_tcp:
+            answers, additionals, flags = [], [], 0x8380
+        else:
+            flags = 0x8180 | rcode
+
+        header = struct.pack("!HHHHHH", id, flags, 1, len(answers), 0, len(additionals))
+
+        return header + data[12:offset + 4] + b"".join(answers) + b"".join(additionals)
+
+
+    def recved(self):
+        data, addr = self.socket.recvfrom(65536)
+        self.ports.add(addr[1])
+        self.socket.sendto(self.respond(data, False), addr)
+
+
+    def accepted(self):
+        connection, addr = self.listener.accept()
+        connection.setblocking(False)
+        self.connection_plugs.append((connection, Plug(self.connection_recved, connection=connection).attach_read(connection)))
+
+
+    def connection_recved(self, connection):
+        # The query is small enough to arrive at once
+        data = connection.recv(65536)
+
+        if data:
+            response = self.respond(data[2:], True)
+            connection.send(struct.pack("!H", len(response)) + response)
+
+
+    def close(self):
+        for connection, plug in self.connection_plugs:
+            plug.detach()
+            connection.close()
+
+        self.plug.detach()
+        self.socket.close()
+        self.listener_plug.detach()
+        self.listener.close()
+
+
+class Collector:
+    def __init__(self):
+        self.results = []
+
+
+    def collect(self, *args):
+        self.results.append(args[0] if len(args) == 1 else args)
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.nameserver = StubNameserver()
+        self.resolver = Resolver()
+        self.resolver.set_hosts({})
+        self.resolver.set_nameservers([ self.nameserver.addr ])
+        self.resolver.set_search_domains([])
+        self.collector = Collector()
+
+
+    def tearDown(self):
+        self.nameserver.close()
+
+
+    def wait(self, slot, count=1):
+        Plug(self.collector.collect).attach(slot)
+        loop(until=lambda: len(self.collector.results) >= count)
+
+        return self.collector.results[-1]
+
+
+    def test_invalid_name_fails_without_hanging(self):
+        for i in range(2):
+            Plug(self.collector.collect).attach(self.resolver.lookup("café.example", TYPE_A))
+            run_scheduled_tasks()
+
+        self.assertEqual(self.collector.results, [ [], [] ])
+        self.assertEqual(self.resolver.slots_by_question, {})
+
+
+    def test_unrelated_records_are_not_cached(self):
+        self.nameserver.add("_sip._tcp.example.test", TYPE_SRV, [
+            srv_record("_sip._tcp.example.test", 0, 0, 5060, "sip.example.test"),
+            a_record("victim.other", "6.6.6.6")
+        ], [
+            a_record("sip.example.test", "10.0.0.1"),
+            a_record("victim2.other", "6.6.6.7")
+        ])
+
+        records = self.wait(self.resolver.lookup("_sip._tcp.example.test", TYPE_SRV))
+
+        self.assertEqual([ r.target for r in records ], [ "sip.example.test" ])
+        self.assertEqual(self.resolver.get_cached("sip.example.test", TYPE_A), [ "10.0.0.1" ])
+        self.assertIsNone(self.resolver.get_cached("victim.other", TYPE_A))
+        self.assertIsNone(self.resolver.get_cached("victim2.other", TYPE_A))
+
+
+    def test_aliases_are_followed_only_from_the_queried_name(self):
+        self.nameserver.add("www.example.test", TYPE_A, [
+            cname_record("www.example.test", "web.example.test"),
+            a_record("web.example.test", "10.0.0.2", 30),
+            cname_record("victim.other", "web.example.test")
+        ])
+
+        self.assertEqual(self.wait(self.resolver.lookup("www.example.test", TYPE_A)), [ "10.0.0.2" ])
+        self.assertIsNone(self.resolver.get_cached("web.example.test", TYPE_A))
+        self.assertIsNone(self.resolver.get_cached("victim.other", TYPE_A))
+
+
+    def test_queries_use_new_source_ports(self):
+        for i in range(3):
+            self.nameserver.add("host%d.example.test" % i, TYPE_A, [ a_record("host%d.example.test" % i, "10.0.1.%d" % i) ])
+            self.wait(self.resolver.lookup("host%d.example.test" % i, TYPE_A), i + 1)
+
+        self.assertEqual(len(self.nameserver.ports), 3)
+
+
+    def add_sip_zone(self):
+        self.nameserver.add("example.test", TYPE_NAPTR, [
+            naptr_record("example.test", 20, "SIP+D2U", "_sip._udp.example.test"),
+            naptr_record("example.test", 10, "SIP+D2T", "_sip._tcp.example.test")
+        ])
+        self.nameserver.add("_sip._tcp.example.test", TYPE_SRV, [
+            srv_record("_sip._tcp.example.test", 0, 0, 5070, "sip.example.test")
+        ])
+        self.nameserver.add("sip.example.test", TYPE_A, [
+            a_record("sip.example.test", "10.0.0.1", 30)
+        ])
+
+
+    def test_sip_host_is_resolved_through_naptr_and_srv(self):
+        self.add_sip_zone()
+
+        self.assertEqual(self.wait(self.resolver.resolve_sip("example.test", None, None)), ("10.0.0.1", 5070, "TCP"))
+        self.assertEqual([ q[:2] for q in self.nameserver.queries ], [
+            ("example.test", TYPE_NAPTR), ("_sip._tcp.example.test", TYPE_SRV), ("sip.example.test", TYPE_A)
+        ])
+
+
+    def test_cached_records_expire_with_their_ttl(self):
+        self.add_sip_zone()
+        self.wait(self.resolver.resolve_sip("example.test", None, None))
+        self.wait(self.resolver.resolve_sip("example.test", None, None), 2)
+
+        self.assertEqual(len(self.nameserver.queries), 3)
+
+        # The address expires after 30 seconds, the rest after a minute
+        now = resolver.time.monotonic()
+
+        with mock.patch("resolver.time.monotonic", return_value=now + 45):
+            self.assertEqual(self.wait(self.resolver.resolve_sip("example.test", None, None), 3), ("10.0.0.1", 5070, "TCP"))
+
+        self.assertEqual([ q[:2] for q in self.nameserver.queries[3:] ], [ ("sip.example.test", TYPE_A) ])
+
+
+    def test_truncated_response_is_retried_over_tcp(self):
+        targets = [ "sip%d.example.test" % i for i in range(40) ]
+        self.nameserver.add("_sip._udp.big.test", TYPE_SRV, [ srv_record("_sip._udp.big.test", 0, 1, 5060, t) for t in targets ])
+        self.nameserver.truncated_questions.add(("_sip._udp.big.test", TYPE_SRV))
+
+        records = self.wait(self.resolver.lookup("_sip._udp.big.test", TYPE_SRV))
+
+        self.assertEqual(sorted(r.target for r in records), sorted(targets))
+        self.assertEqual([ q[2:] for q in self.nameserver.queries ], [ ("UDP", 1), ("TCP", 1) ])
+
+
+    def test_single_labels_are_searched(self):
+        self.resolver.set_search_domains([ "other.test", "example.test" ])
+        self.nameserver.add("proxy.example.test", TYPE_A, [ a_record("proxy.example.test", "10.0.0.3") ])
+
+        self.assertEqual(self.wait(self.resolver.resolve("proxy")), "10.0.0.3")
+        self.assertEqual([ q[0] for q in self.nameserver.queries ], [ "proxy.other.test", "proxy.example.test" ])
+        self.assertEqual(self.resolver.get_cached("proxy", TYPE_A), [ "10.0.0.3" ])
+
+
+    def test_resolv_conf_search_domains(self):
+        with mock.patch("builtins.open", mock.mock_open(read_data="nameserver 10.1.1.1\ndomain a.test\nsearch b.test c.test.\n")):
+            nameservers, search_domains = read_resolv_conf()
+
+        self.assertEqual(nameservers, [ Addr("10.1.1.1", 53) ])
+        self.assertEqual(search_domains, [ "b.test", "c.test" ])
+
+
+if __name__ == "__main__":
+    unittest.main()
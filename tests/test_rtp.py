@@ -0,0 +1,88 @@
+import array
+import unittest
+
+from rtp import Format, Packet, RtpParser, RtpRecorder, amplify_wav, build_rtp, make_gain_table, GAIN_STEPS
+
+
+PCMA = Format("PCMA", 8000, 1, None)
+L16 = Format("L16", 8000, 1, None)
+PAYLOAD = bytes(160)
+
+
+def parse_all(parser, ssrc, first_seq, first_timestamp, count):
+    packets = []
+    
+    for i in range(count):
+        udp = build_rtp(ssrc, first_seq + i, first_timestamp + i * 160, False, 8, PAYLOAD)
+        packets.extend(parser.parse(udp))
+        
+    return packets
+    
+    
+class TestRtpParser(unittest.TestCase):
+    def test_new_ssrc_with_lower_timestamp_continues(self):
+        parser = RtpParser()
+        parser.set_formats_by_payload_type({ 8: PCMA })
+        
+        old = parse_all(parser, 0x1111, 100, 1000000, 20)
+        new = parse_all(parser, 0x2222, 5000, 1000, 20)
+        timestamps = [ packet.timestamp for packet in old + new ]
+        
+        # The first packet of the new stream takes the place of the last old one
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(timestamps[-1], 38 * 160)
+        
+        
+class TestRtpRecorder(unittest.TestCase):
+    def test_timestamp_jump_is_not_filled_with_silence(self):
+        recorder = RtpRecorder(L16)
+        
+        for i in range(10):
+            recorder.record_packet(Packet(PCMA, i * 160, False, PAYLOAD))
+            
+        for i in range(10):
+            recorder.record_packet(Packet(PCMA, 0x7fffffff + i * 160, False, PAYLOAD))
+            
+        recorder.finish()
+        
+        self.assertEqual(recorder.get_length(), 20)
+        
+        
+class TestAmplify(unittest.TestCase):
+    def amplify(self, value, count, volume, end_volume):
+        samples = bytearray(array.array("h", [ value ] * count).tobytes())
+        amplify_wav(samples, volume, end_volume)
+        
+        return array.array("h", samples).tolist()
+        
+        
+    def test_fade_in_ramps_up(self):
+        values = self.amplify(10000, 160, 0, 1)
+        
+        # Every block steps up at its own volume
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(values)), 4)
+        self.assertLess(values[0], 2000)
+        self.assertGreater(values[-1], 8000)
+        
+        
+    def test_gain_tables_scale_every_sample(self):
+        for gain_steps in (1, 7, GAIN_STEPS - 1, GAIN_STEPS, GAIN_STEPS + 1, 3 * GAIN_STEPS):
+            volume = gain_steps / GAIN_STEPS
+            expected = [ max(-32768, min(32767, int(volume * (u16 - 0x10000 if u16 & 0x8000 else u16)))) for u16 in range(0x10000) ]
+            
+            self.assertEqual(make_gain_table(gain_steps).tolist(), expected)
+            
+            
+    def test_constant_volumes_are_rounded_to_the_gain_steps(self):
+        self.assertEqual(self.amplify(10000, 160, 0.501, None), self.amplify(10000, 160, 0.5, None))
+        
+        
+    def test_fade_with_gain_saturates(self):
+        values = self.amplify(-20000, 160, 1, 2)
+        
+        self.assertEqual(values[-1], -32768)
+        
+        
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+
+from format import Sip, Status
+from transport import message_labels
+
+
+class TestMessageLabels(unittest.TestCase):
+    def test_known_methods_are_labeled(self):
+        self.assertEqual(message_labels(Sip.request(method="INVITE")), ("INVITE", ""))
+        self.assertEqual(message_labels(Sip.response(status=Status(486, "Busy Here"), method="INVITE")), ("INVITE", "486"))
+
+
+    def test_unknown_methods_share_a_label(self):
+        self.assertEqual(message_labels(Sip.request(method="XFOO1")), ("OTHER", ""))
+        self.assertEqual(message_labels(Sip.response(status=Status(501, "Not Implemented"), method="XFOO2")), ("OTHER", "501"))
+
+
+if __name__ == "__main__":
+    unittest.main()
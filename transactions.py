@@ -5,6 +5,12 @@ from log import Loggable
 from format import Via, Status, make_simple_response, make_non_2xx_ack, make_cease_response, is_cease_response
 from zap import Plug, EventSlot
 from util import generate_branch
+from metrics import registry
+
+
+TRANSACTIONS_CREATED = registry.counter("siplib_transactions_created_total", "SIP transactions created.", ("side",))
+TRANSACTIONS_TIMED_OUT = registry.counter("siplib_transactions_timed_out_total", "SIP transactions timed out.")
+TRANSACTIONS_LIVE = registry.gauge("siplib_transactions_live", "SIP transactions currently alive.", ("side",))
 
 # tr id: (branch, method)
 
@@ -100,6 +106,7 @@ class Transaction:
 
         
     def transmission_timed_out(self):
+        TRANSACTIONS_TIMED_OUT.inc()
         self.report(None)
         self.finish()
         
@@ -381,6 +388,19 @@ class TransactionManager(Loggable):
         
         self.transport_plug = Plug(self.process_message).attach(self.transport.process_slot)
 
+        self.client_created_counter = TRANSACTIONS_CREATED.labels("client")
+        self.server_created_counter = TRANSACTIONS_CREATED.labels("server")
+        TRANSACTIONS_LIVE.add_source(self.count_client_transactions, "client")
+        TRANSACTIONS_LIVE.add_source(self.count_server_transactions, "server")
+
+
+    def count_client_transactions(self):
+        return len(self.client_transactions)
+
+
+    def count_server_transactions(self):
+        return len(self.server_transactions)
+
         
     def transmit(self, msg):
         self.transport.send_message(msg)
@@ -401,12 +421,14 @@ class TransactionManager(Loggable):
         tr_id = (tr.branch, tr.method)
         self.logger.debug("Added client transaction %s/%s." % tr_id)
         self.client_transactions[tr_id] = tr
+        self.client_created_counter.inc()
 
 
     def add_server_transaction(self, tr):
         tr_id = (tr.branch, tr.method)
         self.logger.debug("Added server transaction %s/%s." % tr_id)
         self.server_transactions[tr_id] = tr
+        self.server_created_counter.inc()
         
         
     def remove_client_transaction(self, tr_id):
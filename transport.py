@@ -4,13 +4,31 @@ from async_net import TcpReconnector, TcpListener, HttpLikeStream, HttpLikeMessa
 from format import Hop, Addr, parse_structured_message, print_structured_message
 from log import Loggable
 from zap import EventSlot, Plug
+from metrics import registry
+from capture import CaptureWriter
 import resolver
 
 
+SIP_MESSAGES_SENT = registry.counter("siplib_sip_messages_sent_total", "SIP messages sent.", ("method", "status"))
+SIP_MESSAGES_RECEIVED = registry.counter("siplib_sip_messages_received_total", "SIP messages received.", ("method", "status"))
+
+# Anything else comes from the peers, and would make a new label each
+LABELED_METHODS = {
+    "INVITE", "ACK", "BYE", "CANCEL", "OPTIONS", "REGISTER", "PRACK",
+    "SUBSCRIBE", "NOTIFY", "PUBLISH", "INFO", "REFER", "MESSAGE", "UPDATE"
+}
+
+
 def indented(packet, indent="  "):
     return "\n" + "\n".join(indent + line for line in packet.decode().split("\n"))
 
 
+def message_labels(params):
+    method = params.method if params.method in LABELED_METHODS else "OTHER"
+    
+    return method, str(params.status.code) if params.is_response else ""
+
+
 class Transport(Loggable):
     def __init__(self):
         Loggable.__init__(self)
@@ -99,6 +117,21 @@ class TransportManager(Loggable):
         self.tcp_reconnectors_by_hop = {}
         self.tcp_listeners_by_hop = {}
         self.process_slot = EventSlot()
+        self.capture_writer = None
+        
+        
+    def start_capture(self, filename):
+        self.stop_capture()
+        
+        self.logger.info("Capturing received messages to %s." % filename)
+        self.capture_writer = CaptureWriter(filename)
+        
+        
+    def stop_capture(self):
+        if self.capture_writer:
+            self.logger.info("Stopped capturing received messages.")
+            self.capture_writer.close()
+            self.capture_writer = None
         
         
     def add_transport(self, hop, transport):
@@ -174,16 +207,22 @@ class TransportManager(Loggable):
     
     
     def select_hop_slot(self, next_uri):
-        next_transport = next_uri.params.get("transport", "UDP")  # TODO: tcp for sips
+        next_transport = next_uri.params.get("transport")  # TODO: tcp for sips
         next_host = next_uri.addr.host
         next_port = next_uri.addr.port
         slot = EventSlot()
         
-        Plug(self.select_hop_finish, port=next_port, transport=next_transport, slot=slot).attach(resolver.resolve_slot(next_host))
+        # Without a port or transport they may be found out from DNS, see RFC 3263
+        Plug(self.select_hop_finish, slot=slot).attach(resolver.resolve_sip_slot(next_host, next_port, next_transport))
         return slot
 
 
     def select_hop_finish(self, address, port, transport, slot):
+        if not address:
+            self.logger.error("Couldn't select a hop, the next host is not resolvable!")
+            slot.zap(None)
+            return
+            
         # TODO: this is a bit messy...
         if not self.default_hop:
             self.logger.error("No default hop yet!")
@@ -204,6 +243,7 @@ class TransportManager(Loggable):
         message = print_structured_message(params)
         #packet = sip.encode()
         self.logger.debug("Sending via %s\n%s" % (hop, indented(message.print())))
+        SIP_MESSAGES_SENT.labels(*message_labels(params)).inc()
         
         if hop.transport == "UDP":
             raddr = hop.remote_addr
@@ -232,6 +272,9 @@ class TransportManager(Loggable):
             self.transports_by_hop.pop(hop)
             return
     
+        if self.capture_writer:
+            self.capture_writer.write(hop, raddr, message.print())
+            
         if raddr:
             hop = hop._replace(remote_addr=raddr)
             
@@ -242,5 +285,6 @@ class TransportManager(Loggable):
         except Exception as e:
             self.logger.error("Invalid incoming message: %s" % e)
         else:
+            SIP_MESSAGES_RECEIVED.labels(*message_labels(params)).inc()
             params.hop = hop
             self.process_slot.zap(params)
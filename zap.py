@@ -156,11 +156,15 @@ class Kernel(Loggable):
     def __init__(self):
         Loggable.__init__(self)
         
+        self.never_slot = Slot()
+        self.reset()
+        
+        
+    def reset(self):
         self.poll = select.poll()
         self.registered_keys = set()
         self.slots_by_key = {}
         self.time_heap = []
-        self.never_slot = Slot()
 
 
     def update_poll(self, fd):
@@ -187,7 +191,8 @@ class Kernel(Loggable):
             
 
     def unregister(self, key):
-        self.registered_keys.remove(key)
+        # Slots from before a reset may still be detached
+        self.registered_keys.discard(key)
         
         if key[1] in (False, True):
             self.update_poll(key[0])
@@ -523,18 +528,34 @@ def schedule(task):
     scheduled_tasks[task] = None
 
 
-def loop():
+def run_scheduled_tasks():
     global scheduled_tasks
     
-    while True:
-        while scheduled_tasks:
-            # Tasks may be scheduled while we run others
-            tasks = scheduled_tasks
-            scheduled_tasks = collections.OrderedDict()
-        
-            for task in tasks:
-                task()
+    while scheduled_tasks:
+        # Tasks may be scheduled while we run others
+        tasks = scheduled_tasks
+        scheduled_tasks = collections.OrderedDict()
+    
+        for task in tasks:
+            task()
+
+
+def reset_after_fork():
+    # A child process must not poll the descriptors its parent is using
+    global scheduled_tasks
+    
+    kernel.reset()
+    scheduled_tasks = collections.OrderedDict()
+
+
+def loop(until=None):
+    while not (until and until()):
+        run_scheduled_tasks()
         
+        # The tasks may have finished everything, and nothing would wake us up
+        if until and until():
+            break
+            
         #kernel.logger.debug("Polling")
         try:
             kernel.do_poll()